@@ -1,90 +1,287 @@
 import argparse
+import json
 import os
+import queue
+import re
+import shlex
 import subprocess
+import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from prd_exec import ToolResult, get_runner
+from prd_ccache import CompileCache, describe
+from prd_compile import CFLAGS_DEFAULT
 
 CREATE_ASM = "create_asm.py"
 ASM_START_MARKER = "In-line assembly for compilation:"
 ASM_STUB_MARKER = "/* ASM STACK HERE */"
+DETOUR_PREFIX = "det_"
+FUNC_HEADER_RE = re.compile(r"^([0-9a-f]+) <(.+)>:$")
+ASM_WORKER = os.path.join(os.path.dirname(os.path.realpath(__file__)), "prd_asm_worker.py")
+
+# the targets are fitted concurrently (--jobs), each one only touches its own directory:
+#  no chdir and no shared tmp file, create_asm.py runs in the target directory and its output is read
+#  from its stdout, the tools are bounded by the runner's per-tool limits
+# only the functions of the target list (and their detour entries) are disassembled, one 'objdump
+#  --disassemble=<sym>' each (objdump takes a single symbol), and the listing is piped to create_asm.py
+#  instead of a whole-binary objdump.txt; if one of them isn't in the binary the whole binary is dumped
+#  as before (--keep-objdump still writes what create_asm.py got to <target>/objdump.txt)
+# create_asm.py runs in long-lived workers (prd_asm_worker.py, one per job), which load the interpreter and
+#  create_asm.py's imports once for all the targets; if a worker can't be used the targets go back to one
+#  create_asm.py process each (also --no-batch)
+#
+# python3 asm_fitter.py target_list recompiled/ -j 8 --timings fit_timings.json
+
+class CreateAsmWorkers():
+    # at most size workers, each one handling one target at a time
+    def __init__(self, script, size):
+        self.script = script
+        self.size = size
+        self.idle = queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+        self.broken = False
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if len(self.workers) < self.size:
+                proc = subprocess.Popen([sys.executable, ASM_WORKER, self.script], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, encoding='ISO-8859-1')
+                self.workers.append(proc)
+                return proc
+        return self.idle.get()
+
+    # => ToolResult, None when the worker failed (it isn't used again, nor are the others)
+    def run(self, command, cwd, input):
+        if self.broken:
+            return None
+        proc = self.acquire()
+        t = time.perf_counter()
+        try:
+            proc.stdin.write(json.dumps({'argv': command[1:], 'cwd': cwd, 'input': input.decode('ISO-8859-1')}) + "\n")
+            proc.stdin.flush()
+            reply = json.loads(proc.stdout.readline())
+        except (OSError, ValueError) as e:
+            with self.lock:
+                if not self.broken:
+                    print("create_asm worker failed (%s), running create_asm.py once per target" % e)
+                self.broken = True
+            proc.kill()
+            return None
+        self.idle.put(proc)
+        return ToolResult("create_asm", command, reply['returncode'], reply['stdout'].encode('ISO-8859-1'),
+                          reply['stderr'].encode('ISO-8859-1'), time.perf_counter()-t)
+
+    def close(self):
+        for proc in self.workers:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+        for proc in self.workers:
+            proc.wait()
+
+
 
 class ASM_Fitter():
-    def __init__(self, target_list_path, target_directory):
+    def __init__(self, target_list_path, target_directory, cache_dir=None, use_cache=True, jobs=None, cflags=CFLAGS_DEFAULT,
+                 detour_prefix=DETOUR_PREFIX, keep_objdump=False, batch=True):
         self.target_list_path = target_list_path
-        self.target_directory = target_directory
+        self.target_directory = os.path.abspath(target_directory)
+        self.runner = get_runner()
+        # the fitter recompiles the same sources on every repair iteration
+        self.cache = CompileCache(cache_dir) if use_cache else None
+        self.jobs = jobs if jobs else (os.cpu_count() or 1)
+        # as many of each tool as there are workers (the compile cache runs gcc as 'cc')
+        for tool in ["cc", "gcc", "nm", "objdump", "create_asm"]:
+            self.runner.limits[tool] = max(self.runner.limits.get(tool, 1), self.jobs)
+        self.cflags = shlex.split(cflags)
+        self.detour_prefix = detour_prefix
+        self.keep_objdump = keep_objdump
+        self.batch = batch
+        self.workers = None
+
+
+    def extract_asm(self, lines):
+        inASM = False
+        asmCode = ""
+        for line in lines.splitlines():
+            if inASM:
+                asmCode += "\t"+ line + "\n"
+                if ");" in line:
+                    inASM = False
+            if ASM_START_MARKER in line:
+                inASM = True
+        return asmCode
+
+
+    # the defined function symbols of funcs (<f> and <detour_prefix><f>, patchmain for main)
+    #  => [symbols], None when one of funcs isn't defined at all
+    def targeted_symbols(self, binary, funcs):
+        r = self.runner.run("nm", ["nm", "--defined-only", binary])
+        if not r.ok:
+            return None
+        defined = set()
+        for line in r.text().splitlines():
+            fields = line.split()
+            if len(fields) == 3 and fields[1] in "TtWw":
+                defined.add(fields[2])
+        symbols = []
+        for f in funcs:
+            names = [f, self.detour_prefix+f] + (["patchmain"] if f == "main" else [])
+            found = [n for n in names if n in defined]
+            if len(found) == 0:
+                return None
+            symbols += [n for n in found if n not in symbols]
+        return symbols
+
+
+    # => (listing, targeted), listing in objdump -d format
+    def disassemble(self, binary, funcs):
+        symbols = self.targeted_symbols(binary, funcs)
+        if symbols:
+            jobs = [self.runner.submit("objdump", ["objdump", "-d", "--disassemble="+s, binary]) for s in symbols]
+            header = None
+            blocks = dict()
+            for job in jobs:
+                r = job.result()
+                if not r.ok:
+                    break
+                lines = r.text().splitlines()
+                if header is None:
+                    header = [l for l in lines if "file format" in l][:1]
+                block = None
+                for line in lines:
+                    m = FUNC_HEADER_RE.match(line)
+                    if m:
+                        block = blocks.setdefault(int(m.group(1), 16), [])
+                        block.append(line)
+                    elif block is not None:
+                        if line.strip() == "":
+                            block = None
+                        else:
+                            block.append(line)
+            else:
+                if len(blocks) >= len(symbols):
+                    text = "\n" + "\n".join(header) + "\n\n\nDisassembly of section .text:\n\n"
+                    text += "\n\n".join(["\n".join(blocks[a]) for a in sorted(blocks)]) + "\n"
+                    return text.encode('ISO-8859-1'), True
+        r = self.runner.run("objdump", ["objdump", "-d", binary])
+        return r.stdout, False
+
+
+    # => {'target', 'status', per-step seconds}
+    def fit(self, target, funcList):
+        t = time.perf_counter()
+        times = {'target': target, 'status': "ok", 'compile': 0.0, 'objdump': 0.0, 'create_asm': 0.0, 'cached': None,
+                 'objdump_bytes': 0, 'targeted': False}
+        mainFunc = funcList[0].strip()
+        targetBaseDir = os.path.join(self.target_directory, target)
+        targetPath = os.path.join(targetBaseDir, target+"_recomp.c")
+        targetObjDumpPath = os.path.join(targetBaseDir, "objdump.txt")
+        outputRunPath = os.path.join(targetBaseDir, "run")
+        createASMPath = os.path.join(self.target_directory, CREATE_ASM)
+        funcArgs = ",".join(funcList[1:])
+        funcArgs = mainFunc+":"+funcArgs
+        funcArgs = funcArgs.strip(":")
+
+        if not os.path.exists(targetPath):
+            times['status'] = "%s does not exist" % targetPath
+            times['total'] = time.perf_counter()-t
+            return times
+
+        if self.cache:
+            r = self.cache.compile("gcc", targetPath, self.cflags, outputRunPath, self.runner)
+            times['cached'] = r.cached
+        else:
+            r = self.runner.run("gcc", ["gcc", targetPath]+self.cflags+["-o", outputRunPath])
+        times['compile'] = r.wall
+        if not r.ok:
+            # nothing to fit, the marker stays for the next attempt
+            err = (r.stderr or b"").decode('utf-8', errors='replace').strip().splitlines()
+            times['status'] = "compilation failed" + (": "+err[-1] if err else "")
+            times['total'] = time.perf_counter()-t
+            return times
+
+        t0 = time.perf_counter()
+        listing, times['targeted'] = self.disassemble(outputRunPath, [f.strip() for f in funcList if f.strip() != ""])
+        times['objdump'] = time.perf_counter()-t0
+        times['objdump_bytes'] = len(listing)
+        if self.keep_objdump:
+            with open(targetObjDumpPath, "wb") as dumpFile:
+                dumpFile.write(listing)
+
+        command = [createASMPath, "--objdump-log", "/dev/stdin", "--debug", "--func", funcArgs]
+        r = self.workers.run(command, targetBaseDir, listing) if self.workers else None
+        times['batch'] = r is not None
+        if r is None:
+            r = self.runner.run("create_asm", command, cwd=targetBaseDir, input=listing)
+        times['create_asm'] = r.wall
+        if not r.ok:
+            times['status'] = "create_asm failed (exit %s)" % r.returncode
+        asmCode = self.extract_asm(r.text())
+
+        with open(targetPath, "r") as targetFile:
+            lines = targetFile.read()
+        lines = lines.replace(ASM_STUB_MARKER, "\n"+asmCode)
+        with open(targetPath, "w") as targetFile:
+            targetFile.write(lines)
+        times['total'] = time.perf_counter()-t
+        return times
 
 
     def run(self):
+        t = time.perf_counter()
+        targets = []
         with open(self.target_list_path, "r") as targetFile:
             for line in targetFile:
+                if line.strip() == "":
+                    continue
                 target, path, funcs = line.split(",")
-                target = target.strip()
-                path = path.strip()
-                funcList = funcs.split(":")
-                mainFunc = funcList[0].strip()
-
-                targetPath = os.path.join(self.target_directory, target, target+"_recomp.c")
-                targetBaseDir = os.path.join(self.target_directory, target)
-                targetObjDumpPath = os.path.join(self.target_directory, target, "objdump.txt")
-                outputRunPath = os.path.join(self.target_directory, target, "run")
-                createASMPath = os.path.join(self.target_directory, CREATE_ASM)
-                funcArgs = ",".join(funcList[1:])
-                funcArgs = mainFunc+":"+funcArgs
-                funcArgs = "\""+funcArgs.strip(":")+"\""
-                print("Fitting", target)
-                # print(createASMPath)
-                # print(funcArgs)
-
-                if os.path.exists(targetPath):
-                    subprocess.run(["gcc", targetPath, "-m32", "-w", "-o", outputRunPath])
-                    command = ["objdump", "-d", outputRunPath]
-                    # print("Running", command)
-                    # subprocess.run(command)
-                    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    out, err = p.communicate()
-                    with open(targetObjDumpPath, "wb") as dumpFile:
-                        dumpFile.write(out)
-                    dumpFile.close()
-                    # print(out)
-                    # print(err)
-                    os.chdir(targetBaseDir)
-                    # print("Running:")
-                    command = [createASMPath, "--objdump-log", targetObjDumpPath, "--debug", "--func", funcArgs, ">", "tmp"]
-                    commandLine = " ".join(command)
-                    # print(" ".join(command))
-                    # subprocess.call(command)
-                    # p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    # out, err = p.communicate()
-                    # print(out)
-                    os.system(commandLine)
-
-                    with open("tmp", "r") as tmpFile:
-                        lines = tmpFile.read()
-                    tmpFile.close()
-
-                    inASM = False
-                    asmCode = ""
-                    for line in lines.splitlines():
-                        if inASM:
-                            asmCode += "\t"+ line + "\n"
-                            if ");" in line:
-                                inASM = False
-                        if ASM_START_MARKER in line:
-                            inASM = True
-                    # print(asmCode)
-
-                    with open(targetPath, "r") as targetFile:
-                        lines = targetFile.read()
-                    targetFile.close()
+                targets.append((target.strip(), funcs.split(":")))
 
-                    lines = lines.replace(ASM_STUB_MARKER, "\n"+asmCode)
-                    # print(lines)
+        createASMPath = os.path.join(self.target_directory, CREATE_ASM)
+        if self.batch and os.path.exists(createASMPath):
+            self.workers = CreateAsmWorkers(createASMPath, self.jobs)
+        results = []
+        with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="asm-fitter") as pool:
+            jobs = [(target, pool.submit(self.fit, target, funcList)) for target, funcList in targets]
+            # reported in target list order
+            for target, job in jobs:
+                try:
+                    times = job.result()
+                except Exception as e:
+                    times = {'target': target, 'status': "%s: %s" % (type(e).__name__, e)}
+                print("Fitting", target)
+                print("   - Done" if times['status'] == "ok" else "   - "+times['status'])
+                if times.get('cached'):
+                    print("   - compile cache hit (%s)" % times['cached'])
+                results.append(times)
+        if self.workers:
+            self.workers.close()
 
-                    with open(targetPath, "w") as targetFile:
-                        targetFile.write(lines)
-                    targetFile.close()
-                    print("   - Done")
-                else:
-                    print("   - %s does not exist" % targetPath)
+        wall = time.perf_counter()-t
+        print("%-24s %8s %8s %9s %10s %8s  %s" % ("target", "gcc(s)", "objdump", "dump(KB)", "create_asm", "total", "status"))
+        for r in results:
+            print("%-24s %8.3f %8.3f %9.1f%s %10.3f %8.3f  %s" % (r['target'], r.get('compile', 0.0), r.get('objdump', 0.0),
+                r.get('objdump_bytes', 0)/1024, " " if r.get('targeted') else "*", r.get('create_asm', 0.0),
+                r.get('total', 0.0), r['status']))
+        print("(* whole-binary disassembly)")
+        fitted = len([r for r in results if r['status'] == "ok"])
+        print("%d targets fitted in %.3fs with %d workers (%.3fs of target time, %.1f targets/s)" % (
+            fitted, wall, self.jobs, sum([r.get('total', 0.0) for r in results]), fitted/wall if wall > 0 else 0.0))
+        print("create_asm.py: %d targets in batch workers, %d in their own process" % (
+            len([r for r in results if r.get('batch')]), len([r for r in results if r.get('batch') is False])))
+        if self.cache:
+            self.cache.trim()
+            print("Compile cache:", describe(self.cache.counters))
+            self.cache.save_stats()
+        return {'jobs': self.jobs, 'wall': wall, 'batch': self.batch, 'targets': results}
 
 
 
@@ -94,9 +291,30 @@ def main():
                         help='path to the list of target binaries + func info')
     parser.add_argument('target_directory',
                         help='path to target directory')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='targets fitted concurrently (default: #cpus)')
+    parser.add_argument('--cflags', default=CFLAGS_DEFAULT,
+                        help='compiler flags, as one string (--cflags="%s")' % CFLAGS_DEFAULT)
+    parser.add_argument('--timings', default=None,
+                        help='write the per-target timings to this JSON file')
+    parser.add_argument('--cache-dir', dest='cache_dir', default=None,
+                        help='compile cache directory (default: $PRD_COMPILE_CACHE or ~/.cache/prd-compile)')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help='always run gcc')
+    parser.add_argument('--detour-prefix', dest='detour_prefix', default=DETOUR_PREFIX,
+                        help='prefix of the detour entry functions (as given to prd_multidecomp_ida.py)')
+    parser.add_argument('--keep-objdump', dest='keep_objdump', action='store_true',
+                        help='also write the disassembly given to create_asm.py to <target>/objdump.txt')
+    parser.add_argument('--no-batch', dest='batch', action='store_false',
+                        help='run create_asm.py once per target instead of in long-lived workers')
 
     args, unknownargs = parser.parse_known_args()
-    asmFitter = ASM_Fitter(args.target_list, args.target_directory)
-    asmFitter.run()
+    asmFitter = ASM_Fitter(args.target_list, args.target_directory, args.cache_dir, args.use_cache, args.jobs, args.cflags,
+                             args.detour_prefix, args.keep_objdump, args.batch)
+    summary = asmFitter.run()
+    if args.timings:
+        with open(args.timings, "w") as f:
+            json.dump(summary, f, indent=1)
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
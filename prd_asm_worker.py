@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import contextlib
+import io
+import json
+import os
+import runpy
+import sys
+import threading
+import time
+import traceback
+
+# long-lived create_asm.py worker for asm_fitter.py: the interpreter and the modules create_asm.py imports are
+#  loaded once, then every request runs the script again (runpy, fresh globals) in the target's directory
+#  - one JSON line per request on stdin, one reply per line on stdout:
+#      {"argv": [...], "cwd": ..., "input": ...} => {"returncode": ..., "stdout": ..., "stderr": ..., "wall": ...}
+#  - "/dev/stdin" in argv is the request's input (a pipe), as when the script runs on its own, sys.stdin too
+#  - what the script prints is captured, anything written to fd 1 directly ends up on the worker's stderr
+#
+# python3 prd_asm_worker.py <target_directory>/create_asm.py
+
+
+def feed(fd,data:bytes):
+    try:
+        with os.fdopen(fd,'wb') as f:
+            f.write(data)
+    except (BrokenPipeError,OSError):
+        # the script didn't read all of it
+        pass
+
+
+def run_script(script,request):
+    t=time.perf_counter()
+    rfd,wfd=os.pipe()
+    data=request.get('input',"")
+    writer=threading.Thread(target=feed,args=(wfd,data.encode('ISO-8859-1')),daemon=True)
+    writer.start()
+    argv=[f"/dev/fd/{rfd}" if a=="/dev/stdin" else a for a in request['argv']]
+    out,err=io.StringIO(),io.StringIO()
+    returncode=0
+    cwd=os.getcwd()
+    try:
+        os.chdir(request.get('cwd',cwd))
+        sys.argv=[script]+argv
+        sys.stdin=io.StringIO(data)
+        with contextlib.redirect_stdout(out),contextlib.redirect_stderr(err):
+            runpy.run_path(script,run_name="__main__")
+    except SystemExit as e:
+        if isinstance(e.code,int):
+            returncode=e.code
+        elif e.code is not None:
+            err.write(f"{e.code}\n")
+            returncode=1
+    except BaseException:
+        err.write(traceback.format_exc())
+        returncode=1
+    finally:
+        os.chdir(cwd)
+        os.close(rfd)
+    writer.join()
+    return {'returncode':returncode,'stdout':out.getvalue(),'stderr':err.getvalue(),'wall':time.perf_counter()-t}
+
+
+def main():
+    script=os.path.abspath(sys.argv[1])
+    sys.path.insert(0,os.path.dirname(script))
+    # replies get their own copy of stdout, fd 1 goes to stderr
+    replies=os.fdopen(os.dup(1),'w')
+    os.dup2(2,1)
+    requests=sys.stdin
+    for line in requests:
+        if line.strip()=="":
+            continue
+        replies.write(json.dumps(run_script(script,json.loads(line)))+"\n")
+        replies.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import re
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import prd_multidecomp_ida as prd
+from prd_compile import CC_DEFAULT, CFLAGS_DEFAULT
+from prd_exec import get_runner
+from prd_log import configure_logging
+
+# offline benchmarks for the CodeCleaner stages, no IDA needed
+#  - synthetic IDA print_decls dumps (typedefs.h) and Hex-Rays function files are generated at increasing scales
+#  - every case reports best-of-N wall time and peak traced memory per scale, plus the scaling exponent
+#    (slope of log(time) over log(scale)), so an accidental O(n^2) shows up as an exponent close to 2
+#
+# python3 prd_benchmark.py --scales 100,200,400,800 --json bench.json --max-exponent 1.5
+#
+# --pch-targets reports, per target of an output directory made with --pch, the compile time of <target>_recomp.c
+#  with and without its precompiled header
+# python3 prd_benchmark.py --pch-targets out/ --json pch.json
+
+
+def gen_type_dump(structs=100,unions=None,enums=None,fnptrs=None,cycles=0.1,seed=0):
+    # typedefs.h as written by get_ida_details.py: START/END markers, the 'decls:' line,
+    #  then one '/* ordinal */' comment per declaration and the declaration over several lines
+    #  cycles: fraction of structs holding a pointer to a struct declared after them
+    r=random.Random(seed)
+    unions=structs//5 if unions is None else unions
+    enums=structs//5 if enums is None else enums
+    fnptrs=structs//5 if fnptrs is None else fnptrs
+    decls=[]
+    for i in range(enums):
+        decls.append([f"enum E{i} : __int32","{"]+[f"  E{i}_V{j} = 0x{j:X}," for j in range(r.randint(2,8))]+["};"])
+    for i in range(structs):
+        decls.append([f"struct S{i};"])
+    for i in range(structs):
+        fields=["  int id;","  unsigned char flags;"]
+        for j in range(r.randint(1,6)):
+            if i>0 and r.random()<0.5:
+                fields.append(f"  S{r.randrange(i)}_t member{j};")
+            else:
+                fields.append(f"  _DWORD raw{j}[{r.randint(1,16)}];")
+        if i+1<structs and r.random()<cycles:
+            fields.append(f"  struct S{r.randrange(i+1,structs)} *next;")
+        elif i>0:
+            fields.append(f"  struct S{r.randrange(i)} *prev;")
+        decls.append([f"struct S{i}","{"]+fields+["};"])
+        decls.append([f"typedef struct S{i} S{i}_t;"])
+    for i in range(unions):
+        members=[f"  S{r.randrange(structs)}_t as_s{j};" for j in range(r.randint(1,3))] if structs>0 else []
+        decls.append([f"union U{i}","{","  int as_int;","  float as_float;"]+members+["};"])
+        decls.append([f"typedef union U{i} U{i}_t;"])
+    for i in range(fnptrs):
+        arg=f"S{r.randrange(structs)}_t *" if structs>0 else "void *"
+        # without the calling convention: remove_artifacts turns '(__cdecl *f)' into '( *f)', which is_function_ptr rejects
+        decls.append([f"typedef int (*fnptr{i})({arg}, int);"])
+
+    out=[prd.TYPEDEF_START,"decls: "+",".join(str(i+1) for i in range(len(decls)))]
+    for i,d in enumerate(decls):
+        out.append(f"/* {i+1} */")
+        out+=d
+    out.append(prd.TYPEDEF_END)
+    return "\n".join(out)+"\n"
+
+
+def gen_symbols(nfuncs):
+    fn_symbols=[f"cgc_fn{j}" for j in range(nfuncs*4)]+[f"cgc_det{i}" for i in range(nfuncs)]
+    data_symbols=[f"gvar{j}" for j in range(nfuncs*2)]
+    glibc_symbols=['memcpy','strlen','printf','malloc','free']
+    return fn_symbols,data_symbols,glibc_symbols
+
+
+def gen_hexrays_func(i,nfuncs,nstubs=40,ndata=20,seed=0):
+    # decompiled output of one detour function (cgc_det<i>), laid out like IDA's hexrays output
+    r=random.Random(seed*1000003+i)
+    out=["//"+"-"*73,prd.IDA_STUB_START,""]
+    called=r.sample(range(nfuncs*4),min(nstubs,nfuncs*4))
+    for j in called:
+        out.append(f"int __cdecl cgc_fn{j}(int a{j}, char *b, unsigned int c);")
+    out.append("void *__cdecl memcpy(void *dest, const void *src, size_t n);")
+    out.append("size_t __cdecl strlen(const char *s);")
+    out.append(f"int __cdecl cgc_det{i}(int x);")
+    out+=["","//"+"-"*73,prd.IDA_DATA_START,""]
+    for j in r.sample(range(nfuncs*2),min(ndata,nfuncs*2)):
+        out.append(f"int gvar{j}; // idb")
+    body=[f"  v1 = cgc_fn{j}(x, (char *)&gvar{j%(nfuncs*2)}, {j});" for j in called[:8]]
+    out+=["","",f"//----- ({0x8048000+i*0x40:08X}) "+"-"*56,f"int __cdecl cgc_det{i}(int x)","{",
+          "  int v1; // eax","","  v1 = x;"]+body+["  memcpy(&v1, &x, 4u);","  return v1 + strlen(\"x\");","}",""]
+    return "\n".join(out)
+
+
+# --------------------------------------------------------------------------------------------------
+# benchmark cases: setup(scale) => state (not measured), run(state) (measured)
+
+def _typedef_dump(scale,args):
+    tmp=tempfile.mkdtemp(prefix="prd-bench-")
+    with open(os.path.join(tmp,"typedefs.h"),"w") as f:
+        f.write(gen_type_dump(scale,cycles=args.cycles,seed=args.seed))
+    # the same extraction run() uses, typedefs.h is already there so IDA isn't called
+    dump=prd.IDAWrapper(None).get_typedef_mappings(None,tmp,True)
+    os.remove(os.path.join(tmp,"typedefs.h"))
+    os.rmdir(tmp)
+    return dump
+
+def setup_remove_artifacts(scale,args):
+    return _typedef_dump(scale,args)
+
+def run_remove_artifacts(dump):
+    prd.CodeCleaner().remove_artifacts(dump,True)
+
+def setup_typedef_resolution(scale,args):
+    c=prd.CodeCleaner()
+    dump=c.remove_artifacts(_typedef_dump(scale,args),True)
+    return c.typedef_remove_errata(c.typedef_firstpass(dump))
+
+def run_typedef_resolution(dump):
+    prd.CodeCleaner().typedef_resolution(dump)
+
+def setup_cleanup_typedefs(scale,args):
+    return prd.CodeCleaner().remove_artifacts(_typedef_dump(scale,args),False)
+
+def run_cleanup_typedefs(dump):
+    prd.CodeCleaner().cleanup_typedefs(dump)
+
+def setup_get_stubs(scale,args):
+    c=prd.CodeCleaner()
+    codes=[c.remove_artifacts(gen_hexrays_func(i,scale,seed=args.seed),True) for i in range(scale)]
+    return scale,codes
+
+def run_get_stubs(state):
+    # same accumulation as the per-function loop of GenprogDecomp.run_target
+    scale,codes=state
+    fn_symbols,data_symbols,glibc_symbols=gen_symbols(scale)
+    detours_re=re.compile(r"\b("+"|".join(f"cgc_det{i}" for i in range(scale))+r")\b")
+    c=prd.CodeCleaner()
+    stubs,funcHeaders,decomp_decls=prd.PrototypeTable(),prd.PrototypeTable(),prd.PrototypeTable()
+    dataMap,data_decls,translate_dict,guessed=dict(),list(),dict(),set()
+    for code in codes:
+        dataMap,_,d,data_decls=c.get_data_declarations(code,data_symbols,dataMap,data_decls)
+        guessed|=set(c.get_guessed_funcs(code))
+        stubs,funcHeaders,h,s,f,d,g,translate_dict,rm=c.get_stubs(code,stubs,funcHeaders,detours_re,decomp_decls,
+            fn_symbols,glibc_symbols,data_symbols,translate_dict,guessed,decomp_decls)
+        for x in rm:
+            decomp_decls.remove(x)
+        decomp_decls.extend(g)
+    return stubs,funcHeaders
+
+def setup_make_pcgc_stubs(scale,args):
+    return run_get_stubs(setup_get_stubs(scale,args))+(gen_symbols(scale)[2],)
+
+def run_make_pcgc_stubs(state):
+    stubs,funcHeaders,glibc_symbols=state
+    prd.CodeCleaner().make_pcgc_stubs(stubs,funcHeaders,glibc_symbols)
+
+CASES={
+    'remove_artifacts':(setup_remove_artifacts,run_remove_artifacts,"structs"),
+    'typedef_resolution':(setup_typedef_resolution,run_typedef_resolution,"structs"),
+    'cleanup_typedefs':(setup_cleanup_typedefs,run_cleanup_typedefs,"structs"),
+    'get_stubs':(setup_get_stubs,run_get_stubs,"functions"),
+    'make_pcgc_stubs':(setup_make_pcgc_stubs,run_make_pcgc_stubs,"functions"),
+}
+
+
+# --------------------------------------------------------------------------------------------------
+# precompiled headers: compile times of each target in a scratch copy, without then with the .gch
+
+def best_compile(cmd,repeat):
+    best=None
+    for _ in range(repeat):
+        r=get_runner().run('cc',cmd,check=True)
+        best=r.wall if best is None else min(best,r.wall)
+    return best
+
+def pch_benchmark(outdir,cflags,repeat):
+    rows=[]
+    for target in sorted(os.listdir(outdir)):
+        srcdir=os.path.join(outdir,target)
+        if not os.path.exists(os.path.join(srcdir,prd.PCH_HEADER)):
+            continue
+        tmp=tempfile.mkdtemp(prefix="prd-bench-pch-")
+        try:
+            for name in os.listdir(srcdir):
+                if os.path.isfile(os.path.join(srcdir,name)) and not name.endswith(".gch"):
+                    shutil.copy(os.path.join(srcdir,name),tmp)
+            hdr=os.path.join(tmp,prd.PCH_HEADER)
+            cmd=[CC_DEFAULT]+cflags+["-c",os.path.join(tmp,target+"_recomp.c"),"-o",os.path.join(tmp,target+".o")]
+            lines=0
+            for name in ["defs.h","resolved-types.h"]:
+                if os.path.exists(os.path.join(tmp,name)):
+                    with open(os.path.join(tmp,name),'r',errors='replace') as f:
+                        lines+=len(f.readlines())
+            without=best_compile(cmd,repeat)
+            build=get_runner().run('cc',[CC_DEFAULT]+cflags+["-x","c-header",hdr,"-o",hdr+".gch"],check=True).wall
+            with_pch=best_compile(cmd,repeat)
+        finally:
+            shutil.rmtree(tmp)
+        saved=without-with_pch
+        rows.append({'target':target,'header_lines':lines,'without':without,'with':with_pch,'build':build,'saved':saved,
+            'saved_pct':100*saved/without if without>0 else 0.0,'break_even':math.ceil(build/saved) if saved>0 else None})
+    return rows
+
+
+def scaling_exponent(points):
+    # least squares slope of log(time) vs log(scale)
+    pts=[(math.log(n),math.log(t)) for n,t in points if t>0]
+    if len(pts)<2:
+        return None
+    mx=sum([x for x,_ in pts])/len(pts)
+    my=sum([y for _,y in pts])/len(pts)
+    den=sum([(x-mx)**2 for x,_ in pts])
+    return sum([(x-mx)*(y-my) for x,y in pts])/den if den>0 else None
+
+
+def measure(run,state,repeat):
+    # the stages print a lot, that's not what we're measuring
+    with open(os.devnull,"w") as devnull, contextlib.redirect_stdout(devnull):
+        best=None
+        for _ in range(repeat):
+            t=time.perf_counter()
+            run(state)
+            t=time.perf_counter()-t
+            best=t if best is None else min(best,t)
+        tracemalloc.start()
+        run(state)
+        peak=tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best,peak
+
+
+def main():
+    parser=argparse.ArgumentParser(description='Offline scaling benchmarks for the recompilation stages')
+    parser.add_argument('--cases',default=None,
+                        help=f'comma separated cases to run (default: all of {",".join(CASES.keys())}, none with --pch-targets)')
+    parser.add_argument('--scales',default="100,200,400",
+                        help='comma separated scales (number of structs or of detour functions)')
+    parser.add_argument('--repeat',type=int,default=3,help='timed runs per scale, the best one is reported')
+    parser.add_argument('--budget',type=float,default=30.0,
+                        help='seconds; a case stops growing once one of its runs takes longer than this')
+    parser.add_argument('--cycles',type=float,default=0.1,help='fraction of structs with a forward pointer (type cycles)')
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--json',dest='json_out',default=None,help='write the results to this file')
+    parser.add_argument('--max-exponent',type=float,default=None,
+                        help='exit with an error if any case scales worse than this')
+    parser.add_argument('--pch-targets',dest='pch_targets',default=None,
+                        help='output directory of a --pch run, report the compile time saved by each precompiled header')
+    parser.add_argument('--pch-flags',dest='pch_flags',default=CFLAGS_DEFAULT,
+                        help=f'compiler flags for --pch-targets, as one string (default: --pch-flags="{CFLAGS_DEFAULT}")')
+    args=parser.parse_args()
+    configure_logging("ERROR")
+    if args.cases is None:
+        args.cases="" if args.pch_targets else ",".join(CASES.keys())
+
+    scales=[int(x) for x in args.scales.split(",")]
+    results=dict()
+    failed=[]
+    for name in [c for c in args.cases.split(",") if c]:
+        setup,run,unit=CASES[name]
+        print(f"{name} (scale = {unit})",flush=True)
+        print(f"  {'scale':>8} {'time(s)':>10} {'peak(MB)':>10}")
+        points=[]
+        rows=[]
+        for n in scales:
+            with open(os.devnull,"w") as devnull, contextlib.redirect_stdout(devnull):
+                state=setup(n,args)
+            t,peak=measure(run,state,args.repeat)
+            points.append((n,t))
+            rows.append({'scale':n,'time':t,'peak_bytes':peak})
+            print(f"  {n:>8} {t:>10.4f} {peak/2**20:>10.2f}",flush=True)
+            if t>args.budget:
+                print(f"  over the {args.budget}s budget, skipping the larger scales",flush=True)
+                break
+        exp=scaling_exponent(points)
+        print(f"  scaling exponent: {exp:.2f}" if exp is not None else "  scaling exponent: n/a",flush=True)
+        results[name]={'unit':unit,'points':rows,'exponent':exp}
+        if args.max_exponent is not None and exp is not None and exp>args.max_exponent:
+            failed.append(name)
+
+    pch=None
+    if args.pch_targets:
+        print(f"precompiled headers ({args.pch_targets}, best of {args.repeat})",flush=True)
+        print(f"  {'target':<24} {'hdr lines':>9} {'without(s)':>10} {'with(s)':>10} {'saved':>7} {'build(s)':>9} {'break-even':>10}")
+        pch=pch_benchmark(args.pch_targets,shlex.split(args.pch_flags),args.repeat)
+        for r in pch:
+            print(f"  {r['target']:<24} {r['header_lines']:>9} {r['without']:>10.4f} {r['with']:>10.4f} {r['saved_pct']:>6.1f}% "+
+                f"{r['build']:>9.4f} {str(r['break_even'] if r['break_even'] else '-'):>10}",flush=True)
+        if len(pch)>0:
+            total=sum([r['without'] for r in pch])
+            print(f"  total: {total:.4f}s => {sum([r['with'] for r in pch]):.4f}s per compile of every target",flush=True)
+        else:
+            print(f"  no target with a {prd.PCH_HEADER} in {args.pch_targets}")
+
+    if args.json_out:
+        with open(args.json_out,"w") as f:
+            json.dump({'scales':scales,'repeat':args.repeat,'cycles':args.cycles,'seed':args.seed,'results':results,'pch':pch},f,indent=1)
+    if failed:
+        print(f"ERROR: scaling exponent above {args.max_exponent} for {','.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
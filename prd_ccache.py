@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from prd_exec import ToolResult, get_runner
+
+# compile cache for the recompiled translation units (used by prd_compile.py and asm_fitter.py)
+#  - an entry is keyed by the hash of the preprocessed TU (gcc -E) + compiler identity + flags, and holds
+#    the output (object/executable), the return code and the diagnostics (failed compilations are cached too)
+#  - direct mode: a manifest keyed by the source file itself records which headers the TU included (and
+#    their hashes) and the entry it led to, so when neither the source nor its headers changed the entry
+#    is found without running gcc at all; otherwise the TU is preprocessed and looked up by its hash
+#  - entries are evicted least recently used first once the cache is over its size bound
+#  - hit/miss counters are kept per cache (stats.json), 'python3 prd_ccache.py stats' prints them
+#
+# linking pulls in the system libraries, which aren't part of the key (same as ccache: clear the cache
+#  after a toolchain/libc update)
+
+CACHE_DIR_DEFAULT=os.environ.get('PRD_COMPILE_CACHE',os.path.join(os.path.expanduser("~"),".cache","prd-compile"))
+CACHE_MAX_BYTES=2*2**30
+MANIFEST_ENTRIES=8
+COUNTERS=['direct_hits','preprocessed_hits','misses','uncacheable','stores','evictions']
+
+
+def hash_bytes(data:bytes):
+    return hashlib.sha256(data).hexdigest()
+
+
+class CompileCache:
+    def __init__(self,cache_dir=None,max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir=os.path.abspath(cache_dir if cache_dir else CACHE_DIR_DEFAULT)
+        self.max_bytes=max_bytes
+        self.counters={k:0 for k in COUNTERS}
+        self.compilers=dict() # cc => identity
+        self.file_hashes=dict() # (path, mtime_ns, size) => hash
+        for d in ['entries','manifests']:
+            os.makedirs(os.path.join(self.cache_dir,d),exist_ok=True)
+
+    def entry_dir(self,key):
+        return os.path.join(self.cache_dir,'entries',key[:2],key)
+
+    def manifest_path(self,key):
+        return os.path.join(self.cache_dir,'manifests',key[:2],key+".json")
+
+    async def compiler_identity(self,runner,cc):
+        ident=self.compilers.get(cc,None)
+        if ident is None:
+            r=await runner.run_async('cc',[cc,"--version"])
+            ident=self.compilers[cc]=hash_bytes((str(shutil.which(cc))+"\0").encode()+(r.stdout or b""))
+        return ident
+
+    def file_hash(self,path):
+        try:
+            st=os.stat(path)
+        except OSError:
+            return None
+        k=(path,st.st_mtime_ns,st.st_size)
+        h=self.file_hashes.get(k,None)
+        if h is None:
+            with open(path,'rb') as f:
+                h=self.file_hashes[k]=hash_bytes(f.read())
+        return h
+
+    # the headers a preprocessed TU came from, from its '# <line> "<file>" <flags>' markers
+    def included_files(self,preprocessed:bytes,source):
+        files=set()
+        for line in preprocessed.split(b"\n"):
+            if line.startswith(b"# ") and b'"' in line:
+                name=line.split(b'"')[1].decode('ISO-8859-1')
+                if not name.startswith("<") and name!=source:
+                    files.add(os.path.abspath(name))
+        return sorted(files)
+
+    def lookup_manifest(self,direct_key):
+        try:
+            with open(self.manifest_path(direct_key),'r') as f:
+                manifest=json.load(f)
+        except (OSError,ValueError):
+            return None
+        for m in manifest:
+            if all([self.file_hash(p)==h for p,h in m['includes'].items()]) and os.path.exists(self.entry_dir(m['key'])):
+                return m['key']
+        return None
+
+    def update_manifest(self,direct_key,includes:dict,key):
+        path=self.manifest_path(direct_key)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        try:
+            with open(path,'r') as f:
+                manifest=json.load(f)
+        except (OSError,ValueError):
+            manifest=[]
+        manifest=[{'includes':includes,'key':key}]+[m for m in manifest if m['key']!=key]
+        self.write_json(path,manifest[:MANIFEST_ENTRIES])
+
+    def write_json(self,path,data):
+        fd,tmp=tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd,'w') as f:
+            json.dump(data,f)
+        os.replace(tmp,path)
+
+    def fetch(self,key,output):
+        d=self.entry_dir(key)
+        try:
+            with open(os.path.join(d,'result.json'),'r') as f:
+                res=json.load(f)
+            if res['returncode']==0:
+                shutil.copy2(os.path.join(d,'output'),output)
+        except (OSError,ValueError):
+            return None
+        # recently used => evicted last
+        os.utime(d)
+        return res
+
+    def store(self,key,result:ToolResult,output):
+        final=self.entry_dir(key)
+        if os.path.exists(final):
+            return
+        os.makedirs(os.path.dirname(final),exist_ok=True)
+        tmp=tempfile.mkdtemp(dir=os.path.dirname(final),prefix=".tmp-")
+        if result.returncode==0:
+            shutil.copy2(output,os.path.join(tmp,'output'))
+        self.write_json(os.path.join(tmp,'result.json'),{'returncode':result.returncode,
+            'stdout':(result.stdout or b"").decode('ISO-8859-1'),'stderr':(result.stderr or b"").decode('ISO-8859-1'),
+            'time':result.wall})
+        try:
+            os.rename(tmp,final)
+            self.counters['stores']+=1
+        except OSError:
+            # stored by another process in the meantime
+            shutil.rmtree(tmp,ignore_errors=True)
+
+    def cached_result(self,cmd,res,t,how):
+        r=ToolResult('cc',cmd,res['returncode'],res['stdout'].encode('ISO-8859-1'),res['stderr'].encode('ISO-8859-1'),time.perf_counter()-t)
+        r.cached=how
+        return r
+
+    # compile source into output (cc source flags -o output), going through the cache => ToolResult (+ .cached)
+    #  after: a concurrent Future to wait for first (e.g. the build of a precompiled header the source uses)
+    async def compile_async(self,runner,cc,source,flags:list,output,after=None):
+        if after is not None:
+            import asyncio
+            await asyncio.wrap_future(after)
+        t=time.perf_counter()
+        cmd=[cc,source]+list(flags)+["-o",output]
+        src=os.path.abspath(source)
+        ident=await self.compiler_identity(runner,cc)
+        with open(src,'rb') as f:
+            direct_key=hash_bytes("\0".join([ident,src]+list(flags)).encode()+b"\0"+f.read())
+        key=self.lookup_manifest(direct_key)
+        if key is not None:
+            res=self.fetch(key,output)
+            if res is not None:
+                self.counters['direct_hits']+=1
+                return self.cached_result(cmd,res,t,'direct')
+
+        pp=await runner.run_async('cc',[cc]+list(flags)+["-E",source])
+        if pp.returncode!=0:
+            # the compiler will report why, nothing to cache
+            self.counters['uncacheable']+=1
+            r=await runner.run_async('cc',cmd)
+            r.cached=None
+            return r
+        key=hash_bytes("\0".join([ident]+list(flags)).encode()+b"\0"+pp.stdout)
+        includes={p:self.file_hash(p) for p in self.included_files(pp.stdout,source)}
+        res=self.fetch(key,output)
+        if res is not None:
+            self.counters['preprocessed_hits']+=1
+            self.update_manifest(direct_key,includes,key)
+            return self.cached_result(cmd,res,t,'preprocessed')
+
+        self.counters['misses']+=1
+        r=await runner.run_async('cc',cmd)
+        r.cached=None
+        if not r.timed_out and (r.returncode!=0 or os.path.exists(output)):
+            self.store(key,r,output)
+            self.update_manifest(direct_key,includes,key)
+        return r
+
+    def submit(self,runner,cc,source,flags,output,after=None):
+        import asyncio
+        return asyncio.run_coroutine_threadsafe(self.compile_async(runner,cc,source,flags,output,after),runner._start())
+
+    def compile(self,cc,source,flags,output,runner=None):
+        return self.submit(runner if runner else get_runner(),cc,source,flags,output).result()
+
+    def entries(self):
+        # => [(last use, bytes, path)]
+        found=[]
+        root=os.path.join(self.cache_dir,'entries')
+        for sub in os.listdir(root):
+            for key in os.listdir(os.path.join(root,sub)):
+                d=os.path.join(root,sub,key)
+                if key.startswith(".tmp-"):
+                    continue
+                size=sum([os.path.getsize(os.path.join(d,f)) for f in os.listdir(d)])
+                found.append((os.stat(d).st_mtime,size,d))
+        return found
+
+    # least recently used entries go first, down to 90% of the bound
+    def trim(self):
+        entries=sorted(self.entries())
+        total=sum([e[1] for e in entries])
+        if total<=self.max_bytes:
+            return total
+        for _,size,d in entries:
+            if total<=0.9*self.max_bytes:
+                break
+            shutil.rmtree(d,ignore_errors=True)
+            total-=size
+            self.counters['evictions']+=1
+        return total
+
+    # adds this process' counters to the cache's stats.json => the totals
+    def save_stats(self):
+        path=os.path.join(self.cache_dir,"stats.json")
+        with open(os.path.join(self.cache_dir,".lock"),'w') as lock:
+            fcntl.flock(lock,fcntl.LOCK_EX)
+            try:
+                with open(path,'r') as f:
+                    totals=json.load(f)
+            except (OSError,ValueError):
+                totals=dict()
+            for k,v in self.counters.items():
+                totals[k]=totals.get(k,0)+v
+            self.write_json(path,totals)
+        self.counters={k:0 for k in COUNTERS}
+        return totals
+
+    def load_stats(self):
+        try:
+            with open(os.path.join(self.cache_dir,"stats.json"),'r') as f:
+                return json.load(f)
+        except (OSError,ValueError):
+            return dict()
+
+
+def hit_rate(counters:dict):
+    hits=counters.get('direct_hits',0)+counters.get('preprocessed_hits',0)
+    total=hits+counters.get('misses',0)+counters.get('uncacheable',0)
+    return hits/total if total>0 else 0.0
+
+
+def describe(counters:dict):
+    return (f"{hit_rate(counters)*100:.1f}% hit rate: {counters.get('direct_hits',0)} direct, "+
+        f"{counters.get('preprocessed_hits',0)} preprocessed, {counters.get('misses',0)} misses, "+
+        f"{counters.get('uncacheable',0)} uncacheable, {counters.get('evictions',0)} evicted")
+
+
+def main():
+    parser=argparse.ArgumentParser(description='Compile cache of the recompiled targets')
+    parser.add_argument('--cache-dir',dest='cache_dir',default=CACHE_DIR_DEFAULT)
+    parser.add_argument('--max-mb',type=float,default=CACHE_MAX_BYTES/2**20)
+    parser.add_argument('cmd',choices=['stats','trim','clear'])
+    args=parser.parse_args()
+    cache=CompileCache(args.cache_dir,int(args.max_mb*2**20))
+    if args.cmd=='clear':
+        shutil.rmtree(cache.cache_dir)
+        print(f"removed {cache.cache_dir}")
+        return
+    if args.cmd=='trim':
+        total=cache.trim()
+        cache.save_stats()
+    else:
+        total=sum([e[1] for e in cache.entries()])
+    stats=cache.load_stats()
+    stats.update({'entries':len(cache.entries()),'bytes':total,'max_bytes':cache.max_bytes,'hit_rate':hit_rate(stats)})
+    print(json.dumps(stats,indent=1))
+
+
+if __name__ == "__main__":
+    main()
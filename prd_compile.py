@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+import argparse
+import bisect
+import json
+import os
+import re
+import shlex
+import shutil
+import time
+from concurrent.futures import Future
+
+from prd_ccache import CompileCache, describe, hit_rate
+from prd_exec import ToolRunner
+from prd_validate import doomed
+
+# parallel compile driver for the recompiled targets (what compile_all used to do serially)
+#  - every <target_directory>/<target>/<target>_recomp.c is compiled into results/<target> by a bounded pool
+#  - each target gets its own log (compile_logs/<target>.log), compile_log is still written, in target order
+#  - the targets that compiled are copied to working/
+#  - compilations go through the compile cache (prd_ccache.py), unchanged targets don't run gcc again
+#  - --validate: sources with structural errors (prd_validate.py) aren't compiled, their log gets those errors
+#  - --format compile_all prints what compile_all printed (the targets that succeed are the ones copied),
+#    --format json prints the summary; --summary writes it to a file either way
+#
+# python3 prd_compile.py recompiled/ -j 16 --summary compile_summary.json
+
+CC_DEFAULT="gcc"
+CFLAGS_DEFAULT="-m32 -w"
+SEPARATOR="="*49
+DIAGNOSTIC_RE=re.compile(r"^(.+?):(\d+):(?:(\d+):)? (fatal error|error|warning|note): (.*)$")
+# a function definition starts at column 0: <type> name(...  (not a prototype, those end with ';')
+DEFINITION_RE=re.compile(r"^[A-Za-z_][^(;=]*?\b([A-Za-z_]\w*)\s*\(")
+
+
+def find_targets(target_directory:str):
+    # => [(target, source)] in 'ls' order
+    targets=[]
+    for target in sorted(os.listdir(target_directory)):
+        path=os.path.join(target_directory,target,target+"_recomp.c")
+        if os.path.exists(path):
+            targets.append((target,path))
+    return targets
+
+
+# path is target or one of its parents
+def contains(path:str,target:str):
+    path,target=os.path.realpath(path),os.path.realpath(target)
+    return target==path or target.startswith(path.rstrip(os.sep)+os.sep)
+
+
+# empties path the way compile_all did: 'rm results/*' (files_only, the directories in it stay),
+#  'rm -r working/*'
+def clear_directory(path:str,files_only=False):
+    if not os.path.exists(path):
+        os.makedirs(path)
+        return
+    for name in os.listdir(path):
+        p=os.path.join(path,name)
+        if os.path.isdir(p) and not os.path.islink(p):
+            if not files_only:
+                shutil.rmtree(p)
+        else:
+            os.remove(p)
+
+
+# compiler output => [{'file','line','column','severity','message'}]
+def parse_diagnostics(text:str):
+    diags=[]
+    for line in text.splitlines():
+        m=DIAGNOSTIC_RE.match(line)
+        if m:
+            diags.append({'file':m.group(1),'line':int(m.group(2)),'column':int(m.group(3)) if m.group(3) else None,
+                'severity':m.group(4),'message':m.group(5)})
+    return diags
+
+
+# what the compiler printed => text, gcc writes its diagnostics in the locale's encoding (UTF-8 quotes)
+#  (the compile cache keeps the raw bytes, ISO-8859-1 there is just a lossless transport)
+def compiler_output(r):
+    return ((r.stdout or b"")+(r.stderr or b"")).decode('utf-8',errors='replace')
+
+
+def count_errors(diags:list):
+    return len([d for d in diags if d['severity'] in ('error','fatal error')])
+
+
+# the function definitions of a C file => [(first line, last line, name)], 1-based
+def definition_lines(path:str):
+    defs=[]
+    current=None
+    with open(path,'r',errors='replace') as f:
+        for n,line in enumerate(f,1):
+            if current is None:
+                m=DEFINITION_RE.match(line)
+                if m and not line.rstrip().endswith(";"):
+                    current=(n,m.group(1))
+            elif line.startswith("}"):
+                defs.append((current[0],n,current[1]))
+                current=None
+    return defs
+
+
+# => name of the function definition around line, None outside of them
+def function_at(defs:list,line:int):
+    i=bisect.bisect_right([d[0] for d in defs],line)-1
+    if i>=0 and defs[i][0]<=line<=defs[i][1]:
+        return defs[i][2]
+    return None
+
+
+class CompileDriver:
+    def __init__(self,target_directory,results="results",working="working",log_dir="compile_logs",
+                 compile_log="compile_log",cc=CC_DEFAULT,cflags=CFLAGS_DEFAULT,jobs=None,timeout=None,quiet=False,
+                 cache:CompileCache=None,validate=False):
+        self.target_directory=target_directory
+        self.results=results
+        self.working=working
+        self.log_dir=log_dir
+        self.compile_log=compile_log
+        self.cc=cc
+        self.cflags=shlex.split(cflags) if isinstance(cflags,str) else list(cflags)
+        self.jobs=jobs if jobs else (os.cpu_count() or 1)
+        self.timeout=timeout
+        self.quiet=quiet
+        self.cache=cache
+        self.validate=validate
+        self.runner=ToolRunner(limits={'cc':self.jobs},timeouts={'cc':timeout} if timeout else None)
+
+    def say(self,msg):
+        if not self.quiet:
+            print(msg,flush=True)
+
+    def command(self,source,output):
+        return [self.cc,source]+self.cflags+["-o",output]
+
+    def run(self):
+        t=time.perf_counter()
+        # working/ is emptied with its sub-directories, it mustn't hold the targets being compiled
+        if contains(self.working,self.target_directory):
+            raise ValueError(f"not clearing {self.working}, the target directory {self.target_directory} is in it")
+        if os.path.exists(self.compile_log):
+            os.remove(self.compile_log)
+        clear_directory(self.results,files_only=True)
+        clear_directory(self.working)
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+        self.say(SEPARATOR)
+        self.say("RUNNING")
+        self.say(SEPARATOR)
+
+        targets=find_targets(self.target_directory)
+        jobs=[]
+        for target,source in targets:
+            self.say("Processing "+source)
+            output=os.path.join(self.results,target)
+            r=doomed(source) if self.validate else None
+            if r is not None:
+                job=Future()
+                job.set_result(r)
+            elif self.cache:
+                job=self.cache.submit(self.runner,self.cc,source,self.cflags,output)
+            else:
+                job=self.runner.submit('cc',self.command(source,output))
+            jobs.append((target,source,output,job))
+
+        summary={'target_directory':self.target_directory,'jobs':self.jobs,'cc':self.command("<source>","<output>"),
+            'targets':dict(),'succeeded':[],'failed':[]}
+        with open(self.compile_log,"w") as log:
+            for target,source,output,job in jobs:
+                r=job.result()
+                text=compiler_output(r)
+                if r.timed_out:
+                    text+=f"compilation timed out after {r.wall:.1f}s\n"
+                tlog=os.path.join(self.log_dir,target+".log")
+                with open(tlog,"w") as f:
+                    f.write(text)
+                log.write(f"{SEPARATOR}\n{source}\n{text}{SEPARATOR}\n")
+                ok=r.ok and os.path.exists(output)
+                summary['targets'][target]={'source':source,'ok':ok,'returncode':r.returncode,'timed_out':r.timed_out,
+                    'time':r.wall,'log':tlog,'output':output if ok else None,'cached':getattr(r,'cached',None),
+                    'errors':count_errors(parse_diagnostics(text)),'validated_only':r.tool=='validate'}
+                summary['succeeded' if ok else 'failed'].append(target)
+
+        self.say("Copying compiled targets...")
+        for target in summary['succeeded']:
+            self.say("   - Copying "+os.path.join(self.target_directory,target))
+            shutil.copytree(os.path.join(self.target_directory,target),os.path.join(self.working,target),symlinks=True)
+        self.say(SEPARATOR)
+        summary['wall']=time.perf_counter()-t
+        summary['compile_time']=sum([x['time'] for x in summary['targets'].values()])
+        if self.cache:
+            self.cache.trim()
+            summary['cache']=dict(self.cache.counters,hit_rate=hit_rate(self.cache.counters),dir=self.cache.cache_dir)
+            self.say("Compile cache: "+describe(self.cache.counters))
+            self.cache.save_stats()
+        self.runner.close()
+        return summary
+
+
+def main():
+    parser=argparse.ArgumentParser(description='Compile the recompiled targets (<dir>/<target>/<target>_recomp.c) in parallel')
+    parser.add_argument('target_directory',help='directory with one sub-directory per target')
+    parser.add_argument('-j','--jobs',type=int,default=None,help='concurrent compilers (default: #cpus)')
+    parser.add_argument('--cc',default=CC_DEFAULT)
+    parser.add_argument('--cflags',default=CFLAGS_DEFAULT,help=f'compiler flags, as one string (--cflags="{CFLAGS_DEFAULT}")')
+    parser.add_argument('--timeout',type=float,default=None,help='seconds before a compilation is killed')
+    parser.add_argument('--results',default="results",help='where the binaries go')
+    parser.add_argument('--working',default="working",help='where the targets that compiled are copied')
+    parser.add_argument('--log-dir',dest='log_dir',default="compile_logs",help='per-target compiler output')
+    parser.add_argument('--compile-log',dest='compile_log',default="compile_log",help='all the compiler output, in target order')
+    parser.add_argument('--format',dest='fmt',default="compile_all",choices=['compile_all','json'],
+                        help="compile_all: print what compile_all printed, json: print the summary")
+    parser.add_argument('--cache-dir',dest='cache_dir',default=None,
+                        help='compile cache directory (default: $PRD_COMPILE_CACHE or ~/.cache/prd-compile)')
+    parser.add_argument('--cache-max-mb',dest='cache_max_mb',type=float,default=None,help='evict the least recently used entries above this size')
+    parser.add_argument('--no-cache',dest='use_cache',action='store_false',help='always run the compiler')
+    parser.add_argument('--validate',action='store_true',help="don't compile the sources prd_validate.py finds errors in")
+    parser.add_argument('--summary',default=None,help='also write the JSON summary to this file')
+    args=parser.parse_args()
+
+    cache=None
+    if args.use_cache:
+        cache=CompileCache(args.cache_dir) if args.cache_max_mb is None else CompileCache(args.cache_dir,int(args.cache_max_mb*2**20))
+    driver=CompileDriver(args.target_directory,args.results,args.working,args.log_dir,args.compile_log,
+        args.cc,args.cflags,args.jobs,args.timeout,quiet=(args.fmt=='json'),cache=cache,
+        validate=args.validate)
+    try:
+        summary=driver.run()
+    except ValueError as e:
+        parser.error(str(e))
+    if args.summary:
+        with open(args.summary,"w") as f:
+            json.dump(summary,f,indent=1)
+    if args.fmt=='json':
+        print(json.dumps(summary,indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import os
+import struct
+import tempfile
+
+# in-process ELF reader for the original binaries: symbols and code bytes, without running nm/objdump
+#  - ELF32/ELF64, either byte order, symbols from .symtab and .dynsym
+#  - detour entry offsets: a detour into main doesn't start at main itself, the original main first sets up
+#    what it needs to return (gcc's i386 prologue):
+#      lea 0x4(%esp),%ecx ; and $-16,%esp                  static: ecx holds the stack __libc_start_main returns to
+#      push -0x4(%ecx) ; push %ebp ; mov %esp,%ebp ; push %ebx ; push %ecx ; sub $n,%esp
+#      call __x86.get_pc_thunk.bx                          dynamic: ebx is loaded (PLT calls)
+#    the offsets are found by decoding those instructions, the ones that used to be hard-coded (main+7 static,
+#    main+23 dynamic) are used when the prologue isn't recognised
+#  - offsets are cached per (binary sha256, symbol), under $PRD_ELF_CACHE or ~/.cache/prd-elf, in a directory
+#    per decoder version (bump DETOUR_DECODER_VERSION when prologue_offsets or the defaults change)
+#
+# python3 prd_elf.py <binary> [symbol ...]
+
+ELF_CACHE_DIR_DEFAULT=os.environ.get('PRD_ELF_CACHE',os.path.join(os.path.expanduser("~"),".cache","prd-elf"))
+DETOUR_OFFSET_DEFAULTS={'dynamic':23,'static':7}
+DETOUR_DECODER_VERSION=1
+EM_386=3
+SHT_SYMTAB=2
+SHT_NOBITS=8
+SHT_DYNSYM=11
+SHF_ALLOC=0x2
+STT_FUNC=2
+PROLOGUE_MAX=64
+# call target that loads ebx with the return address: mov (%esp),%ebx ; ret
+PC_THUNK_BX=b"\x8b\x1c\x24\xc3"
+
+
+class ElfError(Exception):
+    pass
+
+
+class ElfFile:
+    def __init__(self,path):
+        self.path=path
+        with open(path,'rb') as f:
+            self.data=f.read()
+        # a truncated or corrupt file is an ElfError too, whatever part of it doesn't add up
+        try:
+            self.parse()
+        except (struct.error,ValueError,IndexError) as e:
+            raise ElfError(f"{path}: malformed ELF file ({e})")
+
+    def parse(self):
+        d=self.data
+        if d[:4]!=b"\x7fELF" or len(d)<52:
+            raise ElfError(f"{self.path}: not an ELF file")
+        self.bits=64 if d[4]==2 else 32
+        self.endian="<" if d[5]==1 else ">"
+        if self.bits==32:
+            hdr=struct.unpack_from(self.endian+"HHIIIIIHHHHHH",d,16)
+            self.shfmt=self.endian+"IIIIIIIIII"
+            self.symfmt=self.endian+"IIIBBH"
+        else:
+            hdr=struct.unpack_from(self.endian+"HHIQQQIHHHHHH",d,16)
+            self.shfmt=self.endian+"IIQQQQIIQQ"
+            self.symfmt=self.endian+"IBBHQQ"
+        self.machine=hdr[1]
+        self.entry=hdr[3]
+        shoff,shentsize,shnum=hdr[5],hdr[10],hdr[11]
+        # (name, type, flags, addr, offset, size, link, info, addralign, entsize)
+        self.sections=[struct.unpack_from(self.shfmt,d,shoff+i*shentsize) for i in range(shnum)] if shoff else []
+        self.symbols=self.read_symbols()
+
+    def string(self,offset):
+        return self.data[offset:self.data.index(b"\0",offset)].decode('ISO-8859-1')
+
+    def read_symbols(self):
+        # => {name: (value, size, type)}, .symtab first (a stripped binary only has .dynsym)
+        symbols=dict()
+        for stype in [SHT_SYMTAB,SHT_DYNSYM]:
+            for sh in self.sections:
+                if sh[1]!=stype or sh[6]>=len(self.sections):
+                    continue
+                stroff=self.sections[sh[6]][4]
+                size=struct.calcsize(self.symfmt)
+                for off in range(sh[4]+size,sh[4]+sh[5],size):
+                    if self.bits==32:
+                        name,value,ssize,info,_,shndx=struct.unpack_from(self.symfmt,self.data,off)
+                    else:
+                        name,info,_,shndx,value,ssize=struct.unpack_from(self.symfmt,self.data,off)
+                    if name==0 or shndx==0:
+                        continue
+                    symbols.setdefault(self.string(stroff+name),(value,ssize,info&0xf))
+        return symbols
+
+    # the file contents at a virtual address (allocated sections only) => bytes, possibly shorter than size
+    def read(self,addr,size):
+        for sh in self.sections:
+            if sh[2]&SHF_ALLOC and sh[1]!=SHT_NOBITS and sh[3]<=addr<sh[3]+sh[5]:
+                off=sh[4]+addr-sh[3]
+                return self.data[off:off+min(size,sh[3]+sh[5]-addr)]
+        return b""
+
+    def sha256(self):
+        return hashlib.sha256(self.data).hexdigest()
+
+
+# gcc's i386 main prologue => {'dynamic': offset or None, 'static': offset or None}
+#  only the instructions gcc puts there are decoded, the scan stops at the first other one (or at a call)
+def prologue_offsets(elf:ElfFile,addr):
+    code=elf.read(addr,PROLOGUE_MAX)
+    found={'dynamic':None,'static':None}
+    i=0
+    lea=False
+    while i<len(code):
+        c=code[i]
+        if code[i:i+4]==b"\xf3\x0f\x1e\xfb": # endbr32
+            i+=4
+        elif code[i:i+4]==b"\x8d\x4c\x24\x04": # lea 0x4(%esp),%ecx
+            i+=4
+            lea=True
+        elif code[i:i+2] in (b"\x83\xe4",b"\x81\xe4"): # and $n,%esp
+            i+=3 if c==0x83 else 6
+            if lea:
+                found['static']=i
+        elif code[i:i+3]==b"\xff\x71\xfc": # push -0x4(%ecx)
+            i+=3
+        elif 0x50<=c<=0x57: # push %reg
+            i+=1
+        elif code[i:i+2] in (b"\x89\xe5",b"\x8b\xec"): # mov %esp,%ebp
+            i+=2
+        elif code[i:i+2] in (b"\x83\xec",b"\x81\xec"): # sub $n,%esp
+            i+=3 if c==0x83 else 6
+        elif c==0xe8 and i+5<=len(code): # call rel32
+            rel=struct.unpack_from("<i",code,i+1)[0]
+            if rel==0 and code[i+5:i+6]==b"\x5b": # call 1f ; 1: pop %ebx
+                found['dynamic']=i+6
+            elif elf.read(addr+i+5+rel,4)==PC_THUNK_BX:
+                found['dynamic']=i+5
+            break
+        else:
+            break
+    return found
+
+
+class DetourOffsets:
+    def __init__(self,cache_dir=None):
+        self.cache_dir=os.path.abspath(cache_dir if cache_dir else ELF_CACHE_DIR_DEFAULT)
+        self.binaries=dict() # (path, mtime_ns, size) => sha256
+        self.memo=dict() # sha256 => {symbol: entry}
+
+    def cache_path(self,digest):
+        return os.path.join(self.cache_dir,f"v{DETOUR_DECODER_VERSION}",digest[:2],digest+".json")
+
+    def load(self,digest):
+        entries=self.memo.get(digest,None)
+        if entries is None:
+            try:
+                with open(self.cache_path(digest),'r') as f:
+                    entries=json.load(f)
+            except (OSError,ValueError):
+                entries=dict()
+            self.memo[digest]=entries
+        return entries
+
+    def save(self,digest,entries):
+        path=self.cache_path(digest)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        fd,tmp=tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd,'w') as f:
+            json.dump(entries,f)
+        os.replace(tmp,path)
+
+    def inspect(self,elf:ElfFile,symbol):
+        # => {'address', 'dynamic', 'static', 'decoded': [the ones that aren't defaults]}
+        sym=elf.symbols.get(symbol,None)
+        entry={'address':None,'decoded':[]}
+        entry.update(DETOUR_OFFSET_DEFAULTS)
+        if sym is None or sym[2]!=STT_FUNC or elf.machine!=EM_386:
+            return entry
+        entry['address']=sym[0]
+        found=prologue_offsets(elf,sym[0])
+        for k,v in found.items():
+            if v is not None:
+                entry[k]=v
+                entry['decoded'].append(k)
+        return entry
+
+    # offsets of the symbols' detour entries in binary => {symbol: entry + 'offset', 'cached'}
+    #  dynamic: the binary is dynamically linked (the offset after the EBX/PLT setup)
+    def offsets(self,binary,symbols:list,dynamic:bool):
+        st=os.stat(binary)
+        k=(os.path.abspath(binary),st.st_mtime_ns,st.st_size)
+        digest=self.binaries.get(k,None)
+        elf=None
+        if digest is None:
+            elf=ElfFile(binary)
+            digest=self.binaries[k]=elf.sha256()
+        entries=self.load(digest)
+        result=dict()
+        missing=[s for s in symbols if s not in entries]
+        if len(missing)>0:
+            if elf is None:
+                elf=ElfFile(binary)
+            for s in missing:
+                entries[s]=self.inspect(elf,s)
+            self.save(digest,entries)
+        for s in symbols:
+            result[s]=dict(entries[s],offset=entries[s]['dynamic' if dynamic else 'static'],cached=s not in missing)
+        return result
+
+
+def main():
+    parser=argparse.ArgumentParser(description='Detour entry offsets of an ELF binary\'s functions')
+    parser.add_argument('binary')
+    parser.add_argument('symbols',nargs='*',default=["main"])
+    parser.add_argument('--cache-dir',dest='cache_dir',default=None)
+    args=parser.parse_args()
+    elf=ElfFile(args.binary)
+    dynamic=any([sh[1]==SHT_DYNSYM for sh in elf.sections])
+    print(json.dumps(DetourOffsets(args.cache_dir).offsets(args.binary,args.symbols,dynamic),indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import os
+import shlex
+import threading
+import time
+
+# asyncio execution layer for the external tools (idat, r2ghidra, nm, c++filt, strip, gcc, objdump, ...)
+#  - one event loop in a background thread runs every tool process, so synchronous pipeline code can
+#    submit() a job (=> concurrent.futures.Future) and keep working while it runs, or just run() it
+#  - per-tool concurrency limits (e.g. one idat at a time) and timeouts, the process is killed on timeout
+#    or when its job is cancelled
+#  - stdout/stderr are captured, every tool gets calls/failures/timeouts/cancellations/wall time accounted
+#  - commands are argument lists, no shell in between (see shell_command for user supplied command lines)
+#  - asyncio is only imported once the first job is submitted, importing the pipeline stays cheap
+
+DEFAULT_LIMITS={'idat':1}
+TOOLS_NAME="prd_tools.json"
+
+
+class ToolResult:
+    def __init__(self,tool,cmd,returncode,stdout,stderr,wall,timed_out=False):
+        self.tool=tool
+        self.cmd=cmd
+        self.returncode=returncode
+        self.stdout=stdout
+        self.stderr=stderr
+        self.wall=wall
+        self.timed_out=timed_out
+
+    @property
+    def ok(self):
+        return self.returncode==0 and not self.timed_out
+
+    def text(self,encoding='ISO-8859-1'):
+        return self.stdout.decode(encoding) if self.stdout is not None else ""
+
+
+class ToolError(Exception):
+    def __init__(self,result:ToolResult):
+        self.result=result
+        if result.timed_out:
+            msg=f"{result.tool} timed out after {result.wall:.1f}s"
+        else:
+            msg=f"{result.tool} exited with {result.returncode}"
+        err=result.stderr.decode('ISO-8859-1',errors='replace').strip().splitlines() if result.stderr else []
+        if err:
+            msg+=f": {err[-1]}"
+        super().__init__(f"{msg} ({' '.join(result.cmd)})")
+
+
+# a user supplied command line (e.g. --r2ghidra) => argument list
+#  a line that needs the shell (pipes, redirections, ';', '&&', ...) is run with /bin/sh -c, explicitly
+def shell_command(cmdline:str):
+    lex=shlex.shlex(cmdline,posix=True,punctuation_chars=True)
+    lex.whitespace_split=True
+    tokens=list(lex)
+    if any([t and all([c in "();<>|&" for c in t]) for t in tokens]):
+        return ["/bin/sh","-c",cmdline]
+    return shlex.split(cmdline)
+
+
+class ToolRunner:
+    def __init__(self,limits=None,timeouts=None,default_limit=None):
+        self.limits=dict(DEFAULT_LIMITS)
+        self.limits.update(limits if limits else dict())
+        self.timeouts=dict(timeouts) if timeouts else dict() # tool => seconds
+        self.default_limit=default_limit if default_limit else (os.cpu_count() or 1)
+        self.semaphores=dict()
+        self.procs=set()
+        self.stats=dict()
+        self.lock=threading.Lock()
+        self.loop=None
+        self.thread=None
+
+    def _start(self):
+        import asyncio
+        with self.lock:
+            if self.loop is None:
+                self.loop=asyncio.new_event_loop()
+                self.thread=threading.Thread(target=self.loop.run_forever,name="prd-exec",daemon=True)
+                self.thread.start()
+        return self.loop
+
+    def _account(self,tool,result=None,cancelled=False):
+        s=self.stats.get(tool,None)
+        if s is None:
+            s=self.stats[tool]={'calls':0,'failed':0,'timeouts':0,'cancelled':0,'wall':0.0,'running':0,'max_running':0}
+        if result is None and not cancelled:
+            s['running']+=1
+            s['max_running']=max(s['max_running'],s['running'])
+            return
+        s['running']-=1
+        s['calls']+=1
+        if cancelled:
+            s['cancelled']+=1
+            return
+        s['wall']+=result.wall
+        if result.timed_out:
+            s['timeouts']+=1
+        elif result.returncode!=0:
+            s['failed']+=1
+
+    async def run_async(self,tool:str,cmd:list,input=None,env=None,cwd=None,timeout=None,stdout=None):
+        # stdout: a file object to send the output to instead of capturing it
+        import asyncio
+        sem=self.semaphores.get(tool,None)
+        if sem is None:
+            sem=self.semaphores[tool]=asyncio.Semaphore(self.limits.get(tool,self.default_limit))
+        timeout=timeout if timeout is not None else self.timeouts.get(tool,None)
+        async with sem:
+            self._account(tool)
+            t=time.perf_counter()
+            proc=None
+            try:
+                proc=await asyncio.create_subprocess_exec(*cmd,cwd=cwd,env=env,
+                    stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+                    stdout=stdout if stdout is not None else asyncio.subprocess.PIPE,stderr=asyncio.subprocess.PIPE)
+                self.procs.add(proc)
+                timed_out=False
+                try:
+                    out,err=await asyncio.wait_for(proc.communicate(input),timeout)
+                except asyncio.TimeoutError:
+                    proc.kill()
+                    out,err=await proc.communicate()
+                    timed_out=True
+                result=ToolResult(tool,cmd,proc.returncode,out,err,time.perf_counter()-t,timed_out)
+            except asyncio.CancelledError:
+                if proc is not None and proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                self._account(tool,cancelled=True)
+                raise
+            except OSError as e:
+                # the tool couldn't be started at all
+                result=ToolResult(tool,cmd,127,b"",str(e).encode(),time.perf_counter()-t)
+            finally:
+                self.procs.discard(proc)
+            self._account(tool,result)
+            return result
+
+    # => concurrent.futures.Future of the ToolResult
+    def submit(self,tool:str,cmd:list,**kw):
+        import asyncio
+        return asyncio.run_coroutine_threadsafe(self.run_async(tool,cmd,**kw),self._start())
+
+    def run(self,tool:str,cmd:list,check=False,**kw):
+        fut=self.submit(tool,cmd,**kw)
+        try:
+            result=fut.result()
+        except BaseException:
+            fut.cancel()
+            raise
+        if check and not result.ok:
+            raise ToolError(result)
+        return result
+
+    def cancel_all(self):
+        if self.loop is None:
+            return
+        import asyncio
+        def cancel():
+            for task in asyncio.all_tasks(self.loop):
+                task.cancel()
+        self.loop.call_soon_threadsafe(cancel)
+
+    def close(self):
+        if self.loop is None:
+            return
+        self.cancel_all()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop=None
+
+    def report(self):
+        return {tool:{k:v for k,v in s.items() if k!='running'} for tool,s in self.stats.items()}
+
+    def summary(self,title=None):
+        rows=[f"{'tool':<16} {'calls':>7} {'failed':>7} {'timeout':>7} {'cancel':>7} {'wall(s)':>9} {'max||':>6}"]
+        for tool,s in sorted(self.stats.items(),key=lambda x: -x[1]['wall']):
+            rows.append(f"{tool:<16} {s['calls']:>7} {s['failed']:>7} {s['timeouts']:>7} {s['cancelled']:>7} {s['wall']:>9.3f} {s['max_running']:>6}")
+        if title:
+            rows.insert(0,title)
+        return "\n".join(rows)
+
+
+# tool=value options from the command line (--tool-limit idat=2 --tool-timeout gcc=60)
+def parse_tool_values(values,cast=int):
+    d=dict()
+    for v in values if values else []:
+        tool,_,x=v.partition("=")
+        if not tool or not x:
+            raise ValueError(f"expected tool=value, got '{v}'")
+        d[tool.strip()]=cast(x)
+    return d
+
+
+_runner=None
+
+# the process-wide runner, so every stage shares the same limits
+def get_runner():
+    global _runner
+    if _runner is None:
+        _runner=ToolRunner()
+    return _runner
+
+def configure_runner(limits=None,timeouts=None):
+    runner=get_runner()
+    runner.limits.update(limits if limits else dict())
+    runner.timeouts.update(timeouts if timeouts else dict())
+    return runner
@@ -0,0 +1,79 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# per-stage instrumentation for the recompilation pipeline
+#  - each stage (get_stubs, make_pcgc_stubs, ...) accumulates wall time, CPU time, call count and input size
+#  - stages run for a given detour function are also kept per function
+#  - one StageStats per target (written next to prd_info.json), merged into one for the whole run
+
+
+class StageStats:
+    def __init__(self,name=None):
+        self.name=name
+        self.stages=dict() # stage => {'calls','wall','cpu','size'} (first-use order)
+        self.functions=dict() # function => stage => same
+        # stages can run in more than one thread (e.g. the types stage next to the function loop)
+        self.lock=threading.Lock()
+
+    def _add(self,table,stage,wall,cpu,size,calls=1):
+        s=table.get(stage,None)
+        if s is None:
+            s=table[stage]={'calls':0,'wall':0.0,'cpu':0.0,'size':0}
+        s['calls']+=calls
+        s['wall']+=wall
+        s['cpu']+=cpu
+        s['size']+=size
+
+    def add(self,stage,wall,cpu,size=0,function=None):
+        with self.lock:
+            self._add(self.stages,stage,wall,cpu,size)
+            if function is not None:
+                self._add(self.functions.setdefault(function,dict()),stage,wall,cpu,size)
+
+    # with stats.stage('get_stubs',len(code),func): ...
+    #  the size can also be filled in afterwards (rec['size']=...) when it's only known once the stage ran
+    @contextmanager
+    def stage(self,stage,size=0,function=None):
+        rec={'size':size}
+        wall=time.perf_counter()
+        cpu=time.process_time()
+        try:
+            yield rec
+        finally:
+            self.add(stage,time.perf_counter()-wall,time.process_time()-cpu,rec['size'],function)
+
+    def merge(self,other):
+        for stage,s in other.stages.items():
+            self._add(self.stages,stage,s['wall'],s['cpu'],s['size'],s['calls'])
+
+    def report(self):
+        return {'name':self.name,'stages':self.stages,'functions':self.functions}
+
+    @classmethod
+    def from_report(cls,report:dict):
+        stats=cls(report.get('name',None))
+        for stage,s in report.get('stages',dict()).items():
+            stats._add(stats.stages,stage,s['wall'],s['cpu'],s['size'],s['calls'])
+        for function,stages in report.get('functions',dict()).items():
+            for stage,s in stages.items():
+                stats._add(stats.functions.setdefault(function,dict()),stage,s['wall'],s['cpu'],s['size'],s['calls'])
+        return stats
+
+    def write(self,path):
+        if not os.path.exists(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+        with open(path,'w') as f:
+            json.dump(self.report(),f,indent=1)
+
+    def summary(self,title=None):
+        total=sum([s['wall'] for s in self.stages.values()])
+        rows=[f"{'stage':<28} {'calls':>7} {'wall(s)':>9} {'cpu(s)':>9} {'wall%':>6} {'size':>12}"]
+        for stage,s in sorted(self.stages.items(),key=lambda x: -x[1]['wall']):
+            pct=100.0*s['wall']/total if total>0 else 0.0
+            rows.append(f"{stage:<28} {s['calls']:>7} {s['wall']:>9.3f} {s['cpu']:>9.3f} {pct:>6.1f} {s['size']:>12}")
+        if title:
+            rows.insert(0,title)
+        return "\n".join(rows)
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+import time
+
+# append-only journal of a multi-target run, one JSON object per line
+#  - every target gets a 'started' record, then 'done' (with the sha256 of each output it wrote) or 'failed'
+#  - the last record of a target wins; a torn last line (crash while writing) is ignored
+#  - with --resume, a target is skipped when its last record is 'done' for the same inputs and
+#    all of its outputs still hash the same
+
+JOURNAL_NAME="prd_journal.jsonl"
+
+
+def file_digest(path:str):
+    h=hashlib.sha256()
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(1<<20),b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class RunJournal:
+    def __init__(self,path:str):
+        self.path=path
+        self.basedir=os.path.dirname(os.path.abspath(path))
+        self.last=dict()
+        if os.path.exists(path):
+            with open(path,'r') as f:
+                for line in f:
+                    try:
+                        rec=json.loads(line)
+                    except ValueError:
+                        continue
+                    self.last[rec['target']]=rec
+
+    def record(self,target:str,status:str,**fields):
+        rec={'time':time.time(),'target':target,'status':status}
+        rec.update(fields)
+        if not os.path.exists(self.basedir):
+            os.makedirs(self.basedir)
+        with open(self.path,'a') as f:
+            f.write(json.dumps(rec)+"\n")
+        self.last[target]=rec
+        return rec
+
+    def started(self,target:str,inputs:str):
+        return self.record(target,'started',inputs=inputs)
+
+    def done(self,target:str,inputs:str,outputs:list):
+        digests={os.path.relpath(os.path.abspath(p),self.basedir):file_digest(p) for p in outputs}
+        return self.record(target,'done',inputs=inputs,outputs=digests)
+
+    def failed(self,target:str,inputs:str,error:str):
+        return self.record(target,'failed',inputs=inputs,error=error)
+
+    def is_complete(self,target:str,inputs:str):
+        # => (complete, reason it isn't)
+        rec=self.last.get(target,None)
+        if rec is None:
+            return False,"not in the journal"
+        if rec['status']!='done':
+            return False,f"last status was '{rec['status']}'"
+        if rec.get('inputs')!=inputs:
+            return False,"inputs changed"
+        for rel,digest in rec.get('outputs',dict()).items():
+            p=os.path.join(self.basedir,rel)
+            if not os.path.exists(p):
+                return False,f"{rel} is missing"
+            if file_digest(p)!=digest:
+                return False,f"{rel} was modified"
+        return True,None
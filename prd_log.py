@@ -0,0 +1,63 @@
+import json
+import logging
+import sys
+
+# leveled logging for the recompilation pipeline
+#  - one logger per pipeline stage, all under the 'prd' root (e.g. 'prd.get_stubs')
+#  - console output keeps the old print() look (message only, on stdout)
+#  - an optional JSON-lines sink gets every record with its stage and level
+#
+# the hot loops check the level once (log.isEnabledFor) before building their messages, and
+# larger values are wrapped in Lazy so they are only formatted when the record is emitted
+
+LOG_ROOT="prd"
+LOG_LEVELS=['DEBUG','INFO','WARNING','ERROR','CRITICAL']
+DEBUG=logging.DEBUG
+
+
+def get_logger(stage:str):
+    return logging.getLogger(f"{LOG_ROOT}.{stage}")
+
+
+class Lazy:
+    # deferred formatting: fn(*args) is only evaluated when the message is rendered
+    __slots__=('fn','args')
+
+    def __init__(self,fn,*args):
+        self.fn=fn
+        self.args=args
+
+    def __str__(self):
+        return str(self.fn(*self.args))
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self,record):
+        entry={
+            'time':record.created,
+            'level':record.levelname,
+            'stage':record.name[len(LOG_ROOT)+1:] if record.name.startswith(LOG_ROOT+".") else record.name,
+            'msg':record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc']=self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def configure_logging(level="INFO",json_path=None):
+    root=logging.getLogger(LOG_ROOT)
+    for h in list(root.handlers):
+        root.removeHandler(h)
+        h.close()
+    root.setLevel(level if isinstance(level,int) else level.upper())
+    root.propagate=False
+
+    console=logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter("%(message)s"))
+    root.addHandler(console)
+
+    if json_path:
+        sink=logging.FileHandler(json_path,mode='a')
+        sink.setFormatter(JsonLinesFormatter())
+        root.addHandler(sink)
+    return root
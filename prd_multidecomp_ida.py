@@ -1,22 +1,35 @@
 import os
-import subprocess
-import IPython
-import argparse
-import tempfile
 import re
 import shutil
 import time
 import random
 import copy
 import pickle
+import hashlib
+import json
+import shlex
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, Future
+from prd_log import get_logger, configure_logging, Lazy, DEBUG as LOG_DEBUG, LOG_LEVELS
+from prd_journal import RunJournal, JOURNAL_NAME
+from prd_instrument import StageStats
+from prd_plan import WorkPlan
+from prd_shards import shard_of, shard_name, parse_shard, SUMMARY_NAME
+from prd_exec import get_runner, configure_runner, parse_tool_values, shell_command, ToolError, TOOLS_NAME
+from prd_ccache import CompileCache
+from prd_split import split_declarations, source_name
+from prd_elf import DetourOffsets, ElfError, DETOUR_OFFSET_DEFAULTS
+from prd_validate import doomed
+from prd_compile import CC_DEFAULT, CFLAGS_DEFAULT, compiler_output, parse_diagnostics, count_errors, definition_lines, function_at
 
 # path to idat binary
+#  resolved when it's needed (not at import), callers can also pass it to IDAWrapper/GenprogDecomp
+IDA_DEFAULT_PATH="~/seclab_ida/ida/idat"
 
-IDA_DEFAULT_PATH=os.environ['HOME']+"/seclab_ida/ida/idat"
-if os.environ['IDA_BASE_DIR']:
-    IDA_PATH=os.environ['IDA_BASE_DIR']+"/idat"
-else:
-    IDA_PATH=IDA_DEFAULT_PATH
+def default_ida_path():
+    if os.environ.get('IDA_BASE_DIR'):
+        return os.environ['IDA_BASE_DIR']+"/idat"
+    return os.path.expanduser(IDA_DEFAULT_PATH)
 
 
 # path to defs.h
@@ -91,6 +104,23 @@ IDA_FUNC_WEAK_LABEL = "// weak"
 TYPEDEF_START = "============================== START =============================="
 TYPEDEF_END = "============================== END =============================="
 
+# per-function results of GenprogDecomp.run, kept in the target's decompdir and reused by later runs
+INCREMENTAL_CACHE = "incremental.pkl"
+INCREMENTAL_CACHE_VERSION = 3
+# per-stage timings/counters, one per target (next to prd_info.json) and one for the run (output directory)
+STATS_NAME = "prd_stats.json"
+PLAN_NAME = "prd_plan.json"
+# decompilations started ahead of the function being cleaned up
+PIPELINE_DEPTH = 4
+# --compile-check: each written target is compiled (not linked) in the background, the result goes in prd_info.json
+COMPILE_CHECK_FLAGS = CFLAGS_DEFAULT+" -c"
+# --pch: the target's headers go through one header, precompiled (.gch) in the background
+#  gcc picks <header>.gch up when the source is compiled with the same flags, and parses the header otherwise
+PCH_HEADER = "prd_pch.h"
+# --split-functions: <target>_recomp.h + <target>_globals.c + one <target>_fn_<function>.c per decompiled function,
+#  next to the (still written) <target>_recomp.c, with prd_include.mk rules to build them as separate objects
+SPLIT_GLOBALS = "_globals.c"
+
 # tags for primitives for replacement
 
 DEBUG=False
@@ -98,6 +128,14 @@ def dprint(*args,**kwargs):
     if DEBUG:
         print(*args,**kwargs)
 
+# per-stage loggers (see prd_log.py); verbosity is set with --log-level
+log_run=get_logger("run")
+log_types=get_logger("types")
+log_data=get_logger("data")
+log_stubs=get_logger("get_stubs")
+log_deps=get_logger("deps")
+log_pcgc=get_logger("pcgc_stubs")
+
 
 def get_primitives():
     basic_types=["float","double","long double","void"]
@@ -201,20 +239,191 @@ def is_function_ptr(line):
             fn_no_params=f"{y.group(1)} {y.group(3)}"
 
     return is_fnptr,rettype,fnptr_name,params,fn_no_params
-        
 
 
-def strip_binary(binary,out=None):
-    import subprocess
+# names that appear as "<name>(" in a prototype line, i.e., what r"\b(<sym>)\s*\(\b" would find
+PROTO_CALL_NAME_RE=re.compile(r"\b((?:\w+::)*\w+)\s*\(\b")
+
+class PrototypeTable:
+    # ordered, duplicate-free table of prototype lines
+    #  - columns keep the original dict-of-lists layout ('prototypes','symbols',...), so index based
+    #    consumers (stub['prototypes'][i], stub['external'][i]) and iteration over the field names still work
+    #  - membership by line and lookup by symbol name are hashed instead of scanning the lists
+    FIELDS=('prototypes','symbols','external','nm_names','is_glibc')
+
+    def __init__(self,lines=None):
+        self.columns={k:list() for k in self.FIELDS}
+        self.line_index=set()
+        self.symbol_index=dict() # name used in a prototype => {line:None} (insertion ordered)
+        self.derived=dict() # lookups built from the table by its users, dropped whenever the table changes
+        for line in lines or []:
+            self.append(line)
+
+    def __getitem__(self,field):
+        return self.columns[field]
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.columns['prototypes'])
+
+    def keys(self):
+        return self.columns.keys()
+
+    def items(self):
+        return self.columns.items()
+
+    def lines(self):
+        return list(self.columns['prototypes'])
+
+    def has_line(self,line):
+        return line in self.line_index
+
+    def _index_line(self,line):
+        for name in PROTO_CALL_NAME_RE.findall(line):
+            parts=name.split("::")
+            for i in range(0,len(parts)):
+                self.symbol_index.setdefault("::".join(parts[i:]),dict())[line]=None
+
+    def _unindex_line(self,line):
+        for name in PROTO_CALL_NAME_RE.findall(line):
+            parts=name.split("::")
+            for i in range(0,len(parts)):
+                x=self.symbol_index.get("::".join(parts[i:]),None)
+                if x is not None:
+                    x.pop(line,None)
+
+    def append(self,line,symbol=None,external=False,nm_name=None,is_glibc=False):
+        if line in self.line_index:
+            return False
+        self.columns['prototypes'].append(line)
+        self.columns['symbols'].append(symbol)
+        self.columns['external'].append(external)
+        self.columns['nm_names'].append(nm_name)
+        self.columns['is_glibc'].append(is_glibc)
+        self.line_index.add(line)
+        self._index_line(line)
+        self.derived.clear()
+        return True
+
+    def extend(self,lines):
+        for line in lines:
+            self.append(line)
+
+    def remove(self,line):
+        idx=self.columns['prototypes'].index(line)
+        for k in self.FIELDS:
+            del self.columns[k][idx]
+        self.line_index.discard(line)
+        self._unindex_line(line)
+        self.derived.clear()
+
+    def find_symbol(self,sym_name):
+        # lines (in insertion order) where sym_name is used like a function name, i.e., "<sym_name>("
+        return list(self.symbol_index.get(sym_name,dict()).keys())
+
+    # plain (picklable) form of the table, one tuple per line in FIELDS order
+    #  (from row start on)
+    def rows(self,start=0):
+        return list(zip(*[self.columns[k][start:] for k in self.FIELDS]))
+
+    @classmethod
+    def from_rows(cls,rows):
+        table=cls()
+        for row in rows:
+            table.append(*row)
+        return table
+
+
+# C++ => C names in the generated output, the same rewrites the pipeline always made (the generated names have to
+#  keep matching existing Makefiles and detour symbols), with precompiled regexes and skipped when nothing can match
+#   cpp_scope   A::B => A__B                                   decompiled code, basic.c, detour names
+#   cpp_std     A::B => A___B, A::$B => A___B (2 passes)       the whole target (transform_std)
+#   cpp_strip   no _thiscall/_cppobj, A::B => A___B, T<X*> => T_X_p_, T<X> => T_X_   with --strip (transform_cpp)
+#   cpp_types   A::B => A__B, T<X*> => T_X_p_, T<X> => T_X_     recovered types (cpp_to_c)
+#   cpp_header  A::$B => A__E__B, A::B => A__B                  the resolved types header (--use-new-features)
+CPP_STD_RE=re.compile(r"(\S+)::\$?([_\S]+)")
+CPP_THISCALL_RE=re.compile(r"\b_thiscall\b")
+CPP_CPPOBJ_RE=re.compile(r"\b_cppobj\b")
+CPP_QUALIFIED_RE=re.compile(r"(\S+)::(\S+)")
+CPP_TEMPLATE_PTR_RE=re.compile(r"(\S+)<(\S+)\*>")
+CPP_TEMPLATE_RE=re.compile(r"(\S+)<(\S+)>")
+TYPE_TEMPLATE_PTR_RE=re.compile(r"<(\w+)\*>")
+TYPE_TEMPLATE_RE=re.compile(r"<(\w+)>")
+
+
+def cpp_scope(text):
+    return text.replace("::","__")
+
+
+def cpp_header(text):
+    return cpp_scope(text.replace("::$","__E__"))
+
+
+def cpp_std(text):
+    if "::" not in text:
+        return text
+    return CPP_STD_RE.sub(r"\1___\2",CPP_STD_RE.sub(r"\1___\2",text))
+
+
+def cpp_strip(text):
+    if "_thiscall" in text:
+        text=CPP_THISCALL_RE.sub("",text)
+    if "_cppobj" in text:
+        text=CPP_CPPOBJ_RE.sub("",text)
+    if "::" in text:
+        text=CPP_QUALIFIED_RE.sub(r"\1___\2",text)
+    if "<" in text:
+        text=CPP_TEMPLATE_RE.sub(r"\1_\2_",CPP_TEMPLATE_PTR_RE.sub(r"\1_\2_p_",text))
+    return text
+
+
+def cpp_types(line):
+    line=cpp_scope(line)
+    if "<" in line:
+        line=TYPE_TEMPLATE_RE.sub(r"_\1_",TYPE_TEMPLATE_PTR_RE.sub(r"_\1_p_",line))
+    return line
+
+
+class TranslationUnit:
+    # a generated C file kept as an ordered list of section chunks instead of one growing string
+    #  transforms are applied chunk by chunk, so the whole file is never copied while cleaning it up,
+    #  and it is written out with a single writelines
+    def __init__(self):
+        self.chunks=[]
+
+    def add(self,text:str):
+        self.chunks.append(text)
+        return len(self.chunks)-1
+
+    def add_section(self,lines:list):
+        # same text as "\n".join(lines)+"\n"
+        return self.add("".join([l+"\n" for l in lines]))
+
+    def transform(self,fn,start=0,end=None):
+        for i in range(start,len(self.chunks) if end is None else end):
+            self.chunks[i]=fn(self.chunks[i])
+
+    def __len__(self):
+        return sum([len(c) for c in self.chunks])
+
+    def write(self,path):
+        with open(path,"w") as f:
+            f.writelines(self.chunks)
+
+
+def strip_binary(binary,out=None,runner=None):
     b_out=out
     if not out:
         b_out=f"{binary}.strip"
-    x=subprocess.run(f"cp {binary} {b_out}",shell=True)
-    if x.returncode!=0:
+    try:
+        shutil.copy(binary,b_out)
+    except OSError:
         print(f"[WARNING!] Failed to create {b_out} from binary source.\nSkipping stripping of symbols")
         b_out=binary
     else:
-        x=subprocess.run(f"/usr/bin/strip --strip-all {b_out}",shell=True)
+        x=(runner if runner else get_runner()).run('strip',["/usr/bin/strip","--strip-all",b_out])
         if x.returncode!=0:
             print(f"[WARNING!] Failed to strip symbols from {b_out}!")
             print(f"Reverting to original binary")
@@ -223,12 +432,28 @@ def strip_binary(binary,out=None):
 
 
 class IDAWrapper:
-    def __init__(self, typedefScriptPath):
+    def __init__(self, typedefScriptPath, ida_path=None, runner=None):
         self.typedefScriptPath = typedefScriptPath
+        self.ida_path = ida_path if ida_path else default_ida_path()
+        self.runner = runner if runner else get_runner()
+        # output file => idat job started by prefetch_*, picked up by decompile_func/get_typedef_mappings
+        self.pending = dict()
+
+    def decompile_command(self, binary_path, func:str):
+        outname = "/tmp/"+func.strip()+f"{int(random.getrandbits(16))}"
+        return outname,[self.ida_path, "-Ohexrays:-nosave:"+outname+":"+func, "-A", binary_path]
+
+    # start decompiling func in the background (if it isn't already in decompdir)
+    def prefetch_func(self, binary_path, func:str, decompdir:str):
+        decompf=f"{decompdir}/{func.strip()}.c"
+        if decompf in self.pending or (os.path.exists(decompf) and os.stat(decompf).st_size>0):
+            return
+        outname,ida_command = self.decompile_command(binary_path, func)
+        print("Prefetching: ", " ".join(ida_command),flush=True)
+        self.pending[decompf]=(outname,ida_command,self.runner.submit('idat',ida_command))
 
     # get initial decompiled output of ida hexrays
     def decompile_func(self, binary_path, func:str, decompdir:str):
-        outname = "/tmp/"+func.strip()+f"{int(random.getrandbits(16))}"
         decompf=f"{decompdir}/{func.strip()}.c"
         #for func_name in func_list:
         #    funcs += func_name.strip() + ":"
@@ -236,10 +461,15 @@ class IDAWrapper:
 
         # ida run command
         functionLines = ""
-        if not os.path.exists(decompf) or (os.stat(decompf).st_size==0):
-            ida_command = [IDA_PATH, "-Ohexrays:-nosave:"+outname+":"+func, "-A", binary_path]
-            print("Running: ", " ".join(ida_command),flush=True)
-            subprocess.run(ida_command)
+        pending = self.pending.pop(decompf,None)
+        if pending is not None or not os.path.exists(decompf) or (os.stat(decompf).st_size==0):
+            if pending is None:
+                outname,ida_command = self.decompile_command(binary_path, func)
+                print("Running: ", " ".join(ida_command),flush=True)
+                self.runner.run('idat',ida_command)
+            else:
+                outname,ida_command,job = pending
+                job.result()
             
     
             if not os.path.exists(outname+".c"):
@@ -272,9 +502,9 @@ class IDAWrapper:
         funcs = funcs[:-1] #trim dangling ':'
 
         # ida run command
-        ida_command = [IDA_PATH, "-Ohexrays:-nosave:"+outname+":"+funcs, "-A", binary_path]
+        ida_command = [self.ida_path, "-Ohexrays:-nosave:"+outname+":"+funcs, "-A", binary_path]
         print("Running: ", " ".join(ida_command))
-        subprocess.run(ida_command)
+        self.runner.run('idat',ida_command)
 
         functionLines = ""
         if not os.path.exists(outname+".c"):
@@ -288,6 +518,23 @@ class IDAWrapper:
 
         return functionLines
 
+    # start the type dump in the background (if typedefs.h isn't already in output)
+    def prefetch_typedefs(self, binary_path, output):
+        typedef_f=f"{output}/typedefs.h"
+        if typedef_f in self.pending or (os.path.exists(typedef_f) and os.stat(typedef_f).st_size>0):
+            return
+        ida_command,env = self.typedef_command(binary_path, typedef_f)
+        print("Prefetching: ", " ".join(ida_command),flush=True)
+        self.pending[typedef_f]=self.runner.submit('idat',ida_command,env=env)
+
+    def typedef_command(self, binary_path, typedef_f):
+        ida_command = [self.ida_path, '-B', '-S'+"\""+self.typedefScriptPath+"\"", "-A", binary_path]
+        # getting rid of tempfile since I'm saving the original typedef info to a file anyway
+        open(typedef_f,"w").close()
+        env = dict(os.environ)
+        env['IDALOG'] = os.path.realpath(typedef_f)
+        return ida_command,env
+
     # # given a decompiled ida string, find all func calls in that string
 
     # get all typedef mappings
@@ -295,18 +542,13 @@ class IDAWrapper:
         typedefMap = dict()
         typedef_f=f"{output}/typedefs.h"
         typedefs=None
-        if not os.path.exists(typedef_f) or (os.stat(typedef_f).st_size==0):
-            ida_command = [IDA_PATH, '-B', '-S'+"\""+self.typedefScriptPath+"\"", "-A", binary_path]
-            tmpName = ""
-            # getting rid of tempfile since I'm saving the original typedef info to a file anyway
-            #with tempfile.NamedTemporaryFile(mode="r", dir="/tmp", prefix="prd-ida-",delete=True) as tmpFile:
-            with open(typedef_f,"w") as tmpFile:
-                print("RUNNING: ", " ".join(ida_command),flush=True)
-                env = os.environ
-                env['IDALOG'] = os.path.realpath(typedef_f)
-                sp = subprocess.run(ida_command, env=env)
-
-                tmpFile.close()
+        pending = self.pending.pop(typedef_f,None)
+        if pending is not None:
+            pending.result()
+        elif not os.path.exists(typedef_f) or (os.stat(typedef_f).st_size==0):
+            ida_command,env = self.typedef_command(binary_path, typedef_f)
+            print("RUNNING: ", " ".join(ida_command),flush=True)
+            self.runner.run('idat',ida_command,env=env)
         
         
         with open(typedef_f,"r") as tmpFile:
@@ -334,7 +576,9 @@ class IDAWrapper:
 
 class CodeCleaner:
     def __init__(self):
-        self.weakFuncs = []
+        self.weakFuncs = set()
+        # stub line => (header, ret_type, label, argTypes), shared by every make_pcgc_stubs/generate_wrapper call
+        self.parsedPrototypes = dict()
 
     def getTypeAndLabel(self, header, fn_ptr=False):
         array,hType,hLabel=(None,None,None)
@@ -1532,10 +1776,7 @@ class CodeCleaner:
         
     # ehhh, should be similar to def transform_cpp
     def cpp_to_c(self,line):
-        line=re.sub(r'::','__',line)
-        line=re.sub(r'<(\w+)\*>',r'_\1_p_',line)
-        line=re.sub(r'<(\w+)>',r'_\1_',line)
-        return line
+        return cpp_types(line)
         
     def aggregate_sets(self,x_init,known,lookup):
         x_=x_init
@@ -1559,7 +1800,7 @@ class CodeCleaner:
         dprint(f"DEBUG: x_requires[{x}] = {lx_requires_x}")
         if len(lx_requires_x)==0 or (len(lx_requires_x)==1 and lx_requires_x[0]==x):
             valid=set([x])
-            print(f"DEBUG: RULE 1: {x} is valid => {lx_requires_x}")
+            log_types.debug("DEBUG: RULE 1: %s is valid => %s",x,lx_requires_x)
         return valid
     
     def rule_two(self,x,x_requires:dict,uses_x:dict,resolved:set,fnptr_types:list):
@@ -1572,14 +1813,18 @@ class CodeCleaner:
         #uses_union=self.fully_resolve_aggregates(x_reqs,resolved,uses_x)|uses_x_x
 
         valid_=None
-        print(f"DEBUG: CHECKING RULE 2: {x}  [{x_reqs}] is valid [{req_union <= uses_union}] => {req_union} ({uses_union})")
+        # the sets can be large, so they're only rendered if someone is listening
+        debug=log_types.isEnabledFor(LOG_DEBUG)
+        if debug:
+            log_types.debug("DEBUG: CHECKING RULE 2: %s  [%s] is valid [%s] => %s (%s)",x,x_reqs,req_union <= uses_union,req_union,uses_union)
         if req_union <= uses_union:
             valid_=req_union
             if x in fnptr_types:
                 valid_.add(x)
-            print(f"DEBUG: RULE 2: {x} is valid [{valid_}] => {req_union} ({uses_union})")
-        else:
-            print(f"DEBUG: RULE 2: {x} failed REQUIRE_UNION:{req_union}  is not a subset of USES_UNION:{uses_union}")
+            if debug:
+                log_types.debug("DEBUG: RULE 2: %s is valid [%s] => %s (%s)",x,valid_,req_union,uses_union)
+        elif debug:
+            log_types.debug("DEBUG: RULE 2: %s failed REQUIRE_UNION:%s  is not a subset of USES_UNION:%s",x,req_union,uses_union)
         return valid_
 
     def process_rules_for_x(self,x:str,x_requires:dict,uses_x:dict,resolved:set,orig_x_requires:dict,fnptr_types:list):
@@ -1691,6 +1936,9 @@ class CodeCleaner:
                     funcBody = ""
             else:
                 funcBody += line + "\n"
+        # the text can also end with the function (a chunk holding one function)
+        if inFunc:
+            funcList.append(funcBody)
 
         return funcList
 
@@ -1849,7 +2097,7 @@ class CodeCleaner:
                 if ";" in line:
                     capture=False
 
-        print("GLOBAL DATA LINES : \n["+"\n".join(global_dataLines_)+"\n]\n")
+        log_data.debug("GLOBAL DATA LINES : \n[%s\n]\n",Lazy("\n".join,global_dataLines_))
         gdataMap, ldataMap_ = self.process_datalines(dataLines,data_syms,gdataMap)
 
         return gdataMap, removeList, ldataMap_, global_dataLines_
@@ -1858,9 +2106,11 @@ class CodeCleaner:
         line = ""
         new_syms, ext_syms = (set(),set())
         ldataMap_ = {'prototypes':dict(),'sym2proto':dict(),'ext_vars':set(),'local_vars':set()} 
-        print("[RUNNING] process_datalines",flush=True)
+        debug=log_data.isEnabledFor(LOG_DEBUG)
+        log_data.info("[RUNNING] process_datalines")
         for dataLine in dataLines:
-            print(dataLine)
+            if debug:
+                log_data.debug(dataLine)
             if "Elf" in dataLine:
                 # removeList.append(dataLine+"\n")
                 continue
@@ -1880,18 +2130,21 @@ class CodeCleaner:
 
             if base_dataName not in data_syms:
                 new_syms.add(base_dataName)
-                print("{} [NOT A DATA SYMBOL]".format(base_dataName))
+                if debug:
+                    log_data.debug("%s [NOT A DATA SYMBOL]",base_dataName)
                 line = ""
                 continue
             else:
-                print("{} [DATA SYMBOL]".format(base_dataName))
+                if debug:
+                    log_data.debug("%s [DATA SYMBOL]",base_dataName)
                 ext_syms.add(base_dataName)
                 
             array_size=get_array_size(dataName)
-            print("Array Size:", array_size)
+            if debug:
+                log_data.debug("Array Size: %s",array_size)
             defLine=""
             if array_size>=2:
-                print(f"// --- WARNING! Two-dimensional array objects are not yet supported => {dataName}")
+                log_data.warning("// --- WARNING! Two-dimensional array objects are not yet supported => %s",dataName)
                 defLine += "%s *(p%s);\n" %(dataType, dataName)
                 dataName = dataName.split("[")[0] # handle arrays
                 defLine += "#define %s (*p%s)\n" % (dataName, dataName)
@@ -1907,10 +2160,12 @@ class CodeCleaner:
 
             if line.startswith("//"):
                 defLine += "//"
-            print("    ---->", defLine)
+            if debug:
+                log_data.debug("    ----> %s",defLine)
             x=gdataMap.get(line,None)
             if not x:
-                print("    New global variable : ", defLine)
+                if debug:
+                    log_data.debug("    New global variable :  %s",defLine)
                 gdataMap[line] = defLine
             ldataMap_['prototypes'][line] = defLine
             ldataMap_['sym2proto'][base_dataName] = line
@@ -1919,7 +2174,7 @@ class CodeCleaner:
         #      gdataMap [global] ; ldataMap_ [per fn]
         ldataMap_['ext_vars']=ext_syms
         ldataMap_['local_vars']=new_syms
-        print("[COMPLETED] process_datalines",flush=True)
+        log_data.info("[COMPLETED] process_datalines")
         return gdataMap, ldataMap_
 
 
@@ -1966,7 +2221,7 @@ class CodeCleaner:
         for i in fn_list:
             j=stubs_per_func[i]
             if not isinstance(j,dict):
-                print(f"Warning: Function {i} does not have symbols or names from nm")
+                log_deps.warning("Warning: Function %s does not have symbols or names from nm",i)
             else:
                 nms=j['nm_names']
                 syms=j['symbols']
@@ -1999,6 +2254,7 @@ class CodeCleaner:
         local_syms=dict()
         resolved_local_syms=dict()
         resolved_fn=dict()
+        debug=log_deps.isEnabledFor(LOG_DEBUG)
         for f in sorted(unresolved):
             stub=stubs_per_func[f]
             dm=dataMap_per_func[f]
@@ -2009,14 +2265,12 @@ class CodeCleaner:
             ext_syms[f]=set([stub['nm_names'][i] for i in range(0,len(stub['prototypes'])) if stub['external'][i] ])
             local_syms[f]=set([stub['nm_names'][i] for i in range(0,len(stub['prototypes'])) if not stub['external'][i] ])
             resolved_local_syms[f]=set()
-            print(f"{f}: 'ext_varprotos:{sorted(ext_varprotos[f])}'")
-            print(f"{f}: 'ext_vars:{sorted(ext_vars[f])}'")
-            print(f"{f}: 'ext_protos:{sorted(ext_protos[f])}'")
-            print(f"{f}: 'ext_syms:{sorted(ext_syms[f])}'")
-            print(f"{f}: 'ext_dsyms:{sorted(ext_dsyms[f])}'")
-            print(f"{f}: 'local_syms:{sorted(local_syms[f])}'")
+            if debug:
+                for k,v in [('ext_varprotos',ext_varprotos),('ext_vars',ext_vars),('ext_protos',ext_protos),
+                            ('ext_syms',ext_syms),('ext_dsyms',ext_dsyms),('local_syms',local_syms)]:
+                    log_deps.debug("%s: '%s:%s'",f,k,sorted(v[f]))
             resolved_fn[f]=set()
-        print(f"UNRESOLVED = {unresolved}")
+        log_deps.debug("UNRESOLVED = %s",unresolved)
         #fn=random.choice(list(unresolved)) if "main" not in unresolved else "main"
         rslv=sorted(unresolved)
         for fn in rslv:
@@ -2032,23 +2286,21 @@ class CodeCleaner:
                     ext_dsyms[fn] = ext_dsyms[fn] | ext_dsyms[l]
                     ext_syms[fn] = ext_syms[fn] | ext_syms[l]
                 except Exception as e:
-                    print(f"fn={fn}, l={l}")
-                    print(e)
+                    log_deps.error("fn=%s, l=%s",fn,l)
+                    log_deps.error(e)
                     raise(e)
             unresolved.remove(fn)
             resolved.add(fn)
-            print(f"[DONE] -- {f} -- resolved external symbol dependencies")
-        for rf in sorted(resolved):
-            print("RESOLVED:")
-            print(f"{rf}: 'ext_varprotos:{sorted(ext_varprotos[rf])}'")
-            print(f"{rf}: 'ext_vars:{sorted(ext_vars[rf])}'")
-            print(f"{rf}: 'ext_protos:{sorted(ext_protos[rf])}'")
-            print(f"{rf}: 'ext_syms:{sorted(ext_syms[rf])}'")
-            print(f"{rf}: 'ext_dsyms:{sorted(ext_dsyms[rf])}'")
-            print(f"{rf}: 'resolved_local_syms:{sorted(resolved_local_syms[rf])}'")
-            
-            
-        print("Resolved dependencies on external symbols:")
+            if debug:
+                log_deps.debug("[DONE] -- %s -- resolved external symbol dependencies",fn)
+        if debug:
+            for rf in sorted(resolved):
+                log_deps.debug("RESOLVED:")
+                for k,v in [('ext_varprotos',ext_varprotos),('ext_vars',ext_vars),('ext_protos',ext_protos),
+                            ('ext_syms',ext_syms),('ext_dsyms',ext_dsyms),('resolved_local_syms',resolved_local_syms)]:
+                    log_deps.debug("%s: '%s:%s'",rf,k,sorted(v[rf]))
+
+        log_deps.info("Resolved dependencies on external symbols")
         resolved_fn_syms=dict()
         resolved_var_syms=dict()
         for f in fn_list:
@@ -2093,51 +2345,61 @@ class CodeCleaner:
         lstubs = {'prototypes':list(),'symbols':list(),'external':list(),'nm_names':list(),'is_glibc':list()}
         lfuncs = {'prototypes':list(),'symbols':list(),'external':list(),'nm_names':list(),'is_glibc':list()}
         global_fns = []
-        guessed_fn=[x[1] for x in guessed_protos]
-        guessed_pr=[x[2] for x in guessed_protos]
+        guessed=dict()
+        for x in guessed_protos:
+            guessed.setdefault(x[1],x[2])
         weaker_conflicts = []
         
         lines_=lines.splitlines()
         fn_start=-1
         fulldecomp=lines_
-        print("[RUNNING] get_stubs",flush=True)
+        debug=log_stubs.isEnabledFor(LOG_DEBUG)
+        log_stubs.info("[RUNNING] get_stubs")
         for idx,line in enumerate(lines_):
             if IDA_STUB_START in line:
                 isFunc = False
                 instubs = True
-                print("[get_stubs] [{}][{}] {}".format(instubs,isFunc,line),flush=True)
+                if debug:
+                    log_stubs.debug("[get_stubs] [%s][%s] %s",instubs,isFunc,line)
                 continue
             elif IDA_SECTION_END in line:
                 if IDA_DECOMP_START in line and fn_start==-1:
                     fn_start=idx
                 instubs = False
                 isFunc = True
-                print("[get_stubs] [{}][{}] {}".format(instubs,isFunc,line),flush=True)
+                if debug:
+                    log_stubs.debug("[get_stubs] [%s][%s] %s",instubs,isFunc,line)
                 continue
             
             line = line.strip()
-            print("[get_stubs] line : {}".format(line),flush=True)
+            if debug:
+                log_stubs.debug("[get_stubs] line : %s",line)
             if instubs and len(line.strip()) > 0:
                 # if the stub isn't a decompiled function
                 # this looks like the right solution, but has problematic corner cases
                 #decomp=decomp_re.search(line.split('(',1)[0].rsplit('\s',1)[-1])
                 preparse_line=line.rsplit('=',1)[0].rsplit('(',1)[0]
-                print("[get_stubs] preparse_line: {}".format(preparse_line),flush=True)
+                if debug:
+                    log_stubs.debug("[get_stubs] preparse_line: %s",preparse_line)
                 while preparse_line.count('(') != preparse_line.count(')'):
                     x=preparse_line.rsplit('(',1)[0]
-                    print("[get_stubs] preparse_line: {} => {}".format(preparse_line,x),flush=True)
+                    if debug:
+                        log_stubs.debug("[get_stubs] preparse_line: %s => %s",preparse_line,x)
                     preparse_line=x
                     
-                print("[get_stubs] [done] preparse_line: {}".format(preparse_line),flush=True)
+                if debug:
+                    log_stubs.debug("[get_stubs] [done] preparse_line: %s",preparse_line)
                 sym_type, sym_name=self.getTypeAndLabel(preparse_line)
                 #print(f"[get_stubs] [done] type : {sym_type}, label : {sym_name}",flush=True)
                 nm_sym_name=sym_name
                 found_glibc=False
                 if sym_name in data_symbols:
-                    print("Found a data symbol! '{}'".format(sym_name))
+                    if debug:
+                        log_stubs.debug("Found a data symbol! '%s'",sym_name)
                     
                 elif sym_name in glibc_symbols:
-                    print("Found a glibc symbol! '{}'".format(sym_name))
+                    if debug:
+                        log_stubs.debug("Found a glibc symbol! '%s'",sym_name)
                     found_glibc=True
                     # the following doesn't work if the equivalent variable function isn't an available symbol in binary
                     #if sym_name in list(VALIST_TRANSFORM.keys()):
@@ -2148,12 +2410,14 @@ class CodeCleaner:
                     if line.lstrip().startswith("//"):
                         line = line.lstrip()[2:]
                 elif sym_name not in fn_symbols:
-                    print("Function declaration symbol name '{}' doesn't exist in symbol list!".format(sym_name))
-                    print("line => {}".format(line))
-                    print("Checking to see if it's an inlined alias, which is usually <fn>_\d+")
+                    if debug:
+                        log_stubs.debug("Function declaration symbol name '%s' doesn't exist in symbol list!",sym_name)
+                        log_stubs.debug("line => %s",line)
+                        log_stubs.debug("Checking to see if it's an inlined alias, which is usually <fn>_\\d+")
                     new_sym=re.sub(r'^(\w+)(_\d+)$',r'\1',sym_name)
                     alt_sym="_"+sym_name
-                    print(f"NEW SYM: {new_sym}\tALT SYM: {alt_sym}")
+                    if debug:
+                        log_stubs.debug("NEW SYM: %s\tALT SYM: %s",new_sym,alt_sym)
                     # hex-rays either gets rid of prepended _ character or appends _\d+ for inlined functions
                     if  sym_name == "patchmain":
                         translate_dict[sym_name]="main"
@@ -2165,17 +2429,18 @@ class CodeCleaner:
                         translate_dict[sym_name]=new_sym
                         nm_sym_name=new_sym
                     elif alt_sym in fn_symbols:
-                        print("We're good! Decompiler stripped prepended '_' character")
+                        if debug:
+                            log_stubs.debug("We're good! Decompiler stripped prepended '_' character")
                         translate_dict[sym_name]=alt_sym
                         translate_dict[alt_sym]=sym_name
                         nm_sym_name=alt_sym
                         
                     else:
-                        print("Error: can't resolve symbol '{}'".format(sym_name))
-                        print("Skipping line")
+                        log_stubs.warning("Error: can't resolve symbol '%s'. Skipping line",sym_name)
                         continue
                 decomp=decomp_re.search(sym_name)
-                print("decomp_re : "+str(decomp_re)+f" => {decomp}")                    
+                if debug:
+                    log_stubs.debug("decomp_re : %s => %s",decomp_re,decomp)
                         
                 lstubs['symbols'].append(sym_name)
                 
@@ -2183,21 +2448,23 @@ class CodeCleaner:
                 lstubs['is_glibc'].append(found_glibc)
                 skip_prototype=False
                 if decomp:
-                    print("FOUND DECOMPILED FUNCTION  '{}' : {}".format(decomp.group(0),line))
+                    if debug:
+                        log_stubs.debug("FOUND DECOMPILED FUNCTION  '%s' : %s",decomp.group(0),line)
                     lstubs['external'].append(False)
-                    if decomp.group(0) in guessed_fn:
-                        indx=guessed_fn.index(decomp.group(0))
-                        guess_proto=guessed_pr[indx]
+                    if decomp.group(0) in guessed:
+                        guess_proto=guessed[decomp.group(0)]
                         xline=line.rsplit(';',1)[0].strip()
                         gproto=guess_proto.rsplit(';',1)[0].strip()
-                        print(f"GUESSED PROTOTYPE: {gproto} vs LINE : {xline}")
+                        if debug:
+                            log_stubs.debug("GUESSED PROTOTYPE: %s vs LINE : %s",gproto,xline)
                         if xline==gproto:
-                            print(f"a guessed prototype is in the decompiled function list")
-                            print(f"ignoring the guess and using the concrete decompiled function prototype")
+                            log_stubs.info("a guessed prototype is in the decompiled function list, "+
+                                "ignoring the guess and using the concrete decompiled function prototype")
                             skip_prototype=True
 
                 else:
-                    print("FOUND EXTERNAL FUNCTION  '{}' : {}".format(sym_name,line))
+                    if debug:
+                        log_stubs.debug("FOUND EXTERNAL FUNCTION  '%s' : %s",sym_name,line)
                     lstubs['external'].append(True)
 
                 if skip_prototype:
@@ -2205,29 +2472,25 @@ class CodeCleaner:
                 else:
                     lstubs['prototypes'].append(line)
                     
-                if line not in stubs['prototypes'] and not decomp:
-                    stubs['symbols'].append(sym_name)
-                    stubs['prototypes'].append(line)
-                    stubs['external'].append(True)
-                    stubs['nm_names'].append(nm_sym_name)
-                    stubs['is_glibc'].append(found_glibc)
-                elif line not in stubs['prototypes'] and decomp and line not in global_decomp and not skip_prototype:
-                    print(f"global function [{sym_name}] => {line}")
-                    print(f"global decomp => {global_decomp}")
-                    print(f"stubs[prototypes] => {stubs['prototypes']}")
+                if not stubs.has_line(line) and not decomp:
+                    stubs.append(line,sym_name,True,nm_sym_name,found_glibc)
+                elif not stubs.has_line(line) and decomp and not global_decomp.has_line(line) and not skip_prototype:
+                    if debug:
+                        log_stubs.debug("global function [%s] => %s",sym_name,line)
+                        log_stubs.debug("global decomp => %s",global_decomp.lines())
+                        log_stubs.debug("stubs[prototypes] => %s",stubs['prototypes'])
                     dont_push=False
-                    for gindex,proto_ in enumerate(prev_global):
-                        print(f"DEBUG [{sym_name}]: '{proto_}'")
-                        if re.search(r"\b("+sym_name+r")\s*\(\b",proto_):
-                            print(f"CONFLICT in Decompiled prototypes for {sym_name} [previous => {proto_}")
-                            if proto_.strip().endswith("// idb"):
-                                print(f"Need to remove previous declaration: {proto_}")
-                                print(f"and use current declaration: {line}")
-                                weaker_conflicts.append(proto_)
-                            else:
-                                print(f"Can't use current declaration: {line}")
-                                print(f"Need to use previous declaration: {proto_}")
-                                dont_push=True
+                    # only the previous prototypes that use sym_name as a function name can conflict
+                    for proto_ in prev_global.find_symbol(sym_name):
+                        log_stubs.info("CONFLICT in Decompiled prototypes for %s [previous => %s",sym_name,proto_)
+                        if proto_.strip().endswith("// idb"):
+                            log_stubs.info("Need to remove previous declaration: %s",proto_)
+                            log_stubs.info("and use current declaration: %s",line)
+                            weaker_conflicts.append(proto_)
+                        else:
+                            log_stubs.info("Can't use current declaration: %s",line)
+                            log_stubs.info("Need to use previous declaration: %s",proto_)
+                            dont_push=True
                     if not dont_push:
                         global_fns.append(line)
                 else:
@@ -2252,18 +2515,14 @@ class CodeCleaner:
                 lfuncs['external'].append(False)
                 lfuncs['nm_names'].append(nm_sym_name)
                 lfuncs['is_glibc'].append(found_glibc)
-                if line not in funcs['prototypes']:
-                    funcs['prototypes'].append(line)
-                    funcs['symbols'].append(sym_name)
-                    funcs['external'].append(False)
-                    funcs['nm_names'].append(nm_sym_name)
-                    funcs['is_glibc'].append(found_glibc)
+                if not funcs.has_line(line):
+                    funcs.append(line,sym_name,False,nm_sym_name,found_glibc)
                 else:
                     continue
 
         #sections=(lines_[stub_idxs[0]]:stub_idxs[1]], lines_[stub_idxs[1]]:stub_idxs[-1]] )
         #stubs, funcHeaders, header_decls, s, f = cleaner.get_stubs(decomp_code,stubs,funcHeaders,header_decls)
-        print("[COMPLETED] get_stubs",flush=True)
+        log_stubs.info("[COMPLETED] get_stubs")
                                          # s
         return stubs, funcs, fulldecomp, lstubs, lfuncs, fn_start, global_fns,translate_dict, weaker_conflicts
 
@@ -2302,41 +2561,22 @@ class CodeCleaner:
         return dataLines,funcstubLines,funcdefLines
 
     def get_stub_name(self, stubLine):
-        header = stubLine.split("(", maxsplit=1)[0]
-        if header.startswith("//"):
-            header = header[3:]
-        stubType, name = self.getTypeAndLabel(header)
-        return name
-
-    # given list of stubs, create stubs
-    def make_pcgc_stubs(self, stublines, funcs, glibc_symbols):
-        stubMap = {}
-        stdio_collision = []
-        print(f"Stubline prototypes: {','.join(x for x in stublines['prototypes'])}");
-        for stub in stublines['prototypes']:
-            skip = False
-            for funcline in funcs:
-                if funcline in stub:
-                    skip = True # skip functions that are already declared below
-                    print(funcline, " in " , stub)
-                    break
-            if skip:
-                # print("Skipping ", stub)
-                continue
-
-            print("Processing stub ", stub)
-            array = stub.split("(", maxsplit=1)
-            header = array[0]
-            if IDA_WEAK_LABEL in stub:
-                self.weakFuncs.append(stub)
-                print(f"WEAK FUNCTION: {stub}")
+        return self.parse_prototype(stubLine)[2]
+
+    # split a prototype line into (header, ret_type, label, argTypes)
+    #  the result only depends on the line, so it is memoized for the lifetime of the cleaner
+    def parse_prototype(self, stub):
+        parsed = self.parsedPrototypes.get(stub,None)
+        if parsed is not None:
+            return parsed
+        array = stub.split("(", maxsplit=1)
+        header = array[0]
+        argTypes = []
+        if len(array) > 1:
             # handle comments
             args = array[1].split(";", maxsplit=1)[0][:-1] #strip ) and ;
 
             argsList = self.split_func_args(args) # args.split(",")
-            argTypes = []
-
-            # print("arglist", argsList)
 
             count = 0
             for arg in argsList:
@@ -2353,19 +2593,65 @@ class CodeCleaner:
                     else:
                         argName = argTuple[1]
 
-                    print("    - ", argType, "||", argName)
+                    log_pcgc.debug("    -  %s || %s",argType,argName)
                     argTypes.append(argType)
 
+        if header.startswith("//"):
+            header = header[3:] # handle commented out cases
+
+        ret_type, label = self.getTypeAndLabel(header)
+        parsed = (header, ret_type, label, argTypes)
+        self.parsedPrototypes[stub] = parsed
+        return parsed
+
+    # label => function definition lines, for the 'already declared below' check in make_pcgc_stubs
+    #  lines without a parameter list can't be keyed reliably, so they're kept under None
+    def declared_function_index(self, funcs):
+        declared = funcs.derived.get('declared',None) if isinstance(funcs,PrototypeTable) else None
+        if declared is None:
+            declared = dict()
+            for funcline in funcs['prototypes']:
+                label = self.parse_prototype(funcline)[2] if "(" in funcline else None
+                declared.setdefault(label,list()).append(funcline)
+            if isinstance(funcs,PrototypeTable):
+                funcs.derived['declared'] = declared
+        return declared
+
+    # given list of stubs, create stubs
+    #  stublines and funcs are PrototypeTable (or the same dict-of-lists layout)
+    def make_pcgc_stubs(self, stublines, funcs, glibc_symbols):
+        stubMap = {}
+        stdio_collision = []
+        declared = self.declared_function_index(funcs)
+        debug=log_pcgc.isEnabledFor(LOG_DEBUG)
+        if debug:
+            log_pcgc.debug("Stubline prototypes: %s",",".join(stublines['prototypes']))
+        for stub in stublines['prototypes']:
+            header, ret_type, label, argTypes = self.parse_prototype(stub)
+            skip = False
+            # a function line can only be contained in a stub with the same label
+            for funcline in declared.get(label,[])+declared.get(None,[]):
+                if funcline in stub:
+                    skip = True # skip functions that are already declared below
+                    if debug:
+                        log_pcgc.debug("%s  in  %s",funcline,stub)
+                    break
+            if skip:
+                # print("Skipping ", stub)
+                continue
+
+            if debug:
+                log_pcgc.debug("Processing stub  %s",stub)
+            if IDA_WEAK_LABEL in stub:
+                self.weakFuncs.add(stub)
+                if debug:
+                    log_pcgc.debug("WEAK FUNCTION: %s",stub)
 
-            if header.startswith("//"):
-                header = header[3:] # handle commented out cases
-            
-            ret_type, label = self.getTypeAndLabel(header)
-            
             is_glibc=label in glibc_symbols if glibc_symbols else False
 
-            print(f"MAKE_PCGC_STUBS: STUB => '{stub}' [{label} is a GLIBC: {is_glibc}]")
-            print("    - RET [%s] LABEL [%s] ARGTYPES[%s] IS_GLIBC[%s]" % (ret_type, label, argTypes, is_glibc))
+            if debug:
+                log_pcgc.debug("MAKE_PCGC_STUBS: STUB => '%s' [%s is a GLIBC: %s]",stub,label,is_glibc)
+                log_pcgc.debug("    - RET [%s] LABEL [%s] ARGTYPES[%s] IS_GLIBC[%s]",ret_type,label,argTypes,is_glibc)
             valist_start=""
             valist_end=""
             
@@ -2491,25 +2777,10 @@ class CodeCleaner:
         return output
 
     def transform_std(self,decomp):
-        d=re.sub(r"(\S+)::\$?([_\S]+)",r"\1___\2",decomp)
-        d=re.sub(r"(\S+)::\$?([_\S]+)",r"\1___\2",d)
-        return d
+        return cpp_std(decomp)
 
     def transform_cpp(self,decomp):
-        # s/_cppobj //g
-        d=re.sub(r"\b_thiscall\b",r"",decomp)
-        d=re.sub(r"\b_cppobj\b",r"",d)
-        # s/(\w+)<(\w+)>/${1}_${2}_/g
-        d=re.sub(r"(\S+)::(\S+)",r"\1___\2",d)
-        # s/(\w+)<(\w+)*>/${1}_${2}_p_/g
-        print(f"transforming : (\S+)<(\S+)\*> to \\1_\\2_p_")
-        d=re.sub(r"(\S+)<(\S+)\*>",r"\1_\2_p_",d)
-        # s/(\w+)::(\w+)/${1}___${2}/g
-        print(f"transforming : (\S+)<(\S+)> to \\1_\\2_")
-        d=re.sub(r"(\S+)<(\S+)>",r"\1_\2_",d)
-        # let's get rid of ::$[0-9a-fA-F]
-
-        return d
+        return cpp_strip(decomp)
 
 
        
@@ -2828,8 +3099,34 @@ class Formatter:
 
 class GenprogDecomp:
 
-    def __init__(self, target_list_path, scriptpath, ouput_directory,entryfn_prefix,r2ghidra=None,strip=False,decompdir="/tmp/decomp",use_new_features=False):
+    def __init__(self, target_list_path, scriptpath, ouput_directory,entryfn_prefix,r2ghidra=None,strip=False,decompdir="/tmp/decomp",use_new_features=False,resume=False,ida_path=None,shard=None,pipeline_depth=PIPELINE_DEPTH,compile_check=None,pch=None,split_functions=False,validate=True,incremental=True):
         self.use_new_features=use_new_features
+        # reuse the results of the functions unchanged since the last run (INCREMENTAL_CACHE in the decomp directory)
+        self.incremental=incremental
+        # compiler flags of the background compile check, None => no check
+        self.compile_check=shlex.split(compile_check) if isinstance(compile_check,str) else compile_check
+        # structural checks first (prd_validate.py), a target they find errors in isn't compiled
+        self.validate=validate
+        self.compile_cache=None
+        # detour entry offsets of the original binaries (prd_elf.py), created when first needed
+        self.detour_offsets=None
+        self.compile_results=dict()
+        # compiler flags of the precompiled headers, None => no precompiled header
+        self.pch=shlex.split(pch) if isinstance(pch,str) else pch
+        self.pch_jobs=dict() # target => Future of the .gch build
+        self.split_functions=split_functions
+        # 0 => no overlap, every stage runs when its result is needed
+        self.pipeline_depth=pipeline_depth
+        self.types_pool=None
+        # (i, N): only the targets whose binary hashes to shard i of N
+        self.shard=shard
+        self.other_shards=0
+        self.ida_path=ida_path
+        self.resume=resume
+        self.targets=list()
+        self.target_failures=list()
+        self.plan=None
+        self.runner=get_runner()
         self.target_list_path = target_list_path
         self.scriptpath = scriptpath
         self.ouput_directory = ouput_directory
@@ -2842,12 +3139,82 @@ class GenprogDecomp:
         print(f"Target File = {self.target_list_path}",flush=True)
         self.strip=strip
 
+    # run() state that is threaded from one detour function to the next, in this order
+    FUNCTION_STATE=('dataMap','dataRemoveList','data_decls','stubs','funcHeaders','decomp_decls','header_decls',
+        'translate_dict','guessed_protos','stubs_per_func','funcHeaders_per_func','decomp_per_func','dataMap_per_func')
+
+    # each function's results depend on the functions processed before it, so its cache key chains
+    #  the previous function's key with its own inputs
+    def function_cache_key(self,prev_key,*inputs):
+        h=hashlib.sha1(str(prev_key).encode())
+        for i in inputs:
+            h.update(b"\0"+repr(i).encode())
+        return h.hexdigest()
+
+    # sizes of the state before a function is processed
+    def function_state_sizes(self,state:tuple):
+        return tuple(len(v) for v in state)
+
+    # what one function changed in the state => {name: change}, only that is cached for the function
+    #  the other changes are recorded where the function makes them (edits: {name: change}), the lists, tables and
+    #  dataMap it only appends to => their entries past sizes; deep copied, so the state can keep changing in place
+    def function_state_delta(self,sizes:tuple,state:tuple,edits:dict):
+        delta=dict()
+        for k,n,v in zip(self.FUNCTION_STATE,sizes,state):
+            if k in edits:
+                delta[k]=edits[k]
+            elif len(v)<=n:
+                continue
+            elif isinstance(v,PrototypeTable):
+                delta[k]=('extend',v.rows(n),[])
+            elif isinstance(v,dict):
+                delta[k]=('update',dict(reversed(list(islice(reversed(v.items()),len(v)-n)))),[])
+            else:
+                delta[k]=('extend',v[n:])
+        return copy.deepcopy(delta)
+
+    # replays a cached function's delta on the state => the state after that function
+    def apply_function_state_delta(self,state:tuple,delta:dict):
+        state=list(state)
+        for i,k in enumerate(self.FUNCTION_STATE):
+            if k not in delta:
+                continue
+            d=copy.deepcopy(delta[k])
+            v=state[i]
+            if isinstance(v,PrototypeTable):
+                for line in d[2]:
+                    v.remove(line)
+                for row in d[1]:
+                    v.append(*row)
+            elif isinstance(v,list):
+                if d[0]=='extend':
+                    v.extend(d[1])
+                else:
+                    v[:]=d[1]
+            elif isinstance(v,dict):
+                v.update(d[1])
+                for x in d[2]:
+                    v.pop(x,None)
+            else:
+                v|=d[1]
+                v-=set(d[2])
+        return tuple(state)
+
+    def load_function_cache(self,decompdir:str):
+        cachef=os.path.join(decompdir,INCREMENTAL_CACHE)
+        if os.path.exists(cachef):
+            try:
+                return readpickle(cachef)
+            except Exception as e:
+                log_run.warning("Ignoring unreadable %s (%s)",cachef,e)
+        return dict()
+
     def get_decompilations(self,symlist,binp):
         syms=" ".join(symlist)
         cmd=self.r2ghidra_cmd
         cmd=re.sub("<SYM>",syms,cmd)
         cmd=re.sub("<BIN>",binp,cmd)
-        d=subprocess.check_output(cmd,shell=True)
+        d=self.runner.run('r2ghidra',shell_command(cmd),check=True).stdout
         decomp=d.decode('ascii').rstrip()
         return decomp
 
@@ -2858,7 +3225,7 @@ class GenprogDecomp:
             cmd=self.r2ghidra_cmd
             cmd=re.sub("<SYM>",symbol,cmd)
             cmd=re.sub("<BIN>",binp,cmd)
-            d=subprocess.check_output(cmd,shell=True)
+            d=self.runner.run('r2ghidra',shell_command(cmd),check=True).stdout
             decomp=d.decode('ascii').rstrip()
             with open(decompf, "w") as decompFile:
                 decompFile.write(decomp)
@@ -2885,16 +3252,10 @@ class GenprogDecomp:
         else:
             cmd=["/usr/bin/nm","-D",binary_path]
             #cmd=["/usr/bin/nm","--demangle",binary_path]
-            symproc=subprocess.Popen(" ".join(cmd),stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=True)
-            #ret=symproc.poll()
-            #if ret == None:
-            #    ret=symproc.poll()
-            #    print("Error running '{}' {} ".format(" ".join(cmd),ret))
-            #    return None
-            sout,serr = symproc.communicate()
-            output=sout.decode('ISO-8859-1')
+            output=self.runner.run('nm',cmd).text()
             lines=output.split('\n')
             symbol_dict = dict()
+            syms=list()
             count=0;MAX=len(lines)
             for x in lines:
                 if (count==len(lines) or (count%int(MAX/min(10,MAX)))==0):
@@ -2907,17 +3268,21 @@ class GenprogDecomp:
                 symtype=x[9:10]
                 full_symname=x[11:len(x)]
                 if x[8]!=" ":
-                    print("ERROR!! Looks like a 64b binary\nExiting.")
-                    import sys;sys.exit(-1)
+                    print("ERROR!! Looks like a 64b binary")
+                    raise ValueError(f"{binary_path} looks like a 64b binary")
                 symname=full_symname
                 is_glibc="GLIBC" in symname
                 if is_glibc:
                     symname=x[11:len(x)].split('@',1)[0]
+                syms.append((symadd,symtype,symname,is_glibc))
+            # one c++filt for all the symbols (one name per line in, one per line out)
+            demangled_=self.runner.run('c++filt',["/usr/bin/c++filt"],check=True,
+                input="".join([f"{x[2]}\n" for x in syms]).encode()).stdout.decode('ascii').split('\n')
+            for (symadd,symtype,symname,is_glibc),demangled in zip(syms,demangled_):
                 ltype=symbol_dict.get(symtype,None)
                 if not ltype:
                     symbol_dict[symtype]=list()
-                cmd=["/usr/bin/c++filt",symname]
-                demangled = subprocess.check_output(" ".join(cmd),shell=True).decode('ascii').rstrip()
+                demangled = demangled.rstrip()
                 clean=demangled.split('(',1)[0]
                 symbol_dict[symtype].append({'name':clean,'fullname':demangled,'mangled':symname,'address':symadd,'type':symtype,'is_glibc':is_glibc})
                 if not self.mang2demLUT:
@@ -2935,42 +3300,314 @@ class GenprogDecomp:
 
     def get_target_info(self,workdir):
         self.targets=list()
+        # targets that can't be set up are reported by run() instead of stopping the whole run
+        self.target_failures=list()
         with open(self.target_list_path, "r") as targetFile:
             for line in targetFile:
                 if len(line)<=0:
                     continue
                 else:
                     print(line,flush=True)
-                finalOutput = ""
-                dataMap=dict()
 
-                target, path, funcs = line.rstrip().split(",")
-                target = target.strip()
-                path = path.strip()
-                symbols_lut = self.get_symbols(path,os.path.join(workdir,target))
-                #print(f" => {','.join(self.mang2demLUT.keys())}",flush=True)
-                funcs_=re.sub("::","_____",funcs)
-                funcs_=re.sub(":"," ",funcs_)
-                funcs=re.sub("_____","::",funcs_)
-                # we're now assuming that we're getting mangled symbols as input
-                funcList_ = funcs.split(" ")
-                print(f"FUNCLIST='{funcList_}'",flush=True)
-                funcList=list()
-                for i in funcList_:
-                    print(f"{i} ",flush=True)
-                    if self.mang2demLUT and self.mang2demLUT.get(i,None) is not None:
-                        print(f" => {self.mang2demLUT[i]}",flush=True)
-                        funcList.append(i)
-                    else:
-                        print(f"ERROR: {i} does not exist as a local symbol. SKipping.")
-                if len(funcList)==0:
-                    print(f"Nothing to do. Exiting.")
-                    import sys;sys.exit(-1);
-                detour_funcs= [ (self.mang2demLUT[f],f) for f in funcList ]
-                x={'target':target,'path':path,'funcList':funcList,'detour_funcs':detour_funcs,'symbols_lut':symbols_lut}
-                self.targets.append(x)
+                try:
+                    target, path, funcs = line.rstrip().split(",")
+                except ValueError:
+                    # reported once, by the first shard
+                    if self.shard is None or self.shard[0]==0:
+                        print(f"ERROR: malformed target line '{line.rstrip()}'. Skipping.")
+                        self.target_failures.append((line.rstrip(), None, "malformed target line"))
+                    continue
+                if self.shard is not None and shard_of(path,self.shard[1])!=self.shard[0]:
+                    self.other_shards+=1
+                    continue
+                self.add_target(target.strip(),path.strip(),funcs,workdir)
         targetFile.close()
 
+    # one target (a line of the target list), appended to self.targets
+    #  => the target's info, or None when it was recorded in self.target_failures instead
+    def add_target(self,target,path,funcs,workdir):
+        stats=StageStats(target)
+        try:
+            with stats.stage("get_symbols") as st:
+                symbols_lut = self.get_symbols(path,os.path.join(workdir,target))
+                st['size']=sum([len(v) for v in symbols_lut.values()]) if symbols_lut else 0
+        except Exception as e:
+            print(f"ERROR: can't get the symbols of {target} ({e}). Skipping.")
+            self.target_failures.append((target, path, f"{type(e).__name__}: {e}"))
+            return None
+        #print(f" => {','.join(self.mang2demLUT.keys())}",flush=True)
+        funcs_=re.sub("::","_____",funcs)
+        funcs_=re.sub(":"," ",funcs_)
+        funcs=re.sub("_____","::",funcs_)
+        # we're now assuming that we're getting mangled symbols as input
+        funcList_ = funcs.split(" ")
+        print(f"FUNCLIST='{funcList_}'",flush=True)
+        funcList=list()
+        for i in funcList_:
+            print(f"{i} ",flush=True)
+            if self.mang2demLUT and self.mang2demLUT.get(i,None) is not None:
+                print(f" => {self.mang2demLUT[i]}",flush=True)
+                funcList.append(i)
+            else:
+                print(f"ERROR: {i} does not exist as a local symbol. SKipping.")
+        if len(funcList)==0:
+            print(f"Nothing to do for {target}. Skipping.")
+            self.target_failures.append((target, path, "none of the functions are local symbols"))
+            return None
+        detour_funcs= [ (self.mang2demLUT[f],f) for f in funcList ]
+        x={'target':target,'path':path,'funcList':funcList,'detour_funcs':detour_funcs,'symbols_lut':symbols_lut,'stats':stats}
+        self.targets.append(x)
+        return x
+
+    # what a target's outputs are generated from, a journal entry is only reused (--resume) if this matches
+    def target_inputs(self,TARG):
+        binstat=None
+        if os.path.exists(TARG['path']):
+            st=os.stat(TARG['path'])
+            binstat=[st.st_size,st.st_mtime_ns]
+        return hashlib.sha1(json.dumps([TARG['path'],binstat,TARG['funcList'],self.use_new_features,self.strip,
+            self.detour_entry_fn_prefix,self.r2ghidra_cmd]+([self.compile_check] if self.compile_check else [])+
+            (['no-validate'] if self.compile_check and not self.validate else [])+
+            ([['pch']+self.pch] if self.pch else [])+(['split'] if self.split_functions else [])).encode()).hexdigest()
+
+    # result of a job of the run's WorkPlan (shared by the targets on the same binary), or fn() without a plan
+    def planned(self,kind,TARG,arg,decompdir,fn):
+        if self.plan is None:
+            return fn()
+        return self.plan.run(kind,TARG,arg,decompdir,fn)
+
+    # start the idat jobs a target runs itself (see WorkPlan) in the background, so they overlap with
+    #  the processing of the target(s) before it
+    #  at most pipeline_depth functions (from start on) are decompiled ahead, the type dump only with start=0
+    def prefetch(self,TARG,idaw,start=0):
+        if self.strip or self.pipeline_depth<=0:
+            # decompilation uses the stripped copy, made by run_target
+            return
+        decompdir=os.path.join(self.decompdir,TARG['target'])
+        if not os.path.exists(decompdir):
+            os.makedirs(decompdir)
+        if start==0 and (self.plan is None or self.plan.runs('typedefs',TARG,None)):
+            idaw.prefetch_typedefs(TARG['path'],decompdir)
+        for funcsym in TARG['funcList'][start:start+self.pipeline_depth]:
+            if self.plan is None or self.plan.runs('decompile',TARG,funcsym):
+                idaw.prefetch_func(TARG['path'],funcsym,decompdir)
+
+    # type dump + type resolution of a target => (typedefLines, types_used, needs_stdio)
+    def types_stage(self,TARG,idaw,cleaner,nostripbin,decompdir,stats):
+        print("    --- Getting typedef mappings...",flush=True)
+        with stats.stage("get_typedef_mappings") as st:
+            structDump = self.planned('typedefs',TARG,None,decompdir,
+                lambda: idaw.get_typedef_mappings(nostripbin,decompdir,self.use_new_features))
+            st['size']=len(structDump)
+        # print(structDump)
+        with stats.stage("remove_artifacts",len(structDump)):
+            typedefLines = cleaner.remove_artifacts(structDump,self.use_new_features)
+        types_used=None
+        needs_stdio=False
+        if self.use_new_features:
+            with stats.stage("resolve_type_order",len(typedefLines)):
+                typedefLines,types_used,needs_stdio = self.planned('resolve_types',TARG,None,decompdir,
+                    lambda: cleaner.resolve_type_order(typedefLines,decompdir))
+        else:
+            with stats.stage("cleanup_typedefs",len(typedefLines)):
+                typedefLines = self.planned('cleanup_typedefs',TARG,None,decompdir,
+                    lambda: cleaner.cleanup_typedefs(typedefLines))
+        return typedefLines,types_used,needs_stdio
+
+    # the types stage runs in its own thread, next to the decompile/clean-up loop of run_target
+    #  (nothing in that loop needs the types), => a Future of its result
+    def start_types_stage(self,TARG,idaw,cleaner,nostripbin,decompdir,stats):
+        if self.pipeline_depth<=0:
+            job=Future()
+            job.set_result(self.types_stage(TARG,idaw,cleaner,nostripbin,decompdir,stats))
+            return job
+        if self.types_pool is None:
+            self.types_pool=ThreadPoolExecutor(max_workers=1,thread_name_prefix="prd-types")
+        return self.types_pool.submit(self.types_stage,TARG,idaw,cleaner,nostripbin,decompdir,stats)
+
+    # compiles a written target in the background (through the compile cache, the object stays in the decomp directory)
+    #  => Future of the ToolResult
+    def start_compile_check(self,TARG):
+        target=TARG['target']
+        if self.compile_cache is None:
+            self.compile_cache=CompileCache()
+        source=os.path.join(self.ouput_directory,target,target+"_recomp.c")
+        obj=os.path.join(self.decompdir,target,target+"_check.o")
+        r=doomed(source) if self.validate else None
+        if r is not None:
+            # the report (and the r2ghidra retry) go by the validator's errors
+            job=Future()
+            job.set_result(r)
+            return job
+        return self.compile_cache.submit(self.runner,CC_DEFAULT,source,self.compile_check,obj,after=self.pch_jobs.get(target,None))
+
+    # precompiles the target's header set in the background => Future of the ToolResult
+    def start_pch(self,TARG):
+        hdr=os.path.join(self.ouput_directory,TARG['target'],PCH_HEADER)
+        self.pch_jobs[TARG['target']]=self.runner.submit('cc',[CC_DEFAULT]+self.pch+["-x","c-header",hdr,"-o",hdr+".gch"])
+        return self.pch_jobs[TARG['target']]
+
+    # prd_include.mk is included by the target's Makefile, its rules mustn't become that Makefile's default goal
+    def makefile_rules(self,rules:list):
+        return ["PRD_DEFAULT_GOAL := $(.DEFAULT_GOAL)"]+rules+[".DEFAULT_GOAL := $(PRD_DEFAULT_GOAL)"]
+
+    def pch_makefile_rules(self,headers:list):
+        return "\n".join(["",
+            f"# precompiled header set ({PCH_HEADER} includes {' and '.join(headers)}), gcc only uses $(PCH) when",
+            "#  the target is compiled with the flags it was built with",
+            f"PCH_HDR := {PCH_HEADER}",
+            "PCH := $(PCH_HDR).gch",
+            "PCH_DEPS := "+" ".join(headers),
+            "PCH_CC ?= $(CC)",
+            "PCH_CFLAGS ?= "+" ".join(self.pch)]+self.makefile_rules([
+            "$(PCH): $(PCH_HDR) $(PCH_DEPS)",
+            "\t$(PCH_CC) $(PCH_CFLAGS) -x c-header $(PCH_HDR) -o $@"])+[""])
+
+    def split_makefile_rules(self,header:str,sources:list,headers:list):
+        return "\n".join(["",
+            "# one object per decompiled function (--split-functions), make -j builds them in parallel and",
+            "#  only the sources that changed are rebuilt",
+            f"SPLIT_HDR := {header}",
+            "SPLIT_SRCS := "+" ".join(sources),
+            "SPLIT_OBJS := $(SPLIT_SRCS:.c=.o)",
+            "SPLIT_DEPS := $(SPLIT_HDR) "+" ".join(headers+(["$(PCH)"] if self.pch else [])),
+            "SPLIT_CC ?= $(CC)",
+            "SPLIT_CFLAGS ?= "+" ".join(self.pch if self.pch else shlex.split(CFLAGS_DEFAULT))]+self.makefile_rules([
+            "$(SPLIT_OBJS): %.o: %.c $(SPLIT_DEPS)",
+            "\t$(SPLIT_CC) $(SPLIT_CFLAGS) -c $< -o $@",
+            "split-objs: $(SPLIT_OBJS)",
+            ".PHONY: split-objs"])+[""])
+
+    # --split-functions: the written translation unit as a shared header, the globals and one source per function
+    #  => (header, [sources])
+    def write_split_functions(self,target,recomp,func_chunks:dict,includes:str,outdir):
+        in_function=set([i for a,b in func_chunks.values() for i in range(a,b)])
+        # chunk 0 is the includes, the header has them
+        decls,defs=split_declarations("".join([c for i,c in enumerate(recomp.chunks) if i>0 and i not in in_function]))
+        header=target+"_recomp.h"
+        guard="PRD_"+re.sub(r"\W","_",target).upper()+"_RECOMP_H"
+        # every source includes the header set itself, a precompiled header is only used by the source's first #include
+        includes+=f"#include \"{header}\"\n\n"
+        files={header:f"// Auto-generated declarations shared by the sources of target [{target}]\n"+
+                   f"#ifndef {guard}\n#define {guard}\n{decls}\n#endif\n",
+            target+SPLIT_GLOBALS:f"{includes}// Auto-generated globals of target [{target}]\n{defs}"}
+        for f,(a,b) in func_chunks.items():
+            files[source_name(target,f)]=includes+"".join(recomp.chunks[a:b])
+        for name,text in files.items():
+            with open(os.path.join(outdir,name),'w') as fh:
+                fh.write(text)
+        return header,[n for n in files.keys() if n!=header]
+
+    # => number of precompiled headers built, the failed ones are removed (the sources still compile without them)
+    def collect_pch(self):
+        built=0
+        for target,job in self.pch_jobs.items():
+            r=job.result()
+            if r.ok:
+                built+=1
+                continue
+            err=(r.stderr or b"").decode('utf-8',errors='replace').strip().splitlines()
+            log_run.warning("%s: precompiled header not built (%s)",target,err[-1] if err else f"exit {r.returncode}")
+            gch=os.path.join(self.ouput_directory,target,PCH_HEADER+".gch")
+            if os.path.exists(gch):
+                os.remove(gch)
+        return built
+
+    def compile_report(self,TARG,r):
+        target=TARG['target']
+        source=os.path.join(self.ouput_directory,target,target+"_recomp.c")
+        diags=parse_diagnostics(compiler_output(r))
+        defs=definition_lines(source) if os.path.exists(source) else []
+        funcs=TARG.get('check_functions',dict())
+        failing=set()
+        for d in diags:
+            d['function']=None
+            if os.path.basename(d['file'])==os.path.basename(source):
+                d['function']=function_at(defs,d['line'])
+                if d['severity'] in ('error','fatal error') and d['function'] in funcs:
+                    failing.add(funcs[d['function']])
+        return {'ok':r.ok,'returncode':r.returncode,'timed_out':r.timed_out,'cached':getattr(r,'cached',None),
+            'cmd':" ".join(r.cmd),'time':r.wall,'errors':count_errors(diags),
+            'warnings':len([d for d in diags if d['severity']=='warning']),
+            'failing_functions':[f for f in TARG['funcList'] if f in failing],'diagnostics':diags}
+
+    # records the compile check in prd_info.json, a target that doesn't compile is done again with the functions
+    #  the errors are in decompiled by r2ghidra (if --r2ghidra is set), and kept if that has fewer errors
+    #  => the target's outputs
+    def finish_compile_check(self,TARG,outputs,job,idaw,cleaner,success,failure):
+        target=TARG['target']
+        report=self.compile_report(TARG,job.result())
+        if not report['ok'] and self.r2ghidra_cmd and len(report['failing_functions'])>0:
+            funcs=report['failing_functions']
+            print(f"    --- {target} doesn't compile ({report['errors']} errors), retrying {funcs} with r2ghidra",flush=True)
+            retry={'functions':funcs,'errors':None,'kept':False}
+            # the retry rewrites the outputs and the incremental cache, both are put back if it's discarded
+            cachef=os.path.join(self.decompdir,target,INCREMENTAL_CACHE)
+            backup=dict()
+            for p in outputs+[cachef]:
+                if os.path.exists(p):
+                    with open(p,'rb') as f:
+                        backup[p]=f.read()
+            retry_success,retry_failure=[],[]
+            retry_report=None
+            TARG['r2ghidra_retry']=set(funcs)
+            try:
+                retry_outputs=self.run_target(TARG,idaw,cleaner,retry_success,retry_failure)
+                if retry_outputs is not None:
+                    retry_report=self.compile_report(TARG,self.start_compile_check(TARG).result())
+            except Exception as e:
+                log_run.exception("%s: r2ghidra retry failed",target)
+                retry['error']=f"{type(e).__name__}: {e}"
+            finally:
+                del TARG['r2ghidra_retry']
+            if retry_report is not None:
+                retry['errors']=retry_report['errors']
+            if retry_report is not None and (retry_report['ok'] or retry_report['errors']<report['errors']):
+                retry['kept']=True
+                retry['first_errors']=report['errors']
+                report=retry_report
+                outputs=retry_outputs
+                success[:]=[x for x in success if x[0]!=target]+retry_success
+                failure[:]=[x for x in failure if x[0]!=target]+retry_failure
+            else:
+                for p,data in backup.items():
+                    with open(p,'wb') as f:
+                        f.write(data)
+                if cachef not in backup and os.path.exists(cachef):
+                    os.remove(cachef)
+            report['retry']=retry
+            print(f"    --- {target}: r2ghidra retry {'kept' if retry['kept'] else 'discarded'} ({retry['errors']} errors)",flush=True)
+        json_outpath=os.path.join(self.ouput_directory,target,"prd_info.json")
+        with open(json_outpath,'r') as f:
+            info=json.load(f)
+        info['compile_check']=report
+        with open(json_outpath,'w') as f:
+            json.dump(info,f)
+        self.compile_results[target]={'ok':report['ok'],'errors':report['errors'],'retried':'retry' in report,
+            'kept':report.get('retry',dict()).get('kept',False)}
+        return outputs
+
+    # targets whose compile check is done (all of them with wait) are finished and journaled => the pending ones
+    #  their binary's plan results were kept for the r2ghidra retry, their timings include it
+    def collect_compile_checks(self,checks,idaw,cleaner,success,failure,journal,run_stats,wait=False):
+        pending=[]
+        for TARG,outputs,job in checks:
+            if not wait and not job.done():
+                pending.append((TARG,outputs,job))
+                continue
+            try:
+                outputs=self.finish_compile_check(TARG,outputs,job,idaw,cleaner,success,failure)
+            except Exception as e:
+                log_run.exception("%s: compile check failed",TARG['target'])
+                self.compile_results[TARG['target']]={'ok':False,'errors':None,'retried':False,'kept':False,
+                    'error':f"{type(e).__name__}: {e}"}
+            finally:
+                self.plan.done(TARG)
+                TARG['stats'].write(os.path.join(self.ouput_directory,TARG['target'],STATS_NAME))
+                run_stats.merge(TARG['stats'])
+            journal.done(TARG['target'],TARG['inputs'],outputs)
+        return pending
+
     def find_symbol(self,demangled:str):
         search_re=re.compile(r"\b"+f"{demangled}"+r"\b")
         for dm in self.dem2mangLUT.keys():
@@ -2979,409 +3616,617 @@ class GenprogDecomp:
         return None
 
     def run(self):
-        idaw = IDAWrapper(self.scriptpath)
+        idaw = IDAWrapper(self.scriptpath,self.ida_path,self.runner)
         cleaner = CodeCleaner()
         functions = []
         success = []
         failure = []
         decomp_failure_count=0
+        target_failure_count=0
+        resumed=[]
+        journal=RunJournal(os.path.join(self.ouput_directory,JOURNAL_NAME))
+        run_stats=StageStats("run")
+        for target,path,reason in self.target_failures:
+            journal.failed(target,None,reason)
+            failure.append((target, path, reason))
+            target_failure_count+=1
+        todo=[]
         for TARG in self.targets:
             target=TARG['target']
-            path=TARG['path']
-            funcList=TARG['funcList']
-            detour_funcs=[x[0][0] for x in TARG['detour_funcs']]
-            detour_fullfuncs=[x[0][1] for x in TARG['detour_funcs']]
-            detour_syms=[x[1] for x in TARG['detour_funcs']]
-            symbols_lut = TARG['symbols_lut']
-            binpath=path
-            nostripbin=binpath
-            decompile_error_count=0
-            if self.strip:
-               binpath=strip_binary(path) 
-
-            outdir = os.path.join(self.ouput_directory, target)
-            decompdir = os.path.join(self.decompdir, target)
-            if not os.path.exists(outdir):
-                os.makedirs(outdir)
-            if not os.path.exists(decompdir):
-                os.makedirs(decompdir)
-
-            finalOutput = ""
-            dataMap=dict()
-            detfncs=detour_funcs+[x[1:] for x in detour_funcs if x.startswith('_') ]
-            detours_regex="|".join(detfncs)
-
-            while len(detours_regex)>0 and detours_regex[-1]=='|':
-                detours_regex=detours_regex[0:-1]
-            detours_re=re.compile(r"\b("+detours_regex+r")\b")
-            mainFunc = funcList[0].strip()
-
-            print("="*100,flush=True)
-            print("Decompile and Recompiling: %s in target %s" %(str([x for x in detour_funcs]), target),flush=True)
-            print("="*100,flush=True)
-
-            print("    --- Getting typedef mappings...",flush=True)
-            structDump = idaw.get_typedef_mappings(nostripbin,decompdir,self.use_new_features)
-            # print(structDump)
-            typedefLines = cleaner.remove_artifacts(structDump,self.use_new_features)
-            needs_stdio=False
-            typehdr="resolved-types.h"
-            if self.use_new_features:
-                stdio_types=CHDR_TYPES
-                typedefLines,types_used,needs_stdio = cleaner.resolve_type_order(typedefLines,decompdir)
-
-            else:
-                typedefLines = cleaner.cleanup_typedefs(typedefLines)
-                finalOutput += typedefLines
-
-            print("    --- Decompiling target functions...",flush=True)
-            data_symbols = [ x['name'] for s in ['d','D','b','B'] if (symbols_lut.get(s,None) != None) for x in symbols_lut[s] ]
-            fn_symbols = [ x['name'] for s in ['t','T','U','w','W'] if (symbols_lut.get(s,None) != None) for x in symbols_lut[s] ]
-            glibc_symbols = [ x['name'] for s in ['t','T','U','w','W'] if (symbols_lut.get(s,None) != None) for x in symbols_lut[s] if x['is_glibc'] and (x['name'] not in CSTDIO_DATASYMS)]
-            ext_symbols = [ x['name'] for s in ['U'] if (symbols_lut.get(s,None) != None) for x in symbols_lut[s] ]
-            finalOutput += cleaner.generate_det_placeholders()
-
-            fulldecomp_code=""
-            stubs={'prototypes':list(),'symbols':list(),'external':list(),'nm_names':list(),'is_glibc':list()}
-            funcHeaders={'prototypes':list(),'symbols':list(),'external':list(),'nm_names':list(),'is_glibc':list()}
-            decls=[[],[],[],[],[],[]]
-            header_decls=decls[0]
-            func_decls=decls[1]
-            data_decls=decls[2]
-            decomp_decls=decls[3]
-            decomp_defs=decls[4]
-            stubs_per_func=dict()
-            funcHeaders_per_func=dict()
-            decomp_per_func=dict()
-            dataMap_per_func=dict()
-            translate_dict=dict()
-            fn_info=dict()
-            data_decls.append("\n//"+"-"*68)
-            data_decls.append(IDA_DATA_START+"\n")
-            func_decls.append("\n//"+"-"*68)
-            func_decls.append(IDA_STUB_START+"\n")
-            decomp_defs.append("\n//"+"-"*68)
-            decomp_defs.append("// Decompiled Functions\n")
-            sym_requirements=dict()
-            dataRemoveList=list()
-
-            #decompFH=open("/tmp/decomp_raw.c","w")
-            guessed_protos=set()
-            for idx,funcsym in enumerate(funcList):
-                func=funcsym
-                if self.mang2demLUT:
-                    func=self.mang2demLUT[funcsym][0]
-                print(f"Processing Function: {func} [symbol = '{funcsym}']")
-                decomp_code = idaw.decompile_func(binpath, funcsym,decompdir)
-                decomp_code = re.sub(r"\bmain\b","patchmain",decomp_code)
-                if func not in fn_symbols:
-                    print(f"{func} not in {fn_symbols}")
-                    print("invalid function symbol, skipping...")
-                    failure.append((target, binpath, funcsym))
-                    continue
-                print(f"STUBS_PER_FUNC[ID] : ID={detour_funcs[idx]}")
-                stubs_per_func[detour_funcs[idx]]=dict()
-                funcHeaders_per_func[detour_funcs[idx]]=dict()
-                if len(decomp_code) <= 0:
-                    print("decompilation error, skipping...")
-                    decompile_error_count+=1;failure.append((target, binpath, funcsym))
+            TARG['inputs']=self.target_inputs(TARG)
+            if self.resume:
+                complete,reason=journal.is_complete(target,TARG['inputs'])
+                if complete:
+                    print(f"Skipping {target}, already recompiled by a previous run (outputs verified)",flush=True)
+                    success.append((target, TARG['path'], TARG['funcList']))
+                    resumed.append(target)
                     continue
+                print(f"Recompiling {target}: {reason}",flush=True)
+            todo.append(TARG)
+        # typedef and decompile jobs are run once per binary / (binary, function), whichever target needs them first
+        self.plan=WorkPlan(todo,self.strip)
+        print(self.plan.summary(),flush=True)
+        # targets being compiled in the background (--compile-check), journaled once their check is recorded
+        checks=[]
+        for k,TARG in enumerate(todo):
+            target=TARG['target']
+            inputs=TARG['inputs']
+            checks=self.collect_compile_checks(checks,idaw,cleaner,success,failure,journal,run_stats)
+            for T in todo[k:k+2]:
+                self.prefetch(T,idaw)
+            journal.started(target,inputs)
+            # a failing target is recorded and the run moves on to the next one
+            outputs=None
+            try:
+                outputs=self.run_target(TARG,idaw,cleaner,success,failure)
+            except Exception as e:
+                log_run.exception("%s: recompilation failed",target)
+                failure.append((target, TARG['path'], f"{type(e).__name__}: {e}"))
+                journal.failed(target,inputs,f"{type(e).__name__}: {e}")
+                target_failure_count+=1
+                continue
+            finally:
+                # a target being compile checked is done once its check is collected (see collect_compile_checks)
+                checked=self.compile_check and outputs is not None
+                if not checked:
+                    self.plan.done(TARG)
+                # timings go next to prd_info.json, whatever happened to the target
+                if 'stats' in TARG:
+                    TARG['stats'].write(os.path.join(self.ouput_directory,target,STATS_NAME))
+                    if not checked:
+                        run_stats.merge(TARG['stats'])
+            if outputs is None:
+                decomp_failure_count+=1
+                journal.failed(target,inputs,"none of the functions could be decompiled")
+                continue
+            if self.compile_check:
+                checks.append((TARG,outputs,self.start_compile_check(TARG)))
+                continue
+            journal.done(target,inputs,outputs)
+        self.collect_compile_checks(checks,idaw,cleaner,success,failure,journal,run_stats,wait=True)
+        pch_built=self.collect_pch()
 
+        print(" ALL TARGETS COMPLETE")
+        print(" --- %d binaries successesful recompiled" % len(success))
+        for s in success:
+            print("     - ", s)
+        print(" --- %d binaries failed" % len(failure))
+        for f in failure:
+            print("     - ", f)
+        if len(resumed)>0:
+            print(" --- %d of them were already complete (--resume)" % len(resumed))
+        if len(self.pch_jobs)>0:
+            print(" --- precompiled headers: %d of %d built" % (pch_built,len(self.pch_jobs)))
+        if len(self.compile_results)>0:
+            compiled=[t for t,c in self.compile_results.items() if c['ok']]
+            retried=[t for t,c in self.compile_results.items() if c['retried']]
+            print(" --- compile check: %d of %d targets compile" % (len(compiled),len(self.compile_results)))
+            for t,c in self.compile_results.items():
+                if not c['ok']:
+                    print("     - %s: %s errors" % (t,c['errors']))
+            if len(retried)>0:
+                print(" --- %d retried with r2ghidra, %d kept" % (len(retried),len([t for t in retried if self.compile_results[t]['kept']])))
+            if self.compile_cache is not None:
+                self.compile_cache.save_stats()
+        if self.shard is not None:
+            print(" --- shard %d/%d, %d target lines left to the other shards" % (self.shard[0],self.shard[1],self.other_shards))
+        print(self.plan.saved())
+        print("="*100)
+        if not os.path.exists(self.ouput_directory):
+            os.makedirs(self.ouput_directory)
+        # several shards can share the output directory, each one writes its own run-level files
+        with open(os.path.join(self.ouput_directory,shard_name(PLAN_NAME,self.shard)),"w") as f:
+            json.dump(self.plan.report(),f,indent=1)
+        if len(run_stats.stages)>0:
+            print(run_stats.summary(" STAGE TIMINGS (all targets)"))
+            print("="*100)
+            run_stats.write(os.path.join(self.ouput_directory,shard_name(STATS_NAME,self.shard)))
+        if len(self.runner.stats)>0:
+            print(self.runner.summary(" EXTERNAL TOOLS"))
+            print("="*100)
+            with open(os.path.join(self.ouput_directory,shard_name(TOOLS_NAME,self.shard)),"w") as f:
+                json.dump(self.runner.report(),f,indent=1)
+        if self.shard is not None:
+            summary={'shard':list(self.shard),'targets':[T['target'] for T in self.targets],'other_shards':self.other_shards,
+                'success':success,'failure':failure,'resumed':resumed,'decomp_failures':decomp_failure_count,
+                'target_failures':target_failure_count,'stats':run_stats.report(),'plan':self.plan.report(),
+                'tools':self.runner.report(),'compile_check':self.compile_results}
+            with open(os.path.join(self.ouput_directory,shard_name(SUMMARY_NAME,self.shard)),"w") as f:
+                json.dump(summary,f,indent=1)
+        if decomp_failure_count>0 or target_failure_count>0:
+            import sys;sys.exit(-1)
+
+    # => {'main': {'offset', 'address', 'dynamic', 'static', 'decoded', 'cached'}}, the old defaults if binpath can't be read
+    def main_detour_offsets(self,binpath,dynamic):
+        if self.detour_offsets is None:
+            self.detour_offsets=DetourOffsets()
+        try:
+            return self.detour_offsets.offsets(binpath,["main"],dynamic)
+        except (OSError,ElfError) as e:
+            log_run.warning("%s: no detour offsets (%s), using the defaults",binpath,e)
+            entry=dict(DETOUR_OFFSET_DEFAULTS,address=None,decoded=[],cached=False)
+            return {"main":dict(entry,offset=entry['dynamic' if dynamic else 'static'])}
+
+    # decompile, clean up and write out a single target
+    #  => the paths written, or None when none of its functions could be decompiled
+    def run_target(self,TARG,idaw,cleaner,success,failure):
+        target=TARG['target']
+        outputs=[]
+        stats=TARG.setdefault('stats',StageStats(target))
+        path=TARG['path']
+        funcList=TARG['funcList']
+        detour_funcs=[x[0][0] for x in TARG['detour_funcs']]
+        detour_fullfuncs=[x[0][1] for x in TARG['detour_funcs']]
+        detour_syms=[x[1] for x in TARG['detour_funcs']]
+        symbols_lut = TARG['symbols_lut']
+        binpath=path
+        nostripbin=binpath
+        decompile_error_count=0
+        if self.strip:
+           binpath=strip_binary(path,runner=self.runner) 
+
+        outdir = os.path.join(self.ouput_directory, target)
+        decompdir = os.path.join(self.decompdir, target)
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        if not os.path.exists(decompdir):
+            os.makedirs(decompdir)
+
+        dataMap=dict()
+        detfncs=detour_funcs+[x[1:] for x in detour_funcs if x.startswith('_') ]
+        detours_regex="|".join(detfncs)
+
+        while len(detours_regex)>0 and detours_regex[-1]=='|':
+            detours_regex=detours_regex[0:-1]
+        detours_re=re.compile(r"\b("+detours_regex+r")\b")
+        mainFunc = funcList[0].strip()
+
+        log_run.info("="*100)
+        log_run.info("Decompile and Recompiling: %s in target %s",detour_funcs,target)
+        log_run.info("="*100)
+
+        types_job=self.start_types_stage(TARG,idaw,cleaner,nostripbin,decompdir,stats)
+        typehdr="resolved-types.h"
+        # <target>_recomp.c, built up section by section
+        recomp = TranslationUnit()
+        header = ""
+        pch_headers=["defs.h"]+([typehdr] if self.use_new_features else [])
+        includes="".join([f"#include \"{h}\"\n" for h in ([PCH_HEADER] if self.pch else pch_headers)])
+        header += includes
+        header += "\n// Auto-generated code for recompilation of target [%s]\n\n" % target
+        recomp.add(header)
+        if not self.use_new_features:
+            # filled in once the types stage is done
+            typedef_chunk=recomp.add("")
+
+        log_run.info("    --- Decompiling target functions...")
+        data_symbols = [ x['name'] for s in ['d','D','b','B'] if (symbols_lut.get(s,None) != None) for x in symbols_lut[s] ]
+        fn_symbols = [ x['name'] for s in ['t','T','U','w','W'] if (symbols_lut.get(s,None) != None) for x in symbols_lut[s] ]
+        glibc_symbols = [ x['name'] for s in ['t','T','U','w','W'] if (symbols_lut.get(s,None) != None) for x in symbols_lut[s] if x['is_glibc'] and (x['name'] not in CSTDIO_DATASYMS)]
+        ext_symbols = [ x['name'] for s in ['U'] if (symbols_lut.get(s,None) != None) for x in symbols_lut[s] ]
+        recomp.add(cleaner.generate_det_placeholders())
+
+        fulldecomp_code=""
+        stubs=PrototypeTable()
+        funcHeaders=PrototypeTable()
+        decls=[[],[],[],[],[],[]]
+        header_decls=decls[0]
+        func_decls=decls[1]
+        data_decls=decls[2]
+        decomp_decls=PrototypeTable()
+        decomp_defs=decls[4]
+        stubs_per_func=dict()
+        funcHeaders_per_func=dict()
+        decomp_per_func=dict()
+        dataMap_per_func=dict()
+        translate_dict=dict()
+        fn_info=dict()
+        data_decls.append("\n//"+"-"*68)
+        data_decls.append(IDA_DATA_START+"\n")
+        func_decls.append("\n//"+"-"*68)
+        func_decls.append(IDA_STUB_START+"\n")
+        decomp_defs.append("\n//"+"-"*68)
+        decomp_defs.append("// Decompiled Functions\n")
+        sym_requirements=dict()
+        dataRemoveList=list()
+
+        #decompFH=open("/tmp/decomp_raw.c","w")
+        guessed_protos=set()
+        # functions whose inputs (and everything processed before them) haven't changed since the last run
+        #  are restored from the incremental cache instead of being reprocessed (their deltas are replayed)
+        fn_cache=self.load_function_cache(decompdir) if self.incremental else dict()
+        fn_cache_used=dict()
+        fn_key=self.function_cache_key(INCREMENTAL_CACHE_VERSION,self.use_new_features,self.strip,self.r2ghidra_cmd,
+            data_symbols,fn_symbols,glibc_symbols+ext_symbols)
+        fn_reused=[]
+        fn_recomputed=[]
+        # decompiled function name => symbol, to attribute compile errors
+        check_functions=dict()
+        for idx,funcsym in enumerate(funcList):
+            func=funcsym
+            if self.mang2demLUT:
+                func=self.mang2demLUT[funcsym][0]
+            # keep the next functions decompiling while this one is cleaned up (in funcList order)
+            self.prefetch(TARG,idaw,idx+1)
+            log_run.info("Processing Function: %s [symbol = '%s']",func,funcsym)
+            with stats.stage("decompile_func",function=func) as st:
+                decomp_code = self.planned('decompile',TARG,funcsym,decompdir,
+                    lambda: idaw.decompile_func(binpath, funcsym,decompdir))
+                st['size']=len(decomp_code)
+            if funcsym in TARG.get('r2ghidra_retry',()):
+                # the compile check found errors in this function's Hex-Rays output
+                log_run.info("Using r2ghidra output for %s (compile check retry)",func)
+                with stats.stage("r2ghidra",function=func):
+                    decomp_code=re.sub(r"\b__thiscall\n",r"",self.get_r2ghidra_out(funcsym,path,decompdir))
+            check_functions[re.sub(r"\bmain\b","patchmain",func)]=funcsym
+            check_functions[re.sub(r"\bmain\b","patchmain",detour_funcs[idx])]=funcsym
+            decomp_code = re.sub(r"\bmain\b","patchmain",decomp_code)
+            if func not in fn_symbols:
+                log_run.debug("%s not in %s",func,fn_symbols)
+                log_run.warning("%s: invalid function symbol, skipping...",func)
+                failure.append((target, binpath, funcsym))
+                continue
+            fn_key=self.function_cache_key(fn_key,func,funcsym,detour_funcs[idx],
+                sorted(set(detours_re.findall(decomp_code))),decomp_code)
+            if fn_key in fn_cache:
+                log_run.info("Reusing previous results for %s",func)
+                fn_cache_used[fn_key]=fn_cache[fn_key]
+                (dataMap,dataRemoveList,data_decls,stubs,funcHeaders,decomp_decls,header_decls,translate_dict,guessed_protos,
+                    stubs_per_func,funcHeaders_per_func,decomp_per_func,dataMap_per_func)=self.apply_function_state_delta(
+                    (dataMap,dataRemoveList,data_decls,stubs,funcHeaders,decomp_decls,header_decls,translate_dict,guessed_protos,
+                    stubs_per_func,funcHeaders_per_func,decomp_per_func,dataMap_per_func),fn_cache[fn_key]['delta'])
+                fn_reused.append(func)
+                continue
+            if self.incremental:
+                fn_sizes=self.function_state_sizes((dataMap,dataRemoveList,data_decls,stubs,funcHeaders,decomp_decls,
+                    header_decls,translate_dict,guessed_protos,stubs_per_func,funcHeaders_per_func,decomp_per_func,dataMap_per_func))
+            fn_recomputed.append(func)
+            log_run.debug("STUBS_PER_FUNC[ID] : ID=%s",detour_funcs[idx])
+            stubs_per_func[detour_funcs[idx]]=dict()
+            funcHeaders_per_func[detour_funcs[idx]]=dict()
+            if len(decomp_code) <= 0:
+                log_run.warning("%s: decompilation error, skipping...",func)
+                decompile_error_count+=1;failure.append((target, binpath, funcsym))
+                continue
+
+            with stats.stage("remove_artifacts",len(decomp_code),func):
                 decomp_code = cleaner.remove_artifacts(decomp_code,self.use_new_features)
-                #print(decomp_code)
+            #print(decomp_code)
 
-                print("    --- Creating stubs...")
-                #      dataMap [per fun] ; dataMap_ [global]
-                #return dataMap, removeList, dataMap_, dataLines_
+            log_run.info("    --- Creating stubs...")
+            #      dataMap [per fun] ; dataMap_ [global]
+            #return dataMap, removeList, dataMap_, dataLines_
+            with stats.stage("get_data_declarations",len(decomp_code),func):
                 dataMap, dataRemoveList, d, data_decls = cleaner.get_data_declarations(decomp_code,data_symbols,dataMap, data_decls)
-                known_hexray_issue = [ x for x in d['local_vars'] if "dword" in x ]
-                #if len(known_hexray_issue)>0 and self.r2ghidra_cmd:
-                if self.r2ghidra_cmd and len(known_hexray_issue)>0:
-                    print(f"KNOWN HEX RAY ISSUE: {known_hexray_issue}")
-                    issue_regex=r"&("+"|".join(known_hexray_issue)+r")\b"
-                    issue_re=re.compile(issue_regex)
-                    if issue_re.search(decomp_code):
-                        # need unstripped binary for input
+            known_hexray_issue = [ x for x in d['local_vars'] if "dword" in x ]
+            #if len(known_hexray_issue)>0 and self.r2ghidra_cmd:
+            if self.r2ghidra_cmd and len(known_hexray_issue)>0:
+                log_run.debug("KNOWN HEX RAY ISSUE: %s",known_hexray_issue)
+                issue_regex=r"&("+"|".join(known_hexray_issue)+r")\b"
+                issue_re=re.compile(issue_regex)
+                if issue_re.search(decomp_code):
+                    # need unstripped binary for input
+                    with stats.stage("r2ghidra",function=func):
                         new_decomp= self.get_r2ghidra_out(funcsym,path,decompdir)
-                        print(f"r2ghidra decompiled code: {new_decomp}")
-                        print(f"prev decompiled code: {decomp_code}")
-                        decomp_code=re.sub(r"\b__thiscall\n",r"",new_decomp)
-                # d = {'prototypes':dict(),'sym2proto':dict(),'ext_vars':set(),'local_vars':set()} 
-                #data_syms={'ext_var':ext_var_syms,'local_var':local_var_syms}
-                dataMap_per_func[detour_funcs[idx]]=d
-                # stubs are the Function declaration section content [external and local function prototypes]
-                # funcHeaders are the local function definitions
-                guessed_protos |= set(cleaner.get_guessed_funcs(decomp_code))
-                stubs, funcHeaders, h, s, f, d, g, translate_dict,rm_decomp_decl = cleaner.get_stubs(decomp_code,stubs,funcHeaders,detours_re,
+                    log_run.debug("r2ghidra decompiled code: %s",new_decomp)
+                    log_run.debug("prev decompiled code: %s",decomp_code)
+                    decomp_code=re.sub(r"\b__thiscall\n",r"",new_decomp)
+            # d = {'prototypes':dict(),'sym2proto':dict(),'ext_vars':set(),'local_vars':set()} 
+            #data_syms={'ext_var':ext_var_syms,'local_var':local_var_syms}
+            dataMap_per_func[detour_funcs[idx]]=d
+            # stubs are the Function declaration section content [external and local function prototypes]
+            # funcHeaders are the local function definitions
+            with stats.stage("get_stubs",len(decomp_code),func):
+                guessed=set(cleaner.get_guessed_funcs(decomp_code))-guessed_protos
+                guessed_protos |= guessed
+                # get_stubs only adds to translate_dict, this function's translations are kept apart for its delta
+                stubs, funcHeaders, h, s, f, d, g, translations,rm_decomp_decl = cleaner.get_stubs(decomp_code,stubs,funcHeaders,detours_re,
                     decomp_decls,fn_symbols,glibc_symbols+ext_symbols,data_symbols,
-                    translate_dict,guessed_protos,decomp_decls)
-                decomp_per_func[detour_funcs[idx]]=h[d:-1]
-                #return stubs, funcs, fulldecomp, lstubs, lfuncs, fn_start,global_fns
-                header_decls+=h
-                dprint("HEADER DECLS '{}' => {}".format(func,h))
-                print("DATA REMOVE LIST '{}' => {}".format(func,dataRemoveList))
-                print("GLOBAL DATA MAP '{}' => {}".format(func,dataMap))
-                print("DATA DECLS '{}' => {}".format(func,data_decls))
-                print("FUNCTION DATA MAP '{}' => {}".format(func,d))
-                print("STUB DECLARATIONS '{}' => {}".format(func,stubs['prototypes']))
-                print("NEW STUB DECLARATIONS '{}' => {}".format(func,s['prototypes']))
-                print("NEW FUNCTION DECLARATIONS '{}' => {}".format(func,g))
-                print(f"DETOUR FUNCS 'detour_funcs[{idx}]' => '{detour_funcs[idx]}'")
-                print(f"GUESSED FUNCS: {guessed_protos}")
-                
-                used_symbols=[ get_function_name(x.strip()) for x in data_decls+stubs['prototypes'] if not x.strip().startswith("//")]
-                
-
-                for rmdd in rm_decomp_decl:
-                    print(f"Removing existing weaker conflicting declaration: {rmdd}")
-                    del decomp_decls[decomp_decls.index(rmdd)]
-                decomp_decls+=g
-                stubs_per_func[detour_funcs[idx]]=s
-                funcHeaders_per_func[detour_funcs[idx]]=f['prototypes']
-                #fulldecomp_code += decomp_code
-
-            #decompFH.close()
-            func_decls=stubs['prototypes']
-            decomp_defs=[]
-            for i in decomp_per_func.keys():
-                decomp_defs.extend(decomp_per_func[i])
-
-            if decompile_error_count == len(funcList):
-                decomp_failure_count+=1
-                continue
-            
-            # let's collect basic decompiler output before any transformation
-            basic_=[]
-            basic_+=["\n","//"+'-'*68,"// Function Prototypes"]+func_decls+["\n"]
-            basic_+=["\n","//"+'-'*68,"// Decompiled Variables"]+data_decls+["\n"]
-            basic_+=["\n","//"+'-'*68,"// Decompiled Function Declarations"]+decomp_decls+["\n"]
-            basic_+=["\n","//"+'-'*68,"// Decompiled Function Definitions"]+decomp_defs+["\n"]
-            basic_finalOutput="\n\n"+"\n".join(basic_)+"\n\n"
-
-            #let's clean-up the GLIBC references to avoid collision
-            # and only clean-up references that are used and external (maybe this should be used everywhere?)
-            used_extsymbols = [x for x in used_symbols if x in CSTDIO_FUNCS+glibc_symbols+ext_symbols]
-            print(f"DEBUG : USED EXTERNAL SYMBOLS => {used_extsymbols}")
-            if len(used_extsymbols)>0:
+                    dict(),guessed_protos,decomp_decls)
+                translate_dict.update(translations)
+            decomp_per_func[detour_funcs[idx]]=h[d:-1]
+            #return stubs, funcs, fulldecomp, lstubs, lfuncs, fn_start,global_fns
+            header_decls+=h
+            log_run.debug("HEADER DECLS '%s' => %s",func,h)
+            # these grow with every processed function, so only render them when debugging
+            if log_run.isEnabledFor(LOG_DEBUG):
+                log_run.debug("DATA REMOVE LIST '%s' => %s",func,dataRemoveList)
+                log_run.debug("GLOBAL DATA MAP '%s' => %s",func,dataMap)
+                log_run.debug("DATA DECLS '%s' => %s",func,data_decls)
+                log_run.debug("FUNCTION DATA MAP '%s' => %s",func,d)
+                log_run.debug("STUB DECLARATIONS '%s' => %s",func,stubs['prototypes'])
+                log_run.debug("NEW STUB DECLARATIONS '%s' => %s",func,s['prototypes'])
+                log_run.debug("NEW FUNCTION DECLARATIONS '%s' => %s",func,g)
+                log_run.debug("DETOUR FUNCS 'detour_funcs[%s]' => '%s'",idx,detour_funcs[idx])
+                log_run.debug("GUESSED FUNCS: %s",guessed_protos)
+
+            for rmdd in rm_decomp_decl:
+                log_run.debug("Removing existing weaker conflicting declaration: %s",rmdd)
+                decomp_decls.remove(rmdd)
+            n=len(decomp_decls)
+            decomp_decls.extend(g)
+            stubs_per_func[detour_funcs[idx]]=s
+            funcHeaders_per_func[detour_funcs[idx]]=f['prototypes']
+            #fulldecomp_code += decomp_code
+            if self.incremental:
+                fn_detour=detour_funcs[idx]
+                fn_edits={'dataRemoveList':('replace',dataRemoveList),'decomp_decls':('extend',decomp_decls.rows(n),rm_decomp_decl),
+                    'translate_dict':('update',translations,[]),'guessed_protos':('update',guessed,[]),
+                    'stubs_per_func':('update',{fn_detour:s},[]),'funcHeaders_per_func':('update',{fn_detour:f['prototypes']},[]),
+                    'decomp_per_func':('update',{fn_detour:decomp_per_func[fn_detour]},[]),
+                    'dataMap_per_func':('update',{fn_detour:dataMap_per_func[fn_detour]},[])}
+                fn_cache_used[fn_key]={'function':func,'delta':self.function_state_delta(fn_sizes,(dataMap,dataRemoveList,
+                    data_decls,stubs,funcHeaders,decomp_decls,header_decls,translate_dict,guessed_protos,stubs_per_func,
+                    funcHeaders_per_func,decomp_per_func,dataMap_per_func),fn_edits)}
+
+        typedefLines,types_used,needs_stdio=types_job.result()
+        if not self.use_new_features:
+            recomp.chunks[typedef_chunk]=typedefLines
+        # only this run's entries are kept, stale ones go away
+        if self.incremental:
+            writepickle(os.path.join(decompdir,INCREMENTAL_CACHE),fn_cache_used)
+        log_run.info("    --- Incremental: reused %d function(s) %s, recomputed %d %s",len(fn_reused),fn_reused,len(fn_recomputed),fn_recomputed)
+        #decompFH.close()
+        # only needed once all the functions have been processed
+        used_symbols=[ get_function_name(x.strip()) for x in data_decls+stubs['prototypes'] if not x.strip().startswith("//")]
+        func_decls=stubs.lines()
+        decomp_decls=decomp_decls.lines()
+        decomp_defs=[]
+        for i in decomp_per_func.keys():
+            decomp_defs.extend(decomp_per_func[i])
+
+        if decompile_error_count == len(funcList):
+            return None
+        
+        # let's collect basic decompiler output before any transformation
+        basic_=TranslationUnit()
+        if self.use_new_features:
+            basic_.add(includes+"\n")
+            basic_.add_section(["\n","//"+'-'*68,"// Function Prototypes"]+func_decls+["\n"])
+            basic_.add_section(["\n","//"+'-'*68,"// Decompiled Variables"]+data_decls+["\n"])
+            basic_.add_section(["\n","//"+'-'*68,"// Decompiled Function Declarations"]+decomp_decls+["\n"])
+            basic_.add_section(["\n","//"+'-'*68,"// Decompiled Function Definitions"]+decomp_defs+["\n"])
+            basic_.add("\n")
+
+        #let's clean-up the GLIBC references to avoid collision
+        # and only clean-up references that are used and external (maybe this should be used everywhere?)
+        used_extsymbols = [x for x in used_symbols if x in CSTDIO_FUNCS+glibc_symbols+ext_symbols]
+        log_run.debug("DEBUG : USED EXTERNAL SYMBOLS => %s",used_extsymbols)
+        if len(used_extsymbols)>0:
+            with stats.stage("prevent_glibc_collision",len(decomp_defs)):
                 decomp_defs = cleaner.prevent_glibc_collision(decomp_defs,used_extsymbols)
 
-            # let's uniquify the header lines by the set datatype
-            print("\nFUNC_HEADERS:\n{}".format(" -- "+"\n -- ".join(funcHeaders['prototypes'])))
-            print("\nDATA_DECLS:\n{}".format(" -- "+"\n -- ".join(data_decls)))
-            print("\nFUNC_DECLS:\n{}".format(" -- "+"\n -- ".join(func_decls)))
-            print("\nDECOMP_DECLS:\n{}".format(" -- "+"\n -- ".join(decomp_decls)))
-            print("\nDECOMP_DEFS:\n{}".format(" -- "+"\n -- ".join(decomp_defs)))
+        # let's uniquify the header lines by the set datatype
+        if log_run.isEnabledFor(LOG_DEBUG):
+            for k,v in [("FUNC_HEADERS",funcHeaders['prototypes']),("DATA_DECLS",data_decls),("FUNC_DECLS",func_decls),
+                        ("DECOMP_DECLS",decomp_decls),("DECOMP_DEFS",decomp_defs)]:
+                log_run.debug("\n%s:\n -- %s",k,"\n -- ".join(v))
 
-            # replacing data declarations with the defines
+        # replacing data declarations with the defines
+        with stats.stage("replace_data_defines",len(data_decls)):
             data_decls = cleaner.replace_data_defines_list(data_decls, dataMap, dataRemoveList)
 
-            full_=[]
-            if self.use_new_features:
-                full_+=["\n","//"+"-"*68,"// EBX mechanism needed to interface with original binary's PLT","\n",
-                    "unsigned int preEBX = NULL;","unsigned int origPLT_EBX = NULL;","\n"]
-
-            print(f"decomp_finalOutput => header_decls: {header_decls[0:6]}")
-            #full_+=header_decls[0:6]+["\n","//"+"-"*68,"// Function Declarations","\n"]
-            # the above seems to introduce duplications of function prototypes, so the following is a workaround
-            for x in header_decls[0:6]:
-                if x not in data_decls+decomp_decls+decomp_defs+func_decls:
-                    full_+=[x]
-            full_+=["\n","//"+"-"*68,"// Function Declarations","\n"]
-            full_+=func_decls+["\n"]
-            full_+=["\n","//"+'-'*68,"// Decompiled Variables"]+data_decls+["\n"]
-            full_+=["\n","//"+'-'*68,"// Decompiled Function Declarations"]+decomp_decls+["\n"]
-            full_+=["\n","//"+'-'*68,"// Decompiled Function Definitions"]+decomp_defs+["\n"]
-            #finalOutput+="\n\n"+"\n".join(header_decls[0:6]+func_decls+data_decls+decomp_decls)+"\n\n"
-            decomp_finalOutput="\n\n"+"\n".join(full_)+"\n\n"
-            # this following line replaces content in parts of the code we don't want
-            #finalOutput = cleaner.replace_data_defines(finalOutput, dataMap, dataRemoveList)
-            stubMap_=dict()
-            nonCGCList_=dict()
+        full_=[]
+        if self.use_new_features:
+            full_+=["\n","//"+"-"*68,"// EBX mechanism needed to interface with original binary's PLT","\n",
+                "unsigned int preEBX = NULL;","unsigned int origPLT_EBX = NULL;","\n"]
+
+        log_run.debug("decomp_finalOutput => header_decls: %s",header_decls[0:6])
+        #full_+=header_decls[0:6]+["\n","//"+"-"*68,"// Function Declarations","\n"]
+        # the above seems to introduce duplications of function prototypes, so the following is a workaround
+        for x in header_decls[0:6]:
+            if x not in data_decls+decomp_decls+decomp_defs+func_decls:
+                full_+=[x]
+        full_+=["\n","//"+"-"*68,"// Function Declarations","\n"]
+        full_+=func_decls+["\n"]
+        decomp_start=recomp.add("\n\n")
+        recomp.add_section(full_)
+        recomp.add_section(["\n","//"+'-'*68,"// Decompiled Variables"]+data_decls+["\n"])
+        recomp.add_section(["\n","//"+'-'*68,"// Decompiled Function Declarations"]+decomp_decls+["\n"])
+        # one chunk per decompiled function (decomp_defs is decomp_per_func's lines, in order), these are the bulk
+        #  of the file; the transforms below see a whole function at a time
+        decomp_defs_idx=recomp.add_section(["\n","//"+'-'*68,"// Decompiled Function Definitions"])
+        func_chunks=dict()
+        start=0
+        for f,lines in decomp_per_func.items():
+            i=recomp.add_section(decomp_defs[start:start+len(lines)])
+            func_chunks[f]=(i,i+1)
+            start+=len(lines)
+        recomp.add("\n\n")
+        decomp_defs_end=recomp.add("\n")
+        # this following line replaces content in parts of the code we don't want
+        #finalOutput = cleaner.replace_data_defines(finalOutput, dataMap, dataRemoveList)
+        stubMap_=dict()
+        nonCGCList_=dict()
+        with stats.stage("resolve_dependencies",len(stubs_per_func)):
             updated_stubs,updated_dataMap,nm2decomp_syms=cleaner.resolve_dependencies(stubs_per_func,dataMap_per_func)
 
-            print(f"GLIBC SYMBOLS => {glibc_symbols} ({type(glibc_symbols)})")
-            stubMap, nonCGCList= cleaner.make_pcgc_stubs(stubs, funcHeaders['prototypes'],glibc_symbols+ext_symbols if self.use_new_features else None)
-            for f in detour_funcs:
-                #stubMap_[f], nonCGCList_[f] = cleaner.make_pcgc_stubs(stubs_per_func[f],funcHeaders_per_func[f])
-                dprint(f"DEBUG [{f}]  :  updated_stubs[f]=>{updated_stubs[f]}")
-                stubMap_[f], nonCGCList_[f] = cleaner.make_pcgc_stubs(updated_stubs[f],funcHeaders['prototypes'],glibc_symbols+ext_symbols if self.use_new_features else None)
-            # finalOutput = cleaner.remove_nonCGC_calls(finalOutput, nonCGCList)
-            decomp_finalOutput = cleaner.replace_stubs(decomp_finalOutput, stubMap)
-            # pdr update - let's not rename the functions
-            # finalOutput = cleaner.rename_target(finalOutput, mainFunc)
-                    
+        log_run.debug("GLIBC SYMBOLS => %s",glibc_symbols)
+        with stats.stage("make_pcgc_stubs",len(stubs)):
+            stubMap, nonCGCList= cleaner.make_pcgc_stubs(stubs, funcHeaders,glibc_symbols+ext_symbols if self.use_new_features else None)
+        for f in detour_funcs:
+            #stubMap_[f], nonCGCList_[f] = cleaner.make_pcgc_stubs(stubs_per_func[f],funcHeaders_per_func[f])
+            log_run.debug("DEBUG [%s]  :  updated_stubs[f]=>%s",f,updated_stubs[f])
+            with stats.stage("make_pcgc_stubs",len(updated_stubs[f]['prototypes']),f):
+                stubMap_[f], nonCGCList_[f] = cleaner.make_pcgc_stubs(updated_stubs[f],funcHeaders,glibc_symbols+ext_symbols if self.use_new_features else None)
+        # finalOutput = cleaner.remove_nonCGC_calls(finalOutput, nonCGCList)
+        with stats.stage("replace_stubs",len(stubMap)):
+            recomp.transform(lambda chunk: cleaner.replace_stubs(chunk, stubMap),start=decomp_start)
+        # pdr update - let's not rename the functions
+        # finalOutput = cleaner.rename_target(finalOutput, mainFunc)
+                
 
-            print("    --- Additional cleaning")                
-            decomp_finalOutput = cleaner.handle_const_assigns(decomp_finalOutput, funcHeaders)
+        log_run.info("    --- Additional cleaning")
+        with stats.stage("handle_const_assigns",decomp_defs_end-decomp_defs_idx):
+            recomp.transform(lambda chunk: cleaner.handle_const_assigns(chunk, funcHeaders),start=decomp_defs_idx,end=decomp_defs_end)
 
 
-            print("    --- Generating wrappers...")
-            # we just don't want mainFunc, we want all detoured functions
+        log_run.info("    --- Generating wrappers...")
+        # we just don't want mainFunc, we want all detoured functions
+        with stats.stage("generate_wrapper",len(detour_funcs)):
             footer,detfn_defs = cleaner.generate_wrapper(detour_funcs, funcHeaders_per_func, stubMap_, updated_dataMap, self.detour_entry_fn_prefix,translate_dict,self.dem2mangLUT,glibc_symbols+ext_symbols if self.use_new_features else None)
 
-            decomp_finalOutput += footer
+        recomp.add(footer)
 
-            decomp_finalOutput = re.sub("::","__",decomp_finalOutput)
-            header = ""
-            header += "#include \"defs.h\"\n"
+        # C++ names: the decompiled part (and basic.c) get '::' => '__' first, then the whole target goes through
+        #  transform_cpp with --strip, transform_std otherwise; the types header only gets the '::' rewrite
+        transform=cleaner.transform_cpp if self.strip else cleaner.transform_std
+        with stats.stage("normalize_cpp_names") as st:
             if self.use_new_features:
-                basic_finalOutput=f"#include \"defs.h\"\n#include \"{typehdr}\""+basic_finalOutput
-                header += f"#include \"{typehdr}\"\n"
-                typedefLines = re.sub("::\$","__E__",typedefLines)
-                typedefLines = re.sub("::","__",typedefLines)
-                basic_finalOutput=re.sub("::","__",basic_finalOutput)
-                if self.strip:
-                    basic_finalOutput=cleaner.transform_cpp(basic_finalOutput)
-                else:
-                    basic_finalOutput=cleaner.transform_std(basic_finalOutput)
+                typedefLines = cpp_header(typedefLines)
+                basic_.transform(lambda chunk: transform(cpp_scope(chunk)))
+            recomp.transform(cpp_scope,start=decomp_start)
+            recomp.transform(transform)
+            st['size']=len(recomp)
+        TARG['check_functions']=dict(check_functions)
+        TARG['check_functions'].update({transform(cpp_scope(f)):s for f,s in check_functions.items()})
 
-            header += "\n// Auto-generated code for recompilation of target [%s]\n\n" % target
-            finalOutput = header + finalOutput + decomp_finalOutput
-            if self.strip:
-                finalOutput=cleaner.transform_cpp(finalOutput)
-            else:
-                finalOutput=cleaner.transform_std(finalOutput)
 
-
-            print("Recompilation Complete!")
-
-            print("\nWriting to ", outdir)
-                
-            outpath = os.path.join(self.ouput_directory, target, target+"_recomp.c")
-            with open(outpath, "w") as outFile:
-                outFile.write(finalOutput)
-            outFile.close()
-
-            if self.use_new_features:
-                print(f"WRITING TYPES TO {self.ouput_directory}/{target}/{typehdr}")
-                with open(os.path.join(self.ouput_directory,target,typehdr),'w') as f:
-                    f.write(typedefLines)
-                    f.close()
-                    print(f"DONE WRITING TO {self.ouput_directory}/{target}/{typehdr}")
-                outpath = os.path.join(self.ouput_directory, target, "basic.c")
-                with open(outpath,"w") as of:
-                    of.write(basic_finalOutput)
-                    of.close()
+        log_run.info("Recompilation Complete!")
+        log_run.info("\nWriting to %s",outdir)
             
-            success.append((target, binpath, funcList))
-
-            #funcStubline = ""
-            #for stubLine in stubMap.keys():
-            #    stubName = cleaner.get_stub_name(stubLine)
-            #    funcStubline += stubName +","
-            #
-            #for dataStub in dataMap.values():
-            #    # IPython.embed()
-            #    dataDef = dataStub.split("\n")[1]
-            #    dataName = dataDef[8:].split(maxsplit=1)[0]
-            #    funcStubline += dataName +","
-            #funcStubline = funcStubline.strip(",")
-            funcStubs = [f for f in detfn_defs.values()]
-            print(f"funcStubs: {funcStubs}")
-            funcStubline = re.sub('\[\d*\]',""," ".join(funcStubs))
-            print(f"funcStubline: {funcStubline}")
-            detours = []
-            cleanup_detfn_defs=dict()
-            for i,x in detfn_defs.items():
-                upd_x=re.sub(r"\[\d+\]","",x)
-                cleanup_detfn_defs[i]=upd_x
-                di=re.sub("::","__",i)
-                sym_i=self.dem2mangLUT[i]
-                define=f"{di}:{sym_i}"
-                ti=translate_dict.get(i,i)
-                print(f"DETOURS = {i} vs {ti}")
-                
-                if self.detour_entry_fn_prefix:
-                    di="{}{}".format(self.detour_entry_fn_prefix,ti)
-                    di=re.sub("::","__",di)
-                    define="{}:{}".format(di,sym_i)
-
-                if i=="main":
-                    # Ideally, should read through the disasm and find the correct offset
-                    #  for dynamically linked binaries, this is after the EBX register has been loaded
-                    if len(ext_symbols)>0:
-                        define+="+23"
-                    else:
-                        #  for statically linked binaries, this is after initial population of registers required to return to __libc_start_main
-                        define+="+7"
-                detours.append(define)
+        outpath = os.path.join(self.ouput_directory, target, target+"_recomp.c")
+        with stats.stage("write_outputs",len(recomp)):
+            recomp.write(outpath)
+        outputs.append(outpath)
+        log_run.debug("wrote %s (%d bytes in %d chunks)",outpath,len(recomp),len(recomp.chunks))
+        if self.split_functions:
+            with stats.stage("split_functions",len(recomp)):
+                split_header,split_sources=self.write_split_functions(target,recomp,func_chunks,includes,outdir)
+            outputs+=[os.path.join(outdir,n) for n in [split_header]+split_sources]
+            log_run.info("    --- split into %s and %d sources",split_header,len(split_sources))
+
+        if self.use_new_features:
+            log_run.debug("WRITING TYPES TO %s/%s/%s",self.ouput_directory,target,typehdr)
+            with open(os.path.join(self.ouput_directory,target,typehdr),'w') as f:
+                f.write(typedefLines)
+                f.close()
+                outputs.append(os.path.join(self.ouput_directory,target,typehdr))
+                log_run.debug("DONE WRITING TO %s/%s/%s",self.ouput_directory,target,typehdr)
+            outpath = os.path.join(self.ouput_directory, target, "basic.c")
+            basic_.write(outpath)
+            outputs.append(outpath)
+        
 
+        #funcStubline = ""
+        #for stubLine in stubMap.keys():
+        #    stubName = cleaner.get_stub_name(stubLine)
+        #    funcStubline += stubName +","
+        #
+        #for dataStub in dataMap.values():
+        #    # IPython.embed()
+        #    dataDef = dataStub.split("\n")[1]
+        #    dataName = dataDef[8:].split(maxsplit=1)[0]
+        #    funcStubline += dataName +","
+        #funcStubline = funcStubline.strip(",")
+        funcStubs = [f for f in detfn_defs.values()]
+        log_run.debug("funcStubs: %s",funcStubs)
+        funcStubline = re.sub('\[\d*\]',""," ".join(funcStubs))
+        log_run.debug("funcStubline: %s",funcStubline)
+        detours = []
+        cleanup_detfn_defs=dict()
+        detour_offsets=dict()
+        if "main" in detfn_defs:
+            detour_offsets=self.main_detour_offsets(nostripbin,len(ext_symbols)>0)
+        for i,x in detfn_defs.items():
+            upd_x=re.sub(r"\[\d+\]","",x)
+            cleanup_detfn_defs[i]=upd_x
+            di=cpp_scope(i)
+            sym_i=self.dem2mangLUT[i]
+            define=f"{di}:{sym_i}"
+            ti=translate_dict.get(i,i)
+            log_run.debug("DETOURS = %s vs %s",i,ti)
             
-            makefile_dict={
-            "BIN":target,
-            "MYSRC":target+"_recomp.c",
-            "MYREP":"repair.c",
-            "DETOUR_PREFIX":self.detour_entry_fn_prefix,
-            "DETOURS":detours,
-            #"FUNCSTUB_LIST":[ "{}:{}".format(f,funcStubline) for f in detour_funcs ]
-            "FUNCSTUB_LIST": cleanup_detfn_defs
-            }
-            # pdr: should really put this in in a separate configuration parsing 
-            #      and generation script/program
-            funcinsert_call="\n"
-            if self.use_new_features:
-                funcinsert_call="--plt-ebx-support"
-            makefile_target_info = "# Auto-generated Makefile include file\n"  + \
-                          "BIN := " + target + "\n" + \
-                          "DETOUR_BIN ?= $(BIN).trampoline.bin\n" + \
-                          "MYSRC ?= " + target+"_recomp.c" + "\n" + \
-                          "MYREP ?= " + "repair.c" + "\n" + \
-                          "DETOUR_PREFIX := " + self.detour_entry_fn_prefix + "\n" + \
-                          "DETOUR_DEFS := " + funcStubline + "\n" + \
-                          "DETOUR_CALLS := $(patsubst %, --external-funcs $(DETOUR_PREFIX)%, $(DETOUR_DEFS))\n" + \
-                          "DETOURS := " + " ".join(detours) + "\n" + \
-                          "FUNCINSERT_PARAMS := $(DETOURS) $(DETOUR_CALLS) --debug "+funcinsert_call 
-                          #"FUNCINSERT_PARAMS := --detour-prefix $(DETOUR_PREFIX) $(DETOURS)\n" 
-            #if self.strip:
-            #    makefile_target_info += "\n## Symbols are mangled, indicating CPP code.\n"+\
-            #              "# overriding DIET_GCC to be diet_g++ script\n"+\
-            #              "DIET_GCC?=${DIET32PATH}/diet_g++\n"
-
-            #newfuncStubline = ""
-            #for f in detour_funcs:
-            #    newfuncStubline += f+":"+funcStubline+"\n"
-            #funcStubline = newfuncStubline
-            print("FUNC_STUBS:\n"+funcStubline)
-            outpath = os.path.join(self.ouput_directory, target, target+"_funcstubs")
-            makefile_include_outpath = os.path.join(self.ouput_directory, target, "prd_include.mk")
-            json_outpath = os.path.join(self.ouput_directory, target, "prd_info.json")
-            with open(makefile_include_outpath, "w") as outFile:
-                outFile.write(makefile_target_info)
-            outFile.close()
-            with open(outpath, "w") as outFile:
-                outFile.write(funcStubline)
-            outFile.close()
-            import json
-            with open(json_outpath, 'w') as outFile:
-                json.dump(makefile_dict,outFile)
-            outFile.close()
-
-            print("="*100)
+            if self.detour_entry_fn_prefix:
+                di="{}{}".format(self.detour_entry_fn_prefix,ti)
+                di=cpp_scope(di)
+                define="{}:{}".format(di,sym_i)
+
+            if i=="main":
+                # read from main's prologue in the original binary (prd_elf.py)
+                #  for dynamically linked binaries, this is after the EBX register has been loaded
+                #  for statically linked binaries, this is after initial population of registers required to return to __libc_start_main
+                define+="+{}".format(detour_offsets["main"]['offset'])
+            detours.append(define)
 
-            shutil.copyfile(DEFS_PATH, os.path.join(outdir, "defs.h"))
+        
+        makefile_dict={
+        "BIN":target,
+        "MYSRC":target+"_recomp.c",
+        "MYREP":"repair.c",
+        "DETOUR_PREFIX":self.detour_entry_fn_prefix,
+        "DETOURS":detours,
+        #"FUNCSTUB_LIST":[ "{}:{}".format(f,funcStubline) for f in detour_funcs ]
+        "FUNCSTUB_LIST": cleanup_detfn_defs,
+        "DETOUR_OFFSETS": detour_offsets
+        }
+        # pdr: should really put this in in a separate configuration parsing 
+        #      and generation script/program
+        funcinsert_call="\n"
+        if self.use_new_features:
+            funcinsert_call="--plt-ebx-support"
+        makefile_target_info = "# Auto-generated Makefile include file\n"  + \
+                      "BIN := " + target + "\n" + \
+                      "DETOUR_BIN ?= $(BIN).trampoline.bin\n" + \
+                      "MYSRC ?= " + target+"_recomp.c" + "\n" + \
+                      "MYREP ?= " + "repair.c" + "\n" + \
+                      "DETOUR_PREFIX := " + self.detour_entry_fn_prefix + "\n" + \
+                      "DETOUR_DEFS := " + funcStubline + "\n" + \
+                      "DETOUR_CALLS := $(patsubst %, --external-funcs $(DETOUR_PREFIX)%, $(DETOUR_DEFS))\n" + \
+                      "DETOURS := " + " ".join(detours) + "\n" + \
+                      "FUNCINSERT_PARAMS := $(DETOURS) $(DETOUR_CALLS) --debug "+funcinsert_call 
+        if self.pch:
+            makefile_target_info += ("" if makefile_target_info.endswith("\n") else "\n")+self.pch_makefile_rules(pch_headers)
+        if self.split_functions:
+            makefile_target_info += ("" if makefile_target_info.endswith("\n") else "\n")+self.split_makefile_rules(split_header,split_sources,pch_headers)
+                      #"FUNCINSERT_PARAMS := --detour-prefix $(DETOUR_PREFIX) $(DETOURS)\n" 
+        #if self.strip:
+        #    makefile_target_info += "\n## Symbols are mangled, indicating CPP code.\n"+\
+        #              "# overriding DIET_GCC to be diet_g++ script\n"+\
+        #              "DIET_GCC?=${DIET32PATH}/diet_g++\n"
+
+        #newfuncStubline = ""
+        #for f in detour_funcs:
+        #    newfuncStubline += f+":"+funcStubline+"\n"
+        #funcStubline = newfuncStubline
+        log_run.debug("FUNC_STUBS:\n%s",funcStubline)
+        outpath = os.path.join(self.ouput_directory, target, target+"_funcstubs")
+        makefile_include_outpath = os.path.join(self.ouput_directory, target, "prd_include.mk")
+        json_outpath = os.path.join(self.ouput_directory, target, "prd_info.json")
+        with open(makefile_include_outpath, "w") as outFile:
+            outFile.write(makefile_target_info)
+        outFile.close()
+        with open(outpath, "w") as outFile:
+            outFile.write(funcStubline)
+        outFile.close()
+        with open(json_outpath, 'w') as outFile:
+            json.dump(makefile_dict,outFile)
+        outFile.close()
+        outputs+=[makefile_include_outpath,outpath,json_outpath]
+
+        log_run.info("="*100)
+
+        shutil.copyfile(DEFS_PATH, os.path.join(outdir, "defs.h"))
+        outputs.append(os.path.join(outdir, "defs.h"))
+        if self.pch:
+            with open(os.path.join(outdir,PCH_HEADER),'w') as f:
+                f.write(f"// Auto-generated header set of target [{target}], precompiled into {PCH_HEADER}.gch\n")
+                f.write("".join([f"#include \"{h}\"\n" for h in pch_headers]))
+            outputs.append(os.path.join(outdir,PCH_HEADER))
+            self.start_pch(TARG)
+
+        # break
+        # mappings = idaw.get_typedef_mappings(path)
+        # a success only once everything is written
+        success.append((target, binpath, funcList))
+        return outputs
 
-            # break
-            # mappings = idaw.get_typedef_mappings(path)
-
-        print(" ALL TARGETS COMPLETE")
-        print(" --- %d binaries successesful recompiled" % len(success))
-        for s in success:
-            print("     - ", s)
-        print(" --- %d binaries failed" % len(failure))
-        for f in failure:
-            print("     - ", f)
-        print("="*100)
-        if decomp_failure_count>0:
-            import sys;sys.exit(-1)
 
 
 
 
 def main():
-    if not os.path.isfile(IDA_PATH):
-        print("ERROR: Environmental variable IDA_BASE_PATH is not set or '"+IDA_DEFAULT_PATH+"' does not exist")
-        import sys
-        sys.exit(-1)
+    import argparse
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('--decompdir',dest='decompdir',default="/tmp/decomp",action='store',
                         help='path to store raw decompiled content')
@@ -3404,18 +4249,69 @@ def main():
                     help='Use the new features [type order resolution and pltebx]')
     parser.add_argument('--r2ghidra', dest='r2',default=None,
                     help='r2ghidra command line <SYM> is symbol to decompile, <C_OUT> is decompile out file')
+    parser.add_argument('--log-level', dest='log_level',default="INFO",type=str.upper,choices=LOG_LEVELS,
+                    help='verbosity of the pipeline stage logs (--debug implies DEBUG)')
+    parser.add_argument('--log-json', dest='log_json',default=None,
+                    help='also append every log record as a JSON line to this file')
+    parser.add_argument('--ida-path', dest='ida_path',default=None,
+                    help='path to the idat binary (default: $IDA_BASE_DIR/idat, else '+IDA_DEFAULT_PATH+')')
+    parser.add_argument('--shard', dest='shard',default=None,type=parse_shard,
+                    help='i/N: only process the targets whose binary path hashes to shard i (0 <= i < N), '+
+                         'see prd_shards.py to merge the shards')
+    parser.add_argument('--tool-limit', dest='tool_limits',default=[],action='append',
+                    help='tool=N, at most N concurrent runs of an external tool (default: idat=1, others #cpus)')
+    parser.add_argument('--tool-timeout', dest='tool_timeouts',default=[],action='append',
+                    help='tool=SECONDS, kill an external tool run after this long (default: no timeout)')
+    parser.add_argument('--pipeline-depth', dest='pipeline_depth',default=PIPELINE_DEPTH,type=int,
+                    help='functions decompiled ahead of the one being cleaned up, 0 runs every stage in turn '+
+                         f'(default: {PIPELINE_DEPTH})')
+    parser.add_argument('--compile-check', dest='compile_check',
+                    default=False,action='store_const',const=True,
+                    help='compile each written target in the background, record the diagnostics in its prd_info.json '+
+                         'and retry the functions with errors with --r2ghidra')
+    parser.add_argument('--compile-check-flags', dest='compile_check_flags',default=COMPILE_CHECK_FLAGS,
+                    help=f'compiler flags of the compile check, as one string (default: --compile-check-flags="{COMPILE_CHECK_FLAGS}")')
+    parser.add_argument('--no-validate', dest='validate',
+                    default=True,action='store_false',
+                    help="with --compile-check: compile every target, even the ones prd_validate.py finds errors in")
+    parser.add_argument('--pch', dest='pch',
+                    default=False,action='store_const',const=True,
+                    help=f'include the target headers through {PCH_HEADER} and precompile it, prd_include.mk gets the rule to rebuild it')
+    parser.add_argument('--pch-flags', dest='pch_flags',default=CFLAGS_DEFAULT,
+                    help=f'compiler flags of the precompiled header, the same as the target is compiled with (default: --pch-flags="{CFLAGS_DEFAULT}")')
+    parser.add_argument('--split-functions', dest='split_functions',
+                    default=False,action='store_const',const=True,
+                    help='also write the target as a shared header, its globals and one source per decompiled function, '+
+                         'prd_include.mk gets the rules to build them as separate objects')
+    parser.add_argument('--no-incremental', dest='incremental',
+                    default=True,action='store_false',
+                    help=f'process every function again, without reading or writing {INCREMENTAL_CACHE} in the decomp directory')
+    parser.add_argument('--resume', dest='resume',
+                    default=False,action='store_const',const=True,
+                    help=f'skip targets that the run journal ({JOURNAL_NAME} in the output directory) '+
+                         'records as complete, after checking that their outputs are unchanged')
 
     args, unknownargs = parser.parse_known_args()
+    ida_path=args.ida_path if args.ida_path else default_ida_path()
+    if not os.path.isfile(ida_path):
+        print("ERROR: Environmental variable IDA_BASE_DIR is not set or '"+ida_path+"' does not exist")
+        import sys
+        sys.exit(-1)
     global DEBUG
     DEBUG=args.debug
+    configure_logging("DEBUG" if args.debug else args.log_level,args.log_json)
+    configure_runner(parse_tool_values(args.tool_limits),parse_tool_values(args.tool_timeouts,float))
     if not os.path.exists(args.decompdir):
         os.makedirs(args.decompdir) # make sure that the decomp dir exists before using it
-    gpd = GenprogDecomp(args.target_list, args.scriptpath, args.ouput_directory,args.detfn_prefix,args.r2,args.strip,args.decompdir,args.version2)
+    gpd = GenprogDecomp(args.target_list, args.scriptpath, args.ouput_directory,args.detfn_prefix,args.r2,args.strip,args.decompdir,args.version2,args.resume,ida_path,args.shard,args.pipeline_depth,
+        args.compile_check_flags if args.compile_check else None,args.pch_flags if args.pch else None,
+        args.split_functions,args.validate,args.incremental)
     gpd.get_target_info(args.decompdir)
     gpd.run()
     import sys;sys.exit(0);
 
-main()
+if __name__ == "__main__":
+    main()
 
 
 # idascript line
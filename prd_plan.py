@@ -0,0 +1,99 @@
+import copy
+import os
+import shutil
+from collections import OrderedDict
+
+# planning of a multi-target run
+#  - target_list often has several lines for the same binary with overlapping function lists
+#  - targets are grouped by binary, with one typedef job (IDA type dump + type resolution) per binary
+#    and one decompile job per (binary, function)
+#  - the first target that needs a job runs it, the following ones get its result (and a copy of the
+#    files it left in the decomp directory, so every target's decomp directory stays complete)
+#  - a binary's results are dropped once its last target is done
+
+# files a job leaves in the target's decomp directory
+JOB_FILES={
+    'typedefs':lambda arg: ["typedefs.h"],
+    'resolve_types':lambda arg: ["resolved-typedefs.h","recovered-types.txt"],
+    'cleanup_typedefs':lambda arg: [],
+    'decompile':lambda arg: [f"{arg.strip()}.c"],
+}
+
+
+class WorkPlan:
+    def __init__(self,targets:list,strip=False):
+        self.strip=strip
+        self.binaries=OrderedDict() # binary => [target, ...]
+        self.decompile_jobs=OrderedDict() # (binary, function) => [target, ...]
+        for TARG in targets:
+            b=self.binary_key(TARG)
+            self.binaries.setdefault(b,list()).append(TARG['target'])
+            for f in TARG['funcList']:
+                self.decompile_jobs.setdefault((b,f.strip()),list()).append(TARG['target'])
+        self.requested={'typedefs':len(targets),'decompile':sum([len(T['funcList']) for T in targets])}
+        self.remaining={b:len(t) for b,t in self.binaries.items()}
+        self.results=dict() # (kind, binary, arg) => (result, decomp dir it was produced in)
+        self.executed=dict()
+        self.reused=dict()
+
+    def binary_key(self,TARG):
+        return (os.path.realpath(TARG['path']),self.strip)
+
+    # whether TARG is the target that runs the job (the first one that needs it)
+    def runs(self,kind:str,TARG,arg):
+        b=self.binary_key(TARG)
+        if kind=='decompile':
+            targets=self.decompile_jobs.get((b,arg.strip()),[])
+        else:
+            targets=self.binaries.get(b,[])
+        return len(targets)>0 and targets[0]==TARG['target']
+
+    # => fn()'s result, computed once per (kind, binary, arg)
+    def run(self,kind:str,TARG,arg,decompdir:str,fn):
+        key=(kind,self.binary_key(TARG),arg)
+        if key in self.results:
+            result,srcdir=self.results[key]
+            self.reused[kind]=self.reused.get(kind,0)+1
+            if os.path.realpath(srcdir)!=os.path.realpath(decompdir):
+                for name in JOB_FILES[kind](arg):
+                    src=os.path.join(srcdir,name)
+                    dst=os.path.join(decompdir,name)
+                    if os.path.exists(src) and not os.path.exists(dst):
+                        shutil.copyfile(src,dst)
+            return copy.deepcopy(result)
+        result=fn()
+        self.executed[kind]=self.executed.get(kind,0)+1
+        self.results[key]=(copy.deepcopy(result),decompdir)
+        return result
+
+    def done(self,TARG):
+        b=self.binary_key(TARG)
+        if b not in self.remaining:
+            return
+        self.remaining[b]-=1
+        if self.remaining[b]<=0:
+            for key in [k for k in self.results.keys() if k[1]==b]:
+                del self.results[key]
+
+    def summary(self):
+        rows=[f" --- Work plan: {sum(self.requested.values())} jobs requested by {self.requested['typedefs']} targets"]
+        rows.append(f"     - {len(self.binaries)} distinct binaries => {len(self.binaries)} typedef jobs"+
+            f" (instead of {self.requested['typedefs']})")
+        rows.append(f"     - {len(self.decompile_jobs)} distinct (binary, function) => {len(self.decompile_jobs)} decompile jobs"+
+            f" (instead of {self.requested['decompile']})")
+        for b,targets in self.binaries.items():
+            if len(targets)>1:
+                rows.append(f"     - {b[0]}: shared by {','.join(targets)}")
+        return "\n".join(rows)
+
+    def report(self):
+        return {'binaries':{b[0]:t for b,t in self.binaries.items()},'requested':self.requested,
+            'planned':{'typedefs':len(self.binaries),'decompile':len(self.decompile_jobs)},
+            'executed':self.executed,'reused':self.reused}
+
+    def saved(self):
+        rows=[f" --- Work plan: reused results instead of running the job again"]
+        for kind in JOB_FILES.keys():
+            if kind in self.executed or kind in self.reused:
+                rows.append(f"     - {kind:<18} ran {self.executed.get(kind,0):>5}, reused {self.reused.get(kind,0):>5}")
+        return "\n".join(rows)
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import copy
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
+
+import prd_multidecomp_ida as prd
+from prd_log import configure_logging, get_logger, LOG_ROOT, LOG_LEVELS
+from prd_instrument import StageStats
+
+# long-running recompilation service
+#  - requests (one JSON object per line) come in over a Unix domain socket, each answered by one JSON line
+#  - per-binary state (symbol tables, typedef dump, resolved types, decompiled functions) is kept in memory,
+#    so repeated requests for the same binary skip the nm/c++filt/unpickling/typedef resolution work
+#  - that state is an LRU bounded by number of binaries and by (estimated) size
+#  - it's keyed by binary and options only, a request for another target gets the files the pipeline would have
+#    written (decompiled functions, typedefs.h, ...) copied into its decompdir
+#  - requests are handled one at a time, the pipeline output of each goes to <output>/<target>/prd_service.log
+#
+# python3 prd_service.py --socket /tmp/prd.sock serve --decompdir /tmp/decomp
+# python3 prd_service.py --socket /tmp/prd.sock recompile <target> <binary> <func:func:...> <output_directory> [--use-new-features]
+# python3 prd_service.py --socket /tmp/prd.sock stats|shutdown
+#
+# request:  {"op":"recompile","target":..,"binary":..,"functions":[mangled,...],"output_directory":..,
+#            "options":{"use_new_features":..,"strip":..,"detour_prefix":..,"r2ghidra":..}}
+#           {"op":"stats"}  {"op":"shutdown"}
+# response: {"ok":true,"outputs":[...],"failures":[...],"timing":{...},"cache":{...}}  or  {"ok":false,"error":..}
+
+SOCKET_DEFAULT="/tmp/prd_service.sock"
+SERVICE_LOG="prd_service.log"
+# items of a large container the size estimate looks at
+SIZE_SAMPLE=64
+
+log_svc=get_logger("service")
+
+
+def text_key(text:str):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+# rough size of a kept value, strings by length and large containers extrapolated from their first items
+#  (serializing every value just to measure it costs about as much as what's memoized)
+def estimate_size(v):
+    if isinstance(v,(str,bytes)):
+        return len(v)
+    if isinstance(v,dict):
+        items=list(islice(v.items(),SIZE_SAMPLE))
+        return len(v)*sum([estimate_size(k)+estimate_size(x) for k,x in items])//max(len(items),1)
+    if isinstance(v,(list,tuple,set,frozenset)):
+        items=list(islice(v,SIZE_SAMPLE))
+        return len(v)*sum([estimate_size(x) for x in items])//max(len(items),1)
+    return sys.getsizeof(v)
+
+
+class BinaryState:
+    # everything the pipeline derives from one binary (and the options it was processed with)
+    def __init__(self,key):
+        self.key=key
+        self.symbols=None # (symbol_dict, mang2demLUT, dem2mangLUT)
+        self.values=dict() # memo key => value
+        self.files=dict() # memo key => files written while computing the value
+        self.size=0
+        self.hits=0
+        self.misses=0
+        self.requests=0
+        # the target's types are worked out in another thread (see GenprogDecomp.start_types)
+        self.lock=threading.Lock()
+
+    # keep(value) decides whether a freshly computed value is kept
+    #  files are the paths computing the value writes, a hit copies the ones written by the request that computed it
+    def memo(self,key,fn,keep=None,files=()):
+        with self.lock:
+            hit=key in self.values
+            if hit:
+                self.hits+=1
+                v=copy.deepcopy(self.values[key])
+                sources=self.files[key]
+            else:
+                self.misses+=1
+        if hit:
+            for src,dst in zip(sources,files):
+                if src!=dst and os.path.exists(src) and not os.path.exists(dst):
+                    shutil.copyfile(src,dst)
+            return v
+        v=fn()
+        if keep is not None and not keep(v):
+            return v
+        kept=copy.deepcopy(v)
+        size=estimate_size(kept)
+        with self.lock:
+            self.values[key]=kept
+            self.files[key]=list(files)
+            self.size+=size
+        return v
+
+    def hit(self):
+        with self.lock:
+            self.hits+=1
+
+    def set_symbols(self,symbol_dict,mang2demLUT,dem2mangLUT):
+        symbols=copy.deepcopy((symbol_dict,mang2demLUT,dem2mangLUT))
+        size=estimate_size(symbols)
+        with self.lock:
+            self.symbols=symbols
+            self.size+=size
+
+    def report(self):
+        with self.lock:
+            return {'binary':self.key[0],'bytes':self.size,'entries':len(self.values),'hits':self.hits,
+                'misses':self.misses,'requests':self.requests}
+
+
+class StateLRU:
+    def __init__(self,max_binaries=8,max_bytes=512*2**20):
+        self.max_binaries=max_binaries
+        self.max_bytes=max_bytes
+        self.states=OrderedDict()
+        self.evictions=0
+
+    # the binary's size and mtime are part of the key, a rebuilt binary gets a fresh state
+    def get(self,binary,options:dict):
+        st=os.stat(binary)
+        key=(os.path.realpath(binary),st.st_size,st.st_mtime_ns,json.dumps(options,sort_keys=True))
+        state=self.states.get(key,None)
+        if state is None:
+            state=self.states[key]=BinaryState(key)
+        self.states.move_to_end(key)
+        return state
+
+    def total_bytes(self):
+        return sum([s.size for s in self.states.values()])
+
+    # called once a request is done, the most recently used state always stays
+    def evict(self):
+        while len(self.states)>1 and (len(self.states)>self.max_binaries or self.total_bytes()>self.max_bytes):
+            key,state=self.states.popitem(last=False)
+            self.evictions+=1
+            log_svc.info("evicting %s (%d bytes)",key[0],state.size)
+
+    def report(self):
+        return {'binaries':len(self.states),'bytes':self.total_bytes(),'max_binaries':self.max_binaries,
+            'max_bytes':self.max_bytes,'evictions':self.evictions,'states':[s.report() for s in reversed(self.states.values())]}
+
+
+class CachingIDAWrapper(prd.IDAWrapper):
+    def __init__(self,typedefScriptPath,ida_path,state:BinaryState):
+        super().__init__(typedefScriptPath,ida_path)
+        self.state=state
+
+    # no idat job for what's already memoized (its files are copied in when it's used)
+    def prefetch_typedefs(self,binary_path,output):
+        if any([('get_typedef_mappings',u) in self.state.values for u in (False,True)]):
+            return
+        super().prefetch_typedefs(binary_path,output)
+
+    def prefetch_func(self,binary_path,func:str,decompdir:str):
+        if ('decompile_func',func.strip()) in self.state.values:
+            return
+        super().prefetch_func(binary_path,func,decompdir)
+
+    def get_typedef_mappings(self,binary_path,output,use_new_features=False):
+        return self.state.memo(('get_typedef_mappings',use_new_features),
+            lambda: super(CachingIDAWrapper,self).get_typedef_mappings(binary_path,output,use_new_features),
+            files=[f"{output}/typedefs.h"])
+
+    def decompile_func(self,binary_path,func:str,decompdir:str):
+        # a failed decompilation is retried by the next request
+        return self.state.memo(('decompile_func',func.strip()),
+            lambda: super(CachingIDAWrapper,self).decompile_func(binary_path,func,decompdir),keep=lambda code: code!="",
+            files=[f"{decompdir}/{func.strip()}.c"])
+
+
+class CachingCodeCleaner(prd.CodeCleaner):
+    def __init__(self,state:BinaryState):
+        super().__init__()
+        self.state=state
+
+    def resolve_type_order(self,structDump,output):
+        return self.state.memo(('resolve_type_order',text_key(structDump)),
+            lambda: super(CachingCodeCleaner,self).resolve_type_order(structDump,output),
+            files=[f"{output}/resolved-typedefs.h",f"{output}/recovered-types.txt"])
+
+    def cleanup_typedefs(self,typedefLines):
+        return self.state.memo(('cleanup_typedefs',text_key(typedefLines)),
+            lambda: super(CachingCodeCleaner,self).cleanup_typedefs(typedefLines))
+
+
+class ServiceDecomp(prd.GenprogDecomp):
+    def __init__(self,state:BinaryState,ouput_directory,entryfn_prefix,r2ghidra,strip,decompdir,use_new_features,ida_path,scriptpath):
+        super().__init__(None,scriptpath,ouput_directory,entryfn_prefix,r2ghidra,strip,decompdir,use_new_features,False,ida_path)
+        self.state=state
+
+    def get_symbols(self,binary_path,workdir):
+        if self.state.symbols is None:
+            symbol_dict=super().get_symbols(binary_path,workdir)
+            self.state.set_symbols(symbol_dict,self.mang2demLUT,self.dem2mangLUT)
+            return symbol_dict
+        self.state.hit()
+        symbol_dict,self.mang2demLUT,self.dem2mangLUT=copy.deepcopy(self.state.symbols)
+        return symbol_dict
+
+
+class RecompilationService:
+    def __init__(self,decompdir="/tmp/decomp",scriptpath="get_ida_details.py",ida_path=None,
+                 max_binaries=8,max_bytes=512*2**20):
+        self.decompdir=os.path.abspath(decompdir)
+        self.scriptpath=scriptpath
+        self.ida_path=ida_path
+        self.cache=StateLRU(max_binaries,max_bytes)
+        self.served=0
+        self.started=time.time()
+
+    def recompile(self,req:dict):
+        target=req['target']
+        binary=req['binary']
+        functions=req['functions']
+        if isinstance(functions,str):
+            functions=functions.split(":")
+        outdir=os.path.abspath(req['output_directory'])
+        opts=req.get('options',dict())
+        options={'use_new_features':bool(opts.get('use_new_features',False)),'strip':bool(opts.get('strip',False)),
+            'detour_prefix':opts.get('detour_prefix',"det_"),'r2ghidra':opts.get('r2ghidra',None)}
+
+        t0=time.perf_counter()
+        state=self.cache.get(binary,options)
+        state.requests+=1
+        hits,misses=state.hits,state.misses
+        success=[]
+        failure=[]
+        outputs=None
+        logf=os.path.join(outdir,target,SERVICE_LOG)
+        os.makedirs(os.path.dirname(logf),exist_ok=True)
+        # a failed request is served too, and the state it added still counts against the bounds
+        try:
+            with open(logf,"w") as f, redirect_output(f):
+                gpd=ServiceDecomp(state,outdir,options['detour_prefix'],options['r2ghidra'],options['strip'],self.decompdir,
+                    options['use_new_features'],self.ida_path,self.scriptpath)
+                idaw=CachingIDAWrapper(self.scriptpath,self.ida_path,state)
+                cleaner=CachingCodeCleaner(state)
+                if not os.path.exists(os.path.join(self.decompdir,target)):
+                    os.makedirs(os.path.join(self.decompdir,target))
+                TARG=gpd.add_target(target,binary," ".join(functions),self.decompdir)
+                if TARG is not None:
+                    try:
+                        outputs=gpd.run_target(TARG,idaw,cleaner,success,failure)
+                    finally:
+                        TARG['stats'].write(os.path.join(outdir,target,prd.STATS_NAME))
+        finally:
+            self.served+=1
+            self.cache.evict()
+        failures=[list(x) for x in gpd.target_failures+failure]
+        stats=TARG['stats'] if TARG is not None else StageStats(target)
+        resp={'ok':outputs is not None,'target':target,'outputs':outputs if outputs else [],'failures':failures,
+            'log':logf,
+            'timing':{'wall':time.perf_counter()-t0,'stages':{k:v['wall'] for k,v in stats.stages.items()}},
+            'cache':{'hits':state.hits-hits,'misses':state.misses-misses,'state_bytes':state.size,
+                'requests_for_binary':state.requests}}
+        if outputs is None:
+            resp['error']=failures[0][-1] if failures else "none of the functions could be decompiled"
+        return resp
+
+    def stats(self):
+        return {'ok':True,'served':self.served,'uptime':time.time()-self.started,'cache':self.cache.report()}
+
+    def handle(self,req:dict):
+        op=req.get('op','recompile')
+        if op=='recompile':
+            return self.recompile(req)
+        elif op=='stats':
+            return self.stats()
+        elif op=='shutdown':
+            return {'ok':True,'shutdown':True}
+        return {'ok':False,'error':f"unknown op '{op}'"}
+
+    def serve(self,socket_path):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen(8)
+        log_svc.info("listening on %s",socket_path)
+        running=True
+        try:
+            while running:
+                conn,_=server.accept()
+                with conn, conn.makefile('rwb') as stream:
+                    for line in stream:
+                        if not line.strip():
+                            continue
+                        try:
+                            resp=self.handle(json.loads(line))
+                        except Exception as e:
+                            log_svc.exception("request failed")
+                            resp={'ok':False,'error':f"{type(e).__name__}: {e}"}
+                        stream.write((json.dumps(resp)+"\n").encode())
+                        stream.flush()
+                        if resp.get('shutdown'):
+                            running=False
+                            break
+        finally:
+            server.close()
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+# the pipeline prints and logs a lot, send both to the request's log file
+@contextlib.contextmanager
+def redirect_output(f):
+    handlers=[h for h in logging.getLogger(LOG_ROOT).handlers if type(h) is logging.StreamHandler]
+    streams=[h.setStream(f) for h in handlers]
+    try:
+        with contextlib.redirect_stdout(f):
+            yield
+    finally:
+        for h,s in zip(handlers,streams):
+            h.setStream(s)
+
+
+def send_request(socket_path,req:dict):
+    with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        with s.makefile('rwb') as stream:
+            stream.write((json.dumps(req)+"\n").encode())
+            stream.flush()
+            return json.loads(stream.readline())
+
+
+def main():
+    parser=argparse.ArgumentParser(description='Recompilation service over a Unix domain socket')
+    parser.add_argument('--socket',default=SOCKET_DEFAULT,help='path of the Unix domain socket')
+    sub=parser.add_subparsers(dest='cmd')
+    serve=sub.add_parser('serve',help='run the service')
+    serve.add_argument('--decompdir',default="/tmp/decomp",help='path to store raw decompiled content')
+    serve.add_argument('--scriptpath',default="get_ida_details.py",help='path to idascript')
+    serve.add_argument('--ida-path',dest='ida_path',default=None,help='path to the idat binary')
+    serve.add_argument('--max-binaries',type=int,default=8,help='binaries whose state is kept in memory')
+    serve.add_argument('--max-mb',type=float,default=512,help='bound on the (estimated) size of the kept state')
+    serve.add_argument('--log-level',dest='log_level',default="INFO",type=str.upper,choices=LOG_LEVELS)
+    rec=sub.add_parser('recompile',help='send one recompile request')
+    rec.add_argument('target')
+    rec.add_argument('binary')
+    rec.add_argument('functions',help='colon separated (mangled) function symbols')
+    rec.add_argument('ouput_directory')
+    rec.add_argument('--use-new-features',dest='version2',default=False,action='store_const',const=True)
+    rec.add_argument('--strip-binary',dest='strip',default=False,action='store_const',const=True)
+    rec.add_argument('--detour-prefix',dest='detfn_prefix',default="det_")
+    rec.add_argument('--r2ghidra',dest='r2',default=None)
+    sub.add_parser('stats',help='print the service statistics')
+    sub.add_parser('shutdown',help='stop the service')
+    args=parser.parse_args()
+
+    if args.cmd=='serve':
+        configure_logging(args.log_level)
+        if not os.path.exists(args.decompdir):
+            os.makedirs(args.decompdir)
+        svc=RecompilationService(args.decompdir,args.scriptpath,args.ida_path,args.max_binaries,int(args.max_mb*2**20))
+        svc.serve(args.socket)
+        return
+    if args.cmd=='recompile':
+        req={'op':'recompile','target':args.target,'binary':os.path.abspath(args.binary),
+            'functions':args.functions.split(":"),'output_directory':os.path.abspath(args.ouput_directory),
+            'options':{'use_new_features':args.version2,'strip':args.strip,'detour_prefix':args.detfn_prefix,'r2ghidra':args.r2}}
+    elif args.cmd in ('stats','shutdown'):
+        req={'op':args.cmd}
+    else:
+        parser.print_help()
+        sys.exit(-1)
+    resp=send_request(args.socket,req)
+    print(json.dumps(resp,indent=1))
+    if not resp.get('ok'):
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
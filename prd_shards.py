@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+
+from prd_instrument import StageStats
+
+# sharded runs of a target list
+#  - 'prd_multidecomp_ida.py ... --shard i/N' only processes the target lines whose binary path hashes to shard i
+#    (0 <= i < N), so every line for the same binary lands in the same shard and the work plan can still share
+#    its typedef/decompile jobs
+#  - shards can run on different machines, or as several processes with the same output directory: each shard
+#    writes its own prd_summary/prd_stats/prd_plan files (with a '.shard-i-of-N' suffix)
+#  - 'merge' combines the per-shard files into one report, 'local' runs N shards here and merges them
+#
+# python3 prd_shards.py local 4 target_list out/ --use-new-features
+# python3 prd_shards.py merge out/
+
+SUMMARY_NAME="prd_summary.json"
+SHARD_LOG="prd_run.log"
+SHARD_RE=re.compile(r"\.shard-(\d+)-of-(\d+)\.")
+
+
+def parse_shard(spec:str):
+    m=re.match(r"^\s*(\d+)\s*/\s*(\d+)\s*$",spec)
+    if not m or int(m.group(2))<=0 or int(m.group(1))>=int(m.group(2)):
+        raise ValueError(f"invalid shard '{spec}', expected i/N with 0 <= i < N")
+    return int(m.group(1)),int(m.group(2))
+
+
+# same binary => same shard, on every machine and python version (not hash(), it's salted)
+#  keyed by the real path like the work plan, a binary reached through a symlink or another spelling isn't split
+def shard_of(path:str,count:int):
+    h=hashlib.sha1(os.path.realpath(path.strip()).encode()).digest()
+    return int.from_bytes(h[:8],'big')%count
+
+
+# prd_stats.json => prd_stats.shard-1-of-4.json
+def shard_name(name:str,shard=None):
+    if shard is None:
+        return name
+    base,ext=os.path.splitext(name)
+    return f"{base}.shard-{shard[0]}-of-{shard[1]}{ext}"
+
+
+def find_shards(outdir:str,count=None):
+    # => {index: summary} for the shard summaries of one shard count
+    found=dict()
+    for p in glob.glob(os.path.join(outdir,shard_name(SUMMARY_NAME,("*","*")))):
+        m=SHARD_RE.search(os.path.basename(p))
+        if not m:
+            continue
+        found.setdefault(int(m.group(2)),dict())[int(m.group(1))]=p
+    if len(found)==0:
+        raise ValueError(f"no shard summaries in {outdir}")
+    if count is None:
+        if len(found)>1:
+            raise ValueError(f"summaries for several shard counts in {outdir} ({','.join([str(x) for x in sorted(found)])}), pick one")
+        count=list(found.keys())[0]
+    summaries=dict()
+    for i,p in sorted(found.get(count,dict()).items()):
+        with open(p,'r') as f:
+            summaries[i]=json.load(f)
+    return count,summaries
+
+
+def merge_plans(plans:list):
+    merged={'binaries':dict(),'requested':dict(),'planned':dict(),'executed':dict(),'reused':dict()}
+    for p in plans:
+        merged['binaries'].update(p.get('binaries',dict()))
+        for k in ['requested','planned','executed','reused']:
+            for kind,n in p.get(k,dict()).items():
+                merged[k][kind]=merged[k].get(kind,0)+n
+    return merged
+
+
+# ToolRunner reports (prd_exec.py) => counters summed, max_running is the largest of any shard
+def merge_tools(reports:list):
+    merged=dict()
+    for r in reports:
+        for tool,s in r.items():
+            m=merged.setdefault(tool,dict())
+            for k,v in s.items():
+                m[k]=max(m.get(k,0),v) if k=='max_running' else m.get(k,0)+v
+    return merged
+
+
+def merge(outdir:str,count=None):
+    count,summaries=find_shards(outdir,count)
+    missing=[i for i in range(count) if i not in summaries]
+    stats=StageStats("run")
+    merged={'shards':count,'missing_shards':missing,'targets':[],'success':[],'failure':[],'resumed':[],
+        'decomp_failures':0,'target_failures':0}
+    for i,s in sorted(summaries.items()):
+        for k in ['targets','success','failure','resumed']:
+            merged[k]+=s.get(k,[])
+        merged['decomp_failures']+=s.get('decomp_failures',0)
+        merged['target_failures']+=s.get('target_failures',0)
+        stats.merge(StageStats.from_report(s.get('stats',dict())))
+    merged['plan']=merge_plans([s['plan'] for s in summaries.values() if s.get('plan')])
+    merged['tools']=merge_tools([s['tools'] for s in summaries.values() if s.get('tools')])
+    # --compile-check results, a target is only in one shard
+    merged['compile_check']=dict()
+    for s in summaries.values():
+        merged['compile_check'].update(s.get('compile_check',dict()))
+    merged['stats']=stats.report()
+
+    print(f" MERGED {len(summaries)} of {count} SHARDS")
+    if missing:
+        print(" --- missing shards: %s" % ",".join([str(i) for i in missing]))
+    print(" --- %d binaries successesful recompiled" % len(merged['success']))
+    for s in merged['success']:
+        print("     - ", tuple(s))
+    print(" --- %d binaries failed" % len(merged['failure']))
+    for f in merged['failure']:
+        print("     - ", tuple(f))
+    if len(merged['resumed'])>0:
+        print(" --- %d of them were already complete (--resume)" % len(merged['resumed']))
+    print("="*100)
+    if len(stats.stages)>0:
+        print(stats.summary(" STAGE TIMINGS (all shards)"))
+        print("="*100)
+    with open(os.path.join(outdir,SUMMARY_NAME),'w') as f:
+        json.dump(merged,f,indent=1)
+    stats.write(os.path.join(outdir,"prd_stats.json"))
+    return merged
+
+
+def run_local(count:int,prd_args:list,outdir:str):
+    # N shards as N processes on this machine, all writing to the same output directory
+    script=os.path.join(os.path.dirname(os.path.realpath(__file__)),"prd_multidecomp_ida.py")
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    procs=[]
+    for i in range(count):
+        log=open(os.path.join(outdir,shard_name(SHARD_LOG,(i,count))),'w')
+        cmd=[sys.executable,script]+prd_args+["--shard",f"{i}/{count}"]
+        print("Running: "," ".join(cmd),flush=True)
+        procs.append((i,subprocess.Popen(cmd,stdout=log,stderr=subprocess.STDOUT),log))
+    for i,p,log in procs:
+        ret=p.wait()
+        log.close()
+        print(f"shard {i}/{count} exited with {ret}",flush=True)
+    return merge(outdir,count)
+
+
+def main():
+    parser=argparse.ArgumentParser(description='Sharded runs of prd_multidecomp_ida.py')
+    sub=parser.add_subparsers(dest='cmd')
+    m=sub.add_parser('merge',help='merge the shard summaries of an output directory')
+    m.add_argument('ouput_directory')
+    m.add_argument('--shards',type=int,default=None,help='shard count to merge (default: the only one found)')
+    l=sub.add_parser('local',help='run N shards as local processes, then merge them')
+    l.add_argument('shards',type=int)
+    l.add_argument('target_list')
+    l.add_argument('ouput_directory')
+    args,prd_args=parser.parse_known_args()
+    if args.cmd=='merge':
+        merged=merge(args.ouput_directory,args.shards)
+    elif args.cmd=='local':
+        merged=run_local(args.shards,[args.target_list,args.ouput_directory]+prd_args,args.ouput_directory)
+    else:
+        parser.print_help()
+        sys.exit(-1)
+    if merged['missing_shards'] or merged['decomp_failures']>0 or merged['target_failures']>0:
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import re
+
+# splitting of a generated translation unit into a shared header and several sources (--split-functions)
+#  - at file level the generated code only has preprocessor lines, comments, type definitions, prototypes,
+#    variable definitions and function definitions, so a statement scanner that tracks braces and
+#    parentheses is enough (no C parser)
+#  - the header gets the preprocessor lines, types and prototypes (moved), plus an extern declaration for
+#    every variable and a prototype for every function the source keeps defining; static ones stay private
+#  - conditionals (#if ... #endif) go to both, so what they guard stays guarded
+
+KEYWORDS_BEFORE_PAREN={'if','while','for','switch','return','sizeof','__attribute__','__asm__','asm','__declspec'}
+CONDITIONAL_RE=re.compile(r"^\s*#\s*(if|ifdef|ifndef|elif|else|endif)\b")
+
+
+# code without its string/char literals and // comments, for counting braces and parentheses
+def code_of(text:str):
+    text=re.sub(r'"(\\.|[^"\\\n])*"|\'(\\.|[^\'\\\n])*\'',"\"\"",text)
+    return "\n".join([line.split("//",1)[0] for line in text.split("\n")])
+
+
+def statements(text:str):
+    # => [(kind, text)], kind: 'blank' (blank lines and comments), 'pp', 'function', 'statement'
+    result=[]
+    pending=[]
+    depth=0
+    parens=0
+    braced=False
+    in_comment=False
+    for line in text.splitlines(keepends=True):
+        s=line.strip()
+        if len(pending)==0:
+            if in_comment or s=="" or s.startswith("//") or s.startswith("/*"):
+                in_comment=(in_comment or s.startswith("/*")) and "*/" not in s
+                result.append(('blank',line))
+                continue
+            if s.startswith("#"):
+                # continued lines stay with their directive
+                if len(result)>0 and result[-1][0]=='pp' and result[-1][1].rstrip().endswith("\\"):
+                    result[-1]=('pp',result[-1][1]+line)
+                else:
+                    result.append(('pp',line))
+                continue
+        pending.append(line)
+        code=code_of(line)
+        for c in code:
+            if c=="{":
+                depth+=1
+                braced=True
+            elif c=="}":
+                depth-=1
+            elif c=="(":
+                parens+=1
+            elif c==")":
+                parens-=1
+        if depth>0 or parens>0:
+            continue
+        stmt="".join(pending)
+        if braced and not code.rstrip().endswith(";"):
+            head=code_of(stmt.split("{",1)[0]).rstrip()
+            if head.endswith(")"):
+                result.append(('function',stmt))
+                pending,braced=[],False
+            # else a type or an initializer, it goes on until its ';'
+            continue
+        if code.rstrip().endswith(";"):
+            result.append(('statement',stmt))
+            pending,braced=[],False
+    if len(pending)>0:
+        result.append(('statement',"".join(pending)))
+    return result
+
+
+def storage(stmt:str):
+    words=re.findall(r"[A-Za-z_]\w*",code_of(stmt.lstrip()))
+    return [w for w in words[:3] if w in ('static','extern','typedef','inline','__inline__','__inline')]
+
+
+# a prototype: the first '(' follows the declared name (not '*' as in 'int *(p);', nor a '(*name)' declarator)
+def is_prototype(stmt:str):
+    code=re.sub(r"__attribute__\s*\(\(.*?\)\)","",code_of(stmt))
+    if "=" in code.split("(",1)[0]:
+        return False
+    m=re.search(r"([A-Za-z_]\w*)\s*\(\s*(\*?)",code)
+    return m is not None and m.group(1) not in KEYWORDS_BEFORE_PAREN and m.group(2)=="" and \
+        re.match(r"^\s*(struct|union|enum)\b[^{]*\{",code) is None
+
+
+# 'int a = 1, *b = NULL;' => 'extern int a, *b;'
+def extern_declaration(stmt:str):
+    out=[]
+    depth=0
+    skipping=False
+    i=0
+    text=stmt.rstrip()
+    while i<len(text):
+        c=text[i]
+        if c in "\"'":
+            j=i+1
+            while j<len(text) and text[j]!=c:
+                j+=2 if text[j]=="\\" else 1
+            if not skipping:
+                out.append(text[i:j+1])
+            i=j+1
+            continue
+        if c in "({[":
+            depth+=1
+        elif c in ")}]":
+            depth-=1
+        elif depth==0 and c=="=":
+            skipping=True
+        elif depth==0 and c in ",;":
+            skipping=False
+        if not skipping:
+            out.append(c)
+        i+=1
+    decl="".join(out)
+    decl=re.sub(r"\s+([,;])",r"\1",decl)
+    return "extern "+decl.lstrip()+"\n"
+
+
+def prototype_of(function:str):
+    return function.split("{",1)[0].rstrip()+";\n"
+
+
+# => (header text, source text)
+def split_declarations(text:str):
+    header=[]
+    source=[]
+    for kind,stmt in statements(text):
+        if kind=='blank':
+            source.append(stmt)
+            continue
+        if kind=='pp':
+            header.append(stmt)
+            if CONDITIONAL_RE.match(stmt):
+                source.append(stmt)
+            continue
+        st=storage(stmt)
+        if kind=='function':
+            if 'static' not in st and 'inline' not in st and '__inline__' not in st:
+                header.append(prototype_of(stmt))
+            source.append(stmt)
+        elif 'typedef' in st or 'extern' in st or is_prototype(stmt) or \
+                re.match(r"^\s*(struct|union|enum)\b[^=]*\}\s*;\s*$",code_of(stmt.replace("\n"," "))):
+            header.append(stmt)
+        elif 'static' in st:
+            source.append(stmt)
+        else:
+            header.append(extern_declaration(stmt))
+            source.append(stmt)
+    return "".join(header),"".join(source)
+
+
+def source_name(target:str,function:str):
+    return f"{target}_fn_{re.sub(r'[^A-Za-z0-9_]','_',function)}.c"
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+import argparse
+import bisect
+import json
+import os
+import re
+import sys
+import time
+
+from prd_exec import ToolResult
+from prd_split import KEYWORDS_BEFORE_PAREN, is_prototype
+
+# structural checks of a generated translation unit, before spending a gcc run on it (milliseconds, no parser)
+#  - comments and literals: a /* comment that is never closed, or closed early so that its '*/' is left over
+#    (replace_data_defines_list wraps the replaced data in /* */), a string or char literal left open
+#  - braces, parentheses and brackets: which one isn't matched, and the line it is on
+#  - functions: defined twice, or declared with different types (identical repeated prototypes are warnings)
+#  - types: a type typedef_resolution removed ('// <type> | ...' lines in resolved-types.h) that is still used
+#    and not defined anywhere else
+# the local headers the source includes ("...") are checked too, the system ones aren't read
+# => the same diagnostics as prd_compile.parse_diagnostics ({'file','line','column','severity','message'})
+# prd_compile.py --validate and prd_multidecomp_ida.py --compile-check don't run gcc on a source with errors
+#
+# python3 prd_validate.py recompiled/T1/T1_recomp.c ...    (gcc-style output, exit status 1 on errors)
+
+LITERAL_RE=re.compile(r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'',re.S)
+PREPROCESSOR_RE=re.compile(r"^[ \t]*#(?:[^\n]*\\\n)*[^\n]*",re.M)
+INCLUDE_RE=re.compile(r'^[ \t]*#[ \t]*include[ \t]*"([^"]+)"',re.M)
+DEFINE_RE=re.compile(r"^[ \t]*#[ \t]*define[ \t]+([A-Za-z_]\w*)[ \t]+\(?([\w \t\*]+?)\)?[ \t]*$",re.M)
+REMOVED_TYPE_RE=re.compile(r"^// ([A-Za-z_]\w*) \| (.*)$",re.M)
+ATTRIBUTE_RE=re.compile(r"__attribute__\s*\(\(.*?\)\)")
+TAG_RE=re.compile(r"\b(struct|union|enum)\s+([A-Za-z_]\w*)\s*\{")
+IDENT_RE=re.compile(r"[A-Za-z_]\w*")
+PAIRS={')':'(',']':'[','}':'{'}
+IGNORED_WORDS={'static','extern','inline','__inline','__inline__','register','__cdecl','__stdcall','__fastcall',
+    '__thiscall','__noreturn','_Noreturn'}
+BASE_TYPES={'void','char','short','int','long','float','double','signed','unsigned','_Bool','const','volatile',
+    'struct','union','enum','__int8','__int16','__int32','__int64'}
+CANONICAL_TYPES=[(re.compile(a),b) for a,b in [(r"\bsigned (char)\b",r"__signed_\1"),
+    (r"\bunsigned\b(?! (char|short|int|long))","unsigned int"),(r"\bsigned\b(?! (short|int|long))","int"),(r"\bsigned ",""),
+    (r"\b(short|long|long long) int\b",r"\1"),(r"__signed_",r"signed ")]]
+CALL_RE=re.compile(r"\b([A-Za-z_]\w*)\s*\(")
+TAGGED_END_RE=re.compile(r"\b(?:struct|union|enum)\s+([A-Za-z_]\w*)\s*$")
+
+
+def diagnostic(path,line,severity,message):
+    return {'file':path,'line':line,'column':None,'severity':severity,'message':message}
+
+
+def format_diagnostics(diags:list):
+    return "".join([f"{d['file']}:{d['line']}: {d['severity']}: {d['message']}\n" for d in diags])
+
+
+# the text with its comments, literals and preprocessor lines blanked out (same length, same lines)
+#  => (code, [(offset, severity, message)])
+def blank(text:str):
+    def spaces(m):
+        return re.sub(r"[^\n]"," ",m.group(0))
+    problems=[]
+    code=LITERAL_RE.sub(spaces,text)
+    i=code.find("/*")
+    if i>=0:
+        problems.append((i,'error',"unterminated comment"))
+        code=code[:i]+re.sub(r"[^\n]"," ",code[i:])
+    for m in re.finditer(r"\*/",code):
+        problems.append((m.start(),'error',"stray '*/' (the comment was closed before it)"))
+    code=PREPROCESSOR_RE.sub(spaces,code)
+    for m in re.finditer(r"[\"'][^\n]*",code):
+        problems.append((m.start(),'error',f"missing terminating {m.group(0)[0]} character"))
+        break
+    return code,problems
+
+
+class SourceFile:
+    def __init__(self,path):
+        self.path=path
+        with open(path,'r',errors='replace') as f:
+            self.text=f.read()
+        self.newlines=[m.start() for m in re.finditer("\n",self.text)]
+        self.code,self.problems=blank(self.text)
+        self.found=None
+
+    def line(self,offset):
+        return bisect.bisect_left(self.newlines,offset)+1
+
+    # => [(offset, text)] of the file level statements and function definitions
+    def statements(self):
+        if self.found is not None:
+            return self.found
+        self.found=[]
+        code=self.code
+        depth=0
+        start=0
+        for m in re.finditer(r"[{}();]",code):
+            c=m.group(0)
+            if c in "({":
+                depth+=1
+                continue
+            if c in ")}":
+                depth-=1
+            if depth<0:
+                # unbalanced, reported by brackets()
+                break
+            if depth>0:
+                continue
+            stmt=code[start:m.end()]
+            if c==";" or c=="}" and ATTRIBUTE_RE.sub("",stmt.split("{",1)[0]).rstrip().endswith(")"):
+                text=stmt.lstrip()
+                self.found.append((m.end()-len(text),text))
+                start=m.end()
+        return self.found
+
+    # the first unmatched bracket (the innermost unclosed one at the end) => [(offset, message)]
+    def brackets(self):
+        stack=[]
+        for m in re.finditer(r"[(){}\[\]]",self.code):
+            c=m.group(0)
+            if c in "({[":
+                stack.append((c,m.start()))
+            elif len(stack)==0:
+                return [(m.start(),f"unmatched '{c}'")]
+            elif stack[-1][0]!=PAIRS[c]:
+                o,at=stack[-1]
+                return [(m.start(),f"'{c}' closes the '{o}' opened at line {self.line(at)}")]
+            else:
+                stack.pop()
+        return [(at,f"'{o}' is never closed") for o,at in stack[-1:]]
+
+
+# the text after a '(' => [parameter, ...] up to the matching ')'
+def parameters(text:str):
+    parts=[]
+    depth=0
+    current=""
+    for c in text:
+        if c==")" and depth==0:
+            break
+        if c=="," and depth==0:
+            parts.append(current)
+            current=""
+            continue
+        depth+=(c in "([")-(c in ")]")
+        current+=c
+    parts.append(current)
+    return [p for p in parts if p.strip()!=""]
+
+
+def function_name(stmt:str):
+    for m in re.finditer(r"([A-Za-z_]\w*)\s*\(",ATTRIBUTE_RE.sub("",stmt)):
+        if m.group(1) not in KEYWORDS_BEFORE_PAREN:
+            return m.group(1)
+    return None
+
+
+class Validator:
+    def __init__(self):
+        self.files=[]
+        self.typedefs=set()
+        self.aliases=dict() # typedef/#define name => type
+        self.canonicals=dict() # type => canonical type, once the aliases are all collected
+        self.tags=set()
+        self.removed=dict() # type => (file, line, why)
+        self.declarations=dict() # function => [(file, line, signature, definition)]
+
+    def load(self,path,diags,seen):
+        path=os.path.normpath(path)
+        if path in seen:
+            return
+        seen.add(path)
+        try:
+            f=SourceFile(path)
+        except OSError as e:
+            diags.append(diagnostic(path,1,'fatal error',e.strerror or str(e)))
+            return
+        self.files.append(f)
+        for m in INCLUDE_RE.finditer(f.text):
+            inc=os.path.join(os.path.dirname(path),m.group(1))
+            if not os.path.exists(inc):
+                diags.append(diagnostic(path,f.line(m.start()),'fatal error',f"{m.group(1)}: No such file or directory"))
+                continue
+            self.load(inc,diags,seen)
+
+    def signature(self,stmt:str,name):
+        text=ATTRIBUTE_RE.sub("",stmt.split("{",1)[0])
+        m=next(m for m in CALL_RE.finditer(text) if m.group(1)==name)
+        ret=text[:m.start()]
+        types=[self.param_type(p) for p in parameters(text[m.end():])]
+        if types==["void"]:
+            types=[]
+        elif len(types)==0:
+            # unprototyped, compatible with any parameters
+            types=None
+        return (self.canonical(ret),None if types is None else tuple(types))
+
+    def param_type(self,param:str):
+        p=param.strip()
+        if p=="...":
+            return p
+        p=re.sub(r"\(\s*\*\s*[A-Za-z_]\w*\s*\)","(*)",p)
+        fp=re.match(r"(.*?)\(\*\)\s*\(",p,re.S)
+        if fp:
+            # function pointer: its own parameters are compared by type too
+            return self.canonical(fp.group(1)+"(*)("+",".join([self.param_type(x) for x in parameters(p[fp.end():])])+")")
+        arrays=len(re.findall(r"\[[^\]]*\]",p))
+        p=re.sub(r"\s*\[[^\]]*\]","",p)
+        words=IDENT_RE.findall(p)
+        last=re.search(r"([A-Za-z_]\w*)\s*$",p)
+        if last and len(words)>1 and last.group(1) not in BASE_TYPES and last.group(1) not in self.typedefs and \
+                last.group(1) not in self.aliases and \
+                not TAGGED_END_RE.search(p):
+            p=p[:last.start()]
+        return self.canonical(p+"*"*arrays)
+
+    def canonical(self,t:str):
+        c=self.canonicals.get(t,None)
+        if c is None:
+            c=self.canonicals[t]=self.expand(t)
+        return c
+
+    def expand(self,t:str):
+        words=[w for w in re.findall(r"[A-Za-z_]\w*|\S",t) if w not in IGNORED_WORDS and w!="const"]
+        for _ in range(8):
+            expanded=[]
+            for w in words:
+                expanded+=self.aliases[w] if w in self.aliases else [w]
+            if expanded==words:
+                break
+            words=expanded
+        t=" ".join(words).replace(" *","*").replace("* ","*")
+        for a,b in CANONICAL_TYPES:
+            t=a.sub(b,t)
+        return t.strip()
+
+    def collect(self):
+        for f in self.files:
+            for m in DEFINE_RE.finditer(f.text):
+                self.aliases[m.group(1)]=[w for w in re.findall(r"[A-Za-z_]\w*|\*",m.group(2))]
+            for m in REMOVED_TYPE_RE.finditer(f.text):
+                self.removed.setdefault(m.group(1),(f.path,f.line(m.start()),m.group(2).strip()))
+            for m in TAG_RE.finditer(f.code):
+                self.tags.add(m.group(2))
+            for at,stmt in f.statements():
+                words=IDENT_RE.findall(stmt)
+                if 'typedef' not in words[:3]:
+                    continue
+                fp=re.search(r"\(\s*\*\s*([A-Za-z_]\w*)\s*\)\s*\(",stmt)
+                name=fp.group(1) if fp else (re.findall(r"([A-Za-z_]\w*)\s*(?:\[[^\]]*\]\s*)*;",stmt) or [None])[-1]
+                if name is None:
+                    continue
+                self.typedefs.add(name)
+                body=re.sub(r"^\s*typedef\s+","",stmt.rstrip().rstrip(";"))
+                if fp is None and "{" not in body and "(" not in body:
+                    self.aliases[name]=re.findall(r"[A-Za-z_]\w*|\*",body[:body.rfind(name)])
+                elif fp is not None and "{" not in body:
+                    # typedef int (*cb_t)(int); => cb_t is int(*)(int)
+                    self.aliases[name]=re.findall(r"[A-Za-z_]\w*|\S",self.param_type(body))
+        # what was canonicalized with only some of the aliases
+        self.canonicals.clear()
+
+    def check_declarations(self,diags):
+        for f in self.files:
+            for at,stmt in f.statements():
+                words=IDENT_RE.findall(stmt)
+                definition=stmt.rstrip().endswith("}")
+                if 'typedef' in words[:3] or not definition and not is_prototype(stmt):
+                    continue
+                name=function_name(stmt)
+                if name is None:
+                    continue
+                line=f.line(at)
+                sig=self.signature(stmt,name)
+                for pf,pline,psig,pdef in self.declarations.get(name,[]):
+                    if definition and pdef:
+                        diags.append(diagnostic(f.path,line,'error',f"redefinition of '{name}' (defined at {pf}:{pline})"))
+                        break
+                    if psig[0]!=sig[0] or psig[1] is not None and sig[1] is not None and psig[1]!=sig[1]:
+                        diags.append(diagnostic(f.path,line,'error',f"conflicting types for '{name}' (declared at {pf}:{pline})"))
+                        break
+                    if not definition and not pdef:
+                        diags.append(diagnostic(f.path,line,'warning',f"redundant declaration of '{name}' (declared at {pf}:{pline})"))
+                        break
+                self.declarations.setdefault(name,[]).append((f.path,line,sig,definition))
+
+    def check_removed_types(self,diags):
+        missing={t:v for t,v in self.removed.items() if t not in self.typedefs and t not in self.tags}
+        if len(missing)==0:
+            return
+        use_re=re.compile(r"\b(?:(struct|union|enum)\s+)?("+"|".join([re.escape(t) for t in missing])+r")\b(\s*\*)?")
+        for f in self.files:
+            reported=set()
+            for m in use_re.finditer(f.code):
+                t=m.group(2)
+                # a pointer to an incomplete struct is fine
+                if t in reported or m.group(1) and m.group(3):
+                    continue
+                reported.add(t)
+                pf,pline,why=missing[t]
+                diags.append(diagnostic(f.path,f.line(m.start()),'error',
+                    f"'{t}' is used but was removed by typedef resolution ({pf}:{pline}: {why})"))
+
+    def validate(self,path):
+        diags=[]
+        self.load(path,diags,set())
+        for f in self.files:
+            for at,severity,message in f.problems:
+                diags.append(diagnostic(f.path,f.line(at),severity,message))
+            for at,message in f.brackets():
+                diags.append(diagnostic(f.path,f.line(at),'error',message))
+        self.collect()
+        self.check_declarations(diags)
+        self.check_removed_types(diags)
+        return diags
+
+
+# => diagnostics of the source and the local headers it includes
+def validate(path):
+    return Validator().validate(path)
+
+
+# => a failed ToolResult with the errors (gcc-style, on stderr) when source won't compile, None otherwise
+def doomed(source):
+    t=time.perf_counter()
+    errors=[d for d in validate(source) if d['severity'] in ('error','fatal error')]
+    if len(errors)==0:
+        return None
+    return ToolResult('validate',["prd_validate.py",source],1,b"",format_diagnostics(errors).encode(),time.perf_counter()-t)
+
+
+def main():
+    parser=argparse.ArgumentParser(description='Structural checks of generated C sources (before compiling them)')
+    parser.add_argument('sources',nargs='+')
+    parser.add_argument('--json',action='store_true',help='print the diagnostics as JSON')
+    args=parser.parse_args()
+    result={s:validate(s) for s in args.sources}
+    if args.json:
+        print(json.dumps(result,indent=1))
+    else:
+        for diags in result.values():
+            sys.stdout.write(format_diagnostics(diags))
+    errors=[d for diags in result.values() for d in diags if d['severity'] in ('error','fatal error')]
+    sys.exit(1 if len(errors)>0 else 0)
+
+
+if __name__ == "__main__":
+    main()
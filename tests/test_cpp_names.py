@@ -0,0 +1,51 @@
+import os
+import sys
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import prd_multidecomp_ida as prd
+
+# the C++ => C names generated output has always had, existing Makefiles and detour symbols depend on them
+
+
+def test_transform_std():
+    cleaner=prd.CodeCleaner()
+    for before,after in [('int A::B(int x);','int A___B(int x);'),
+                         ('ns::A::B::C x;','ns::A___B___C x;'),
+                         ('Foo::$1 y;','Foo___1 y;'),
+                         ('int Foo::operator(void);','int Foo___operator(void);'),
+                         ('vector<char *> v;','vector<char *> v;'),
+                         ('Map<Key,Value> m;','Map<Key,Value> m;')]:
+        assert cleaner.transform_std(before)==after
+
+
+def test_transform_cpp():
+    cleaner=prd.CodeCleaner()
+    for before,after in [('int __cdecl _thiscall A::f(A *this);','int __cdecl  A___f(A *this);'),
+                         ('struct _cppobj Foo { int x; };','struct  Foo { int x; };'),
+                         ('vector<char*> v;','vector_char_p_ v;'),
+                         ('list<int> l;','list_int_ l;'),
+                         ('a::b::c z;','a::b___c z;'),
+                         ('vector<char *,std::allocator<char *> > v;','vector<char *,std___allocator<char *> > v;'),
+                         ('Foo::$1 q;','Foo___$1 q;')]:
+        assert cleaner.transform_cpp(before)==after
+
+
+def test_cpp_to_c():
+    cleaner=prd.CodeCleaner()
+    for before,after in [('struct std::pair<int> p;','struct std__pair_int_ p;'),
+                         ('std::vector<char*> v;','std__vector_char_p_ v;'),
+                         ('typedef A::B::C D;','typedef A__B__C D;'),
+                         ('Foo::$E e;','Foo__$E e;'),
+                         ('vector<char *> v;','vector<char *> v;')]:
+        assert cleaner.cpp_to_c(before)==after
+
+
+def test_generated_parts():
+    cleaner=prd.CodeCleaner()
+    # decompiled code and detour names: '::' => '__' before transform_std/transform_cpp
+    assert cleaner.transform_std(prd.cpp_scope('int A::B::C(Foo::$1 x);'))=='int A__B__C(Foo__$1 x);'
+    assert cleaner.transform_cpp(prd.cpp_scope('int _thiscall A::f(vector<char*> v);'))=='int  A__f(vector_char_p_ v);'
+    assert prd.cpp_scope('det_A::B')=='det_A__B'
+    # the resolved types header
+    assert prd.cpp_header('struct Foo::$E1 { int x; }; A::B y;')=='struct Foo__E__E1 { int x; }; A__B y;'
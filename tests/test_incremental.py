@@ -0,0 +1,70 @@
+import os
+import sys
+import pickle
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import prd_multidecomp_ida as prd
+
+# a cached function's delta (written to incremental.pkl) replayed on the state before it => the state after it
+
+
+def new_state():
+    stubs=prd.PrototypeTable()
+    stubs.append("int puts(const char *s);","puts",True,"puts",True)
+    decomp_decls=prd.PrototypeTable(["int f(int a); // idb"])
+    return ({'int g;':'int *(pg);\n'},[],["// data"],stubs,prd.PrototypeTable(),decomp_decls,["// header"],
+        {'patchmain':'main'},{(0,'f','int f();')},{'det_f':{'prototypes':['int f(int a); // idb']}},
+        {'det_f':['int f(int a)']},{'det_f':['int f(int a)','{','}']},
+        {'det_f':{'prototypes':{},'sym2proto':{},'ext_vars':set(),'local_vars':{'v1'}}})
+
+
+def rows(state):
+    return tuple(v.rows() if isinstance(v,prd.PrototypeTable) else v for v in state)
+
+
+def test_nested_changes_round_trip():
+    g=prd.GenprogDecomp.__new__(prd.GenprogDecomp)
+    state=new_state()
+    (dataMap,dataRemoveList,data_decls,stubs,funcHeaders,decomp_decls,header_decls,translate_dict,guessed_protos,
+        stubs_per_func,funcHeaders_per_func,decomp_per_func,dataMap_per_func)=state
+    sizes=g.function_state_sizes(state)
+    # the next function (det_h) appends to the state and replaces a weaker declaration
+    dataMap['int h_data;']='int *(ph_data);\n'
+    data_decls.append("int h_data;")
+    stubs.append("int printf(const char *f, ...);","printf",True,"printf",True)
+    funcHeaders.append("int h(void)","h",False,"h",False)
+    decomp_decls.remove("int f(int a); // idb")
+    n=len(decomp_decls)
+    decomp_decls.extend(["int f(int a);","int h(void);"])
+    header_decls+=["int h(void)"]
+    guessed={(1,'h','int h();')}
+    guessed_protos|=guessed
+    s={'prototypes':['int printf(const char *f, ...);'],'symbols':['printf']}
+    d={'prototypes':{'int h_data;':'int *(ph_data);\n'},'sym2proto':{'h_data':'int h_data;'},'ext_vars':{'h_data'},'local_vars':set()}
+    stubs_per_func['det_h']=s
+    funcHeaders_per_func['det_h']=['int h(void)']
+    decomp_per_func['det_h']=['int h(void)','{','  return 0;','}']
+    dataMap_per_func['det_h']=d
+    translations={'h_1':'h'}
+    translate_dict.update(translations)
+    edits={'dataRemoveList':('replace',[]),'decomp_decls':('extend',decomp_decls.rows(n),["int f(int a); // idb"]),
+        'translate_dict':('update',translations,[]),'guessed_protos':('update',guessed,[]),
+        'stubs_per_func':('update',{'det_h':s},[]),'funcHeaders_per_func':('update',{'det_h':['int h(void)']},[]),
+        'decomp_per_func':('update',{'det_h':decomp_per_func['det_h']},[]),'dataMap_per_func':('update',{'det_h':d},[])}
+    delta=g.function_state_delta(sizes,state,edits)
+    after=pickle.loads(pickle.dumps(rows(state)))
+    # the state keeps changing in place once the function is done, the cached delta must not
+    s['prototypes'].append('void exit(int status);')
+    d['local_vars'].add('v2')
+    decomp_per_func['det_h'][2]='  return 1;'
+    stubs_per_func['det_f']['prototypes'].clear()
+    cached=pickle.loads(pickle.dumps({'function':'h','delta':delta}))
+    replayed=g.apply_function_state_delta(new_state(),cached['delta'])
+    assert rows(replayed)==after
+    assert replayed[11]['det_h'][2]=='  return 0;'
+    assert replayed[12]['det_h']['local_vars']==set()
+    assert replayed[5].find_symbol('f')==['int f(int a);']
+    # replaying doesn't change the cached delta either
+    replayed[9]['det_h']['prototypes'].append('int puts(const char *s);')
+    assert cached['delta']['stubs_per_func'][1]['det_h']['prototypes']==['int printf(const char *f, ...);']